@@ -0,0 +1,443 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# times createrepo, mergerepo and modifyrepo from this tree on a made up
+# repo of noarch rpms, built with rpmbuild from a seeded random shape so the
+# same options always give the same packages. The packages are kept in the
+# workdir between runs (keyed by the shape), so runs on different commits
+# time the same repo, and the results go into a json file to --compare
+# against later.
+#
+#   python bench/repo_runs.py [--packages=500] [--files=20]
+#       [--changelog=30] [--skew=1.5] [--churn=10] [--workers=1,2,4]
+#       [--compress-types=gz,bz2,xz] [--delta-workers=1,2,4] [--repeat=3]
+#       [--compare=OLD.json] [RUN...]
+#
+# RUN is any of full, update, workers, compress, deltas, delta-workers,
+# mergerepo and modifyrepo (default all of them). deltas and delta-workers
+# need makedeltarpm. delta-workers times making the prestodelta.xml from
+# drpms which are already there, without a cachedir so they all get read,
+# and prints how the deltas stage scales with --delta-workers.
+
+import os
+import sys
+import time
+import glob
+import errno
+import shutil
+import random
+import subprocess
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RUNS = ('full', 'update', 'workers', 'compress', 'deltas', 'delta-workers',
+        'mergerepo', 'modifyrepo')
+
+SPEC = """\
+%%define debug_package %%{nil}
+%%define __os_install_post %%{nil}
+%%define _build_id_links none
+Name: %(name)s
+Version: %(version)s
+Release: 1
+Summary: Made up package %(name)s for the createrepo benchmarks
+License: GPLv2+
+Group: Development/Tools
+BuildArch: noarch
+Provides: %(name)s-api = %(version)s
+Requires: %(requires)s
+
+%%description
+Made up package %(name)s, with %(nfiles)d files of %(filesize)d bytes each.
+
+%%install
+mkdir -p %%{buildroot}/usr/share/%(name)s
+for i in $(seq %(nfiles)d); do
+    yes '%(name)s-%(version)s' | head -c %(filesize)d \\
+        > %%{buildroot}/usr/share/%(name)s/file$i
+done
+
+%%files
+/usr/share/%(name)s
+
+%%changelog
+%(changelog)s
+"""
+
+
+def package_shapes(opts):
+    """the (name, nfiles, filesize, changelog entries, requires) of each
+       package, from opts and the seed alone"""
+    rand = random.Random(opts.seed)
+    shapes = []
+    for num in xrange(opts.packages):
+        # a few big packages and lots of small ones, like a real repo
+        scale = min(rand.paretovariate(opts.skew), 100.0)
+        nfiles = max(1, int(opts.files * scale / 2))
+        filesize = max(16, int(opts.file_size * rand.uniform(0.5, 1.5)))
+        nclog = max(1, int(opts.changelog * min(rand.paretovariate(opts.skew),
+                                                50.0) / 2))
+        requires = 'bench%05d-api' % rand.randint(0, num)
+        shapes.append(('bench%05d' % num, nfiles, filesize, nclog, requires))
+    return shapes
+
+
+def changelog(name, version, entries, rand):
+    """entries changelog entries, newest first, a day or so apart"""
+    when = 1400000000 + entries * 86400 * 2
+    out = []
+    for num in xrange(entries):
+        out.append('* %s Bench Mark <bench@example.com> - %s-1\n- %s\n' % (
+                   time.strftime('%a %b %d %Y', time.gmtime(when)), version,
+                   'change %d to %s: %s' % (entries - num, name,
+                                            'x' * rand.randint(10, 200))))
+        when -= rand.randint(1, 3) * 86400
+    return '\n'.join(out)
+
+
+def build_packages(destdir, shapes, version, opts):
+    """rpmbuild the packages of shapes at version into destdir, opts.jobs at
+       a time, unless it was already done"""
+    if os.path.exists(os.path.join(destdir, '.done')):
+        return
+    topdir = destdir + '.build'
+    shutil.rmtree(topdir, ignore_errors=True)
+    for sub in ('SPECS', 'BUILD', 'BUILDROOT', 'RPMS', 'SOURCES', 'SRPMS'):
+        os.makedirs(os.path.join(topdir, sub))
+    rand = random.Random('%s-%s' % (opts.seed, version))
+    specs = []
+    for (name, nfiles, filesize, nclog, requires) in shapes:
+        spec = os.path.join(topdir, 'SPECS', name + '.spec')
+        fo = open(spec, 'w')
+        fo.write(SPEC % {'name': name, 'version': version, 'nfiles': nfiles,
+                         'filesize': filesize, 'requires': requires,
+                         'changelog': changelog(name, version, nclog, rand)})
+        fo.close()
+        specs.append(spec)
+
+    print 'building %d packages in %s' % (len(specs), destdir)
+    running = []
+    devnull = open(os.devnull, 'w')
+    while specs or running:
+        while specs and len(running) < opts.jobs:
+            spec = specs.pop()
+            running.append((spec, subprocess.Popen(['rpmbuild', '-bb',
+                                '--define', '_topdir %s' % topdir, spec],
+                                stdout=devnull, stderr=subprocess.STDOUT)))
+        (spec, proc) = running.pop(0)
+        if proc.wait() != 0:
+            print >> sys.stderr, 'rpmbuild failed for %s' % spec
+            sys.exit(1)
+    devnull.close()
+
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    for rpm in glob.glob(os.path.join(topdir, 'RPMS', '*', '*.rpm')):
+        os.rename(rpm, os.path.join(destdir, os.path.basename(rpm)))
+    shutil.rmtree(topdir)
+    open(os.path.join(destdir, '.done'), 'w').close()
+
+
+def fresh_repo(srcdir, repodir, rpms=None):
+    """repodir with hardlinks to rpms (or all the rpms) of srcdir"""
+    shutil.rmtree(repodir, ignore_errors=True)
+    os.makedirs(repodir)
+    if rpms is None:
+        rpms = [fn for fn in os.listdir(srcdir) if fn.endswith('.rpm')]
+    for fn in rpms:
+        os.link(os.path.join(srcdir, fn), os.path.join(repodir, fn))
+    return repodir
+
+
+def timed(cmd, prepare=None, profile=None):
+    """run cmd, after prepare(), returns (seconds, --profile-json report)"""
+    if prepare is not None:
+        prepare()
+    if profile is not None:
+        cmd = cmd + ['--profile-json', profile]
+    start = time.time()
+    devnull = open(os.devnull, 'w')
+    ret = subprocess.call(cmd, stdout=devnull, cwd=TOP)
+    elapsed = time.time() - start
+    devnull.close()
+    if ret != 0:
+        print >> sys.stderr, 'failed: %s' % ' '.join(cmd)
+        sys.exit(1)
+    report = None
+    if profile is not None and os.path.exists(profile):
+        report = json.load(open(profile))
+        os.unlink(profile)
+    return (elapsed, report)
+
+
+def measure(name, cmd, opts, results, prepare=None, createrepo=True):
+    """time cmd opts.repeat times, keeping the best in results[name]"""
+    profile = None
+    if createrepo:
+        profile = os.path.join(opts.workdir, 'profile.json')
+    times = []
+    best = None
+    for num in range(opts.repeat):
+        (elapsed, report) = timed(cmd, prepare, profile)
+        times.append(elapsed)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, report)
+    times.sort()
+    results[name] = {'times': times, 'best': times[0],
+                     'median': times[len(times) // 2], 'profile': best[1]}
+    print '%-24s %9.3fs %9.3fs' % (name, times[0], times[len(times) // 2])
+
+
+def createrepo_cmd(opts, *args):
+    return [sys.executable, os.path.join(TOP, 'genpkgmetadata.py'),
+            '--worker-pool=fork', '--quiet'] + list(args)
+
+
+def run_all(opts, runs):
+    shapes = package_shapes(opts)
+    shape_key = 'p%d-f%d-s%d-c%d-k%g-r%d' % (opts.packages, opts.files,
+                opts.file_size, opts.changelog, opts.skew, opts.seed)
+    corpus = os.path.join(opts.workdir, shape_key)
+    base = os.path.join(corpus, 'base')
+    build_packages(base, shapes, '1.0', opts)
+    # the packages the --update churn and the --deltas are about
+    rand = random.Random(opts.seed)
+    churned = rand.sample(shapes, max(1, len(shapes) * opts.churn // 100))
+    updates = os.path.join(corpus, 'updates')
+    build_packages(updates, churned, '2.0', opts)
+
+    base_rpms = sorted([fn for fn in os.listdir(base) if fn.endswith('.rpm')])
+    update_rpms = sorted([fn for fn in os.listdir(updates)
+                          if fn.endswith('.rpm')])
+    churned_names = set([shape[0] for shape in churned])
+    kept_rpms = [fn for fn in base_rpms
+                 if fn.rsplit('-', 2)[0] not in churned_names]
+    repo = os.path.join(opts.workdir, 'repo')
+
+    results = {}
+    print '%-24s %10s %10s' % ('run', 'best', 'median')
+    if 'full' in runs:
+        measure('full', createrepo_cmd(opts, repo), opts, results,
+                prepare=lambda: fresh_repo(base, repo))
+
+    if 'update' in runs:
+        def churn():
+            fresh_repo(base, repo)
+            timed(createrepo_cmd(opts, repo))
+            for fn in base_rpms:
+                if fn not in kept_rpms:
+                    os.unlink(os.path.join(repo, fn))
+            for fn in update_rpms:
+                os.link(os.path.join(updates, fn), os.path.join(repo, fn))
+        measure('update-%d%%' % opts.churn,
+                createrepo_cmd(opts, '--update', repo), opts, results,
+                prepare=churn)
+
+    if 'workers' in runs:
+        fresh_repo(base, repo)
+        for workers in opts.workers:
+            measure('workers-%d' % workers,
+                    createrepo_cmd(opts, '--workers=%d' % workers, repo),
+                    opts, results)
+
+    if 'compress' in runs:
+        fresh_repo(base, repo)
+        for compress_type in opts.compress_types:
+            measure('compress-%s' % compress_type,
+                    createrepo_cmd(opts, '--compress-type=%s' % compress_type,
+                                   repo), opts, results)
+
+    have_makedeltarpm = [path for path in
+                         os.environ.get('PATH', '').split(':')
+                         if os.access(os.path.join(path, 'makedeltarpm'),
+                                      os.X_OK)]
+    def new_versions():
+        # which also throws away the drpms of the last go
+        fresh_repo(base, repo, kept_rpms)
+        for fn in update_rpms:
+            os.link(os.path.join(updates, fn), os.path.join(repo, fn))
+
+    if 'deltas' in runs:
+        if not have_makedeltarpm:
+            print '%-24s %10s' % ('deltas', 'skipped, no makedeltarpm')
+        else:
+            measure('deltas', createrepo_cmd(opts, '--deltas',
+                    '--oldpackagedirs=%s' % base, repo), opts, results,
+                    prepare=new_versions)
+
+    if 'delta-workers' in runs:
+        if not have_makedeltarpm:
+            print '%-24s %10s' % ('delta-workers', 'skipped, no makedeltarpm')
+        else:
+            new_versions()
+            timed(createrepo_cmd(opts, '--deltas',
+                                 '--oldpackagedirs=%s' % base, repo))
+            for workers in opts.delta_workers:
+                measure('delta-workers-%d' % workers, createrepo_cmd(opts,
+                        '--deltas', '--oldpackagedirs=%s' % base,
+                        '--workers=%d' % workers,
+                        '--delta-workers=%d' % workers, repo), opts, results)
+            delta_scaling(results, opts.delta_workers)
+
+    if 'mergerepo' in runs:
+        base_repo = os.path.join(opts.workdir, 'base-repo')
+        updates_repo = os.path.join(opts.workdir, 'updates-repo')
+        fresh_repo(base, base_repo)
+        fresh_repo(updates, updates_repo)
+        timed(createrepo_cmd(opts, base_repo))
+        timed(createrepo_cmd(opts, updates_repo))
+        merged = os.path.join(opts.workdir, 'merged')
+        measure('mergerepo', [sys.executable,
+                os.path.join(TOP, 'mergerepo.py'), '--repo', base_repo,
+                '--repo', updates_repo, '--outputdir', merged], opts, results,
+                prepare=lambda: shutil.rmtree(merged, ignore_errors=True),
+                createrepo=False)
+
+    if 'modifyrepo' in runs:
+        fresh_repo(base, repo)
+        timed(createrepo_cmd(opts, repo))
+        mdfile = os.path.join(opts.workdir, 'updateinfo.xml')
+        fo = open(mdfile, 'w')
+        fo.write('<?xml version="1.0"?>\n<updates>\n')
+        for (name, nfiles, filesize, nclog, requires) in churned:
+            fo.write(' <update from="bench@example.com" status="stable" '
+                     'type="bugfix" version="1.4"><id>BENCH-%s</id>'
+                     '<title>%s 2.0</title></update>\n' % (name, name))
+        fo.write('</updates>\n')
+        fo.close()
+        measure('modifyrepo', [sys.executable,
+                os.path.join(TOP, 'modifyrepo.py'), mdfile,
+                os.path.join(repo, 'repodata')], opts, results,
+                createrepo=False)
+    return results
+
+
+def delta_scaling(results, delta_workers):
+    """print the speedup of the deltas stage over the fewest delta workers"""
+    stages = []
+    for workers in delta_workers:
+        profile = results['delta-workers-%d' % workers]['profile']
+        if not profile or 'deltas' not in profile['stages']:
+            return
+        stages.append((workers, profile['stages']['deltas']))
+    (base_workers, base_time) = stages[0]
+    print '%-24s %10s %10s %10s' % ('delta workers', 'deltas', 'speedup',
+                                    'ideal')
+    for (workers, seconds) in stages:
+        print '%-24d %9.3fs %9.2fx %9.2fx' % (workers, seconds,
+                base_time / max(seconds, 1e-6),
+                float(workers) / base_workers)
+
+
+def compare(old, new):
+    print '%-24s %10s %10s %8s' % ('run', 'old', 'new', 'change')
+    for name in sorted(set(old['runs']) | set(new['runs'])):
+        if name not in old['runs'] or name not in new['runs']:
+            continue
+        before = old['runs'][name]['best']
+        after = new['runs'][name]['best']
+        print '%-24s %9.3fs %9.3fs %+7.1f%%' % (name, before, after,
+                                                (after / before - 1) * 100)
+
+
+def git_commit():
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                stdout=subprocess.PIPE, cwd=TOP)
+        commit = proc.communicate()[0].strip()
+    except OSError:
+        return 'unknown'
+    return commit or 'unknown'
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options] [RUN...]')
+    parser.add_option('--packages', default=500, type='int',
+                      help='number of packages (default 500)')
+    parser.add_option('--files', default=20, type='int',
+                      help='typical number of files per package (default 20)')
+    parser.add_option('--file-size', default=2048, type='int',
+                      help='typical size of those files (default 2048)')
+    parser.add_option('--changelog', default=30, type='int',
+                      help='typical changelog entries per package (default 30)')
+    parser.add_option('--skew', default=1.5, type='float',
+                      help='pareto shape of the package sizes and changelog '
+                           'lengths, smaller is more skewed (default 1.5)')
+    parser.add_option('--churn', default=10, type='int',
+                      help='percent of packages replaced for --update and '
+                           '--deltas (default 10)')
+    parser.add_option('--seed', default=42, type='int',
+                      help='random seed of the repo shape (default 42)')
+    parser.add_option('--workers', default='1,2,4',
+                      help='--workers values to time (default 1,2,4)')
+    parser.add_option('--compress-types', default='gz,bz2,xz',
+                      help='--compress-type values to time (default gz,bz2,xz)')
+    parser.add_option('--delta-workers', default='1,2,4',
+                      help='--delta-workers values to time (default 1,2,4)')
+    parser.add_option('--repeat', default=3, type='int',
+                      help='runs of each, the best counts (default 3)')
+    parser.add_option('--jobs', default=4, type='int',
+                      help='rpmbuilds at once (default 4)')
+    parser.add_option('--workdir', default='/var/tmp/createrepo-bench',
+                      help='where the packages and repos go')
+    parser.add_option('--results', default=None,
+                      help='json file for the results (default '
+                           'WORKDIR/results-COMMIT.json)')
+    parser.add_option('--compare', default=None, metavar='OLD.json',
+                      help='compare the results with an earlier run')
+    opts, runs = parser.parse_args(args)
+    for run in runs:
+        if run not in RUNS:
+            parser.error('unknown run %s, not one of %s' % (run,
+                                                            ', '.join(RUNS)))
+    runs = runs or RUNS
+    opts.workers = [int(workers) for workers in opts.workers.split(',')]
+    opts.compress_types = opts.compress_types.split(',')
+    opts.delta_workers = [int(workers)
+                          for workers in opts.delta_workers.split(',')]
+    opts.workdir = os.path.abspath(opts.workdir)
+    try:
+        os.makedirs(opts.workdir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    commit = git_commit()
+    results = {'commit': commit, 'time': time.time(),
+               'shape': {'packages': opts.packages, 'files': opts.files,
+                         'file_size': opts.file_size,
+                         'changelog': opts.changelog, 'skew': opts.skew,
+                         'churn': opts.churn, 'seed': opts.seed},
+               'runs': run_all(opts, runs)}
+    filename = opts.results or os.path.join(opts.workdir,
+                                            'results-%s.json' % commit)
+    fo = open(filename, 'w')
+    json.dump(results, fo, indent=1, sort_keys=True)
+    fo.close()
+    print 'results in %s' % filename
+
+    if opts.compare:
+        old = json.load(open(opts.compare))
+        if old['shape'] != results['shape']:
+            print >> sys.stderr, 'warning: %s was run on a different repo ' \
+                                 'shape' % opts.compare
+        compare(old, results)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# times the -x exclude filtering of trimRpms() on made up package lists,
+# against the old fnmatch() per path and glob loop
+#
+#   python bench/trim_excludes.py [--globs=50] [--old-max=100000] [SIZE...]
+
+import os
+import sys
+import time
+import random
+import fnmatch
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from createrepo.utils import compile_globs
+
+
+def old_trim(files, excludes):
+    """trimRpms() as it used to be"""
+    badrpms = []
+    for rpm_file in files:
+        for glob in excludes:
+            if fnmatch.fnmatch(rpm_file, glob):
+                if rpm_file not in badrpms:
+                    badrpms.append(rpm_file)
+    for rpm_file in badrpms:
+        if rpm_file in files:
+            files.remove(rpm_file)
+    return files
+
+def new_trim(files, excludes):
+    match = compile_globs(excludes)
+    if match is not None:
+        files[:] = [rpm_file for rpm_file in files if match(rpm_file) is None]
+    return files
+
+def make_paths(count, rand):
+    arches = ['noarch', 'x86_64', 'i686', 'src', 'aarch64']
+    paths = []
+    for num in xrange(count):
+        name = 'pkg%d-%s' % (num, rand.choice(['libs', 'devel', 'doc', 'debuginfo', 'common']))
+        paths.append('Packages/%s/%s-%d.%d-%d.fc20.%s.rpm' % (
+                     name[0], name, rand.randint(0, 9), rand.randint(0, 20),
+                     rand.randint(1, 5), rand.choice(arches)))
+    return paths
+
+def make_globs(count, rand):
+    globs = ['*debuginfo*', '*.src.rpm', 'Packages/p/pkg1?-*']
+    while len(globs) < count:
+        globs.append('*pkg%d-*.%s.rpm' % (rand.randint(0, 10**6),
+                                         rand.choice(['noarch', 'i686'])))
+    return globs[:count]
+
+def timed(func, files, excludes):
+    start = time.time()
+    result = func(list(files), excludes)
+    return (time.time() - start, result)
+
+def main(args):
+    parser = OptionParser(usage='%prog [options] [SIZE...]')
+    parser.add_option('--globs', default=50, type='int',
+                      help='number of -x globs (default 50)')
+    parser.add_option('--old-max', default=100000, type='int',
+                      help='skip the old code for lists bigger than this, '
+                           'it is quadratic (default 100000)')
+    opts, sizes = parser.parse_args(args)
+    sizes = [int(size) for size in sizes] or [10000, 100000, 300000, 1000000]
+
+    rand = random.Random(42)
+    excludes = make_globs(opts.globs, rand)
+    print '%10s %10s %12s %12s' % ('paths', 'kept', 'compiled', 'old')
+    for size in sizes:
+        files = make_paths(size, rand)
+        (new_time, new_result) = timed(new_trim, files, excludes)
+        old = '-'
+        if size <= opts.old_max:
+            (old_time, old_result) = timed(old_trim, files, excludes)
+            if old_result != new_result:
+                print >> sys.stderr, 'results differ for %d paths!' % size
+                sys.exit(1)
+            old = '%.3fs' % old_time
+        print '%10d %10d %11.3fs %12s' % (size, len(new_result), new_time, old)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
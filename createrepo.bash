@@ -17,7 +17,9 @@ _cr_createrepo()
 
     case $3 in
         --version|-h|--help|-u|--baseurl|--distro|--content|--repo|\
-        --revision|-x|--excludes|--changelog-limit|--max-delta-rpm-size)
+        --revision|-x|--excludes|--changelog-limit|--max-delta-rpm-size|\
+        --max-concurrent-delta-rpm-size|--delta-workers|--delta-timeout|\
+        --cache-max-entries)
             return 0
             ;;
         --basedir|-c|--cachedir|--update-md-path|-o|--outputdir|\
@@ -35,7 +37,7 @@ _cr_createrepo()
             _cr_checksum_type "$2"
             return 0
             ;;
-        -i|--pkglist|--read-pkgs-list)
+        -i|--pkglist|--read-pkgs-list|--change-journal|--daemon|--profile-json)
             local IFS=$'\n'
             COMPREPLY=( $( compgen -f -o plusdirs -- "$2" ) )
             return 0
@@ -59,6 +61,10 @@ _cr_createrepo()
             COMPREPLY=( $( compgen -W "{1..$max}" -- "$2" ) )
             return 0
             ;;
+        --worker-pool)
+            COMPREPLY=( $( compgen -W 'exec fork' -- "$2" ) )
+            return 0
+            ;;
         --compress-type)
             _cr_compress_type "$1" "$2"
             return 0
@@ -67,13 +73,17 @@ _cr_createrepo()
 
     if [[ $2 == -* ]] ; then
         COMPREPLY=( $( compgen -W '--version --help --quiet --verbose --profile
+            --profile-json
             --excludes --basedir --baseurl --groupfile --checksum --pretty
-            --cachedir --checkts --no-database --update --update-md-path
-            --skip-stat --split --pkglist --includepkg --outputdir
-            --skip-symlinks --changelog-limit --unique-md-filenames
-            --simple-md-filenames --retain-old-md --distro --content --repo
-            --revision --deltas --oldpackagedirs --num-deltas --read-pkgs-list
-            --max-delta-rpm-size --workers --compress-type' -- "$2" ) )
+            --cachedir --cache-stats --cache-max-entries --checkts
+            --no-database --sqlite-direct --update --update-md-path
+            --skip-stat --change-journal --watch --daemon --split --pkglist --includepkg --outputdir --skip-symlinks
+            --changelog-limit --unique-md-filenames --simple-md-filenames
+            --retain-old-md --distro --content --repo --revision --deltas
+            --oldpackagedirs --num-deltas --read-pkgs-list
+            --max-delta-rpm-size --max-concurrent-delta-rpm-size --delta-workers
+            --delta-timeout --workers --worker-pool --compress-type' \
+            -- "$2" ) )
     else
         local IFS=$'\n'
         COMPREPLY=( $( compgen -d -- "$2" ) )
@@ -16,8 +16,8 @@
 
 import os
 import sys
-import fnmatch
 import time
+import marshal
 import yumbased
 import shutil
 from  bz2 import BZ2File
@@ -25,12 +25,9 @@ from urlgrabber import grabber
 import tempfile
 import stat
 import fcntl
-import subprocess
-from select import select
 
 # To support parallel deltarpms
 import multiprocessing
-import multiprocessing.managers
 
 from yum import misc, Errors
 from yum.repoMDObject import RepoMD, RepoData
@@ -39,8 +36,12 @@ from yum.packageSack import MetaSack
 from yum.packages import YumAvailablePackage
 
 import rpmUtils.transaction
+from rpmUtils.miscutils import compareEVR
 from utils import _, errorprint, MDError, lzma, _available_compression
 import readMetadata
+import journal
+import cache
+import timing
 try:
     import sqlite3 as sqlite
 except ImportError:
@@ -52,18 +53,25 @@ except ImportError:
     pass
 
 from utils import _gzipOpen, compressFile, compressOpen, checkAndMakeDir, GzipFile, \
-                  checksum_and_rename, split_list_into_equal_chunks
-from utils import num_cpus_online
+                  checksum_and_rename
+from utils import num_cpus_online, ThreadedWriter, ChecksumWriter, \
+                  ChecksumCompressFile, checksumCompressFile, walk_files, \
+                  compile_globs
+from workerpool import WorkerPool, ForkWorkerPool, ShardParts
 import deltarpms
 
 __version__ = '0.9.9'
 
+# the dirs in the outputdir the workers' shards go in
+WORKER_DIR_PREFIX = '.workers'
+
 
 class MetaDataConfig(object):
     def __init__(self):
         self.quiet = False
         self.verbose = False
         self.profile = False
+        self.profile_json = None # file to write the run's timings to
         self.excludes = []
         self.baseurl = None
         self.groupfile = None
@@ -71,6 +79,8 @@ class MetaDataConfig(object):
         self.pretty = False
         self.cachedir = None
         self.use_cache = False
+        self.cache_stats = False # report checksum cache hits/misses
+        self.cache_max_entries = 0 # evict lru checksums beyond this, 0 = never
         self.basedir = os.getcwd()
         self.checkts = False
         self.split = False
@@ -85,11 +95,16 @@ class MetaDataConfig(object):
         self.max_delta_rpm_size = 100000000
         self.update_md_path = None
         self.skip_stat = False
+        self.change_journal = None # journal kept by --watch, see journal.py
+        self.watch = False
+        self.daemon = None # unix socket to take requests on, see daemon.py
         self.database = True
+        self.sqlite_direct = False # fill the dbs from the packages, not the xml
         self.outputdir = None
         self.file_patterns = ['.*bin\/.*', '^\/etc\/.*', '^\/usr\/lib\/sendmail$']
         self.dir_patterns = ['.*bin\/.*', '^\/etc\/.*']
         self.skip_symlinks = False
+        self.scan_threads = 4 # threads listing the package dirs at once
         self.pkglist = []
         self.database_only = False
         self.primaryfile = 'primary.xml'
@@ -114,13 +129,16 @@ class MetaDataConfig(object):
         self.collapse_glibc_requires = True
         self.workers = 1 # number of workers to fork off to grab metadata from the pkgs
         self.worker_cmd = '/usr/share/createrepo/worker.py'
+        # 'exec' runs worker_cmd, 'fork' forks the workers from this process
+        self.worker_pool = 'exec'
         #self.worker_cmd = './worker.py' # helpful when testing
         self.retain_old_md = 0
         self.compress_type = 'compat'
         # Parallel deltas additions
         self.delta_workers = 1 # number of workers to fork when doing deltarpms
-        # Keep the combined payload size of all in-progress deltarpm creation below this number
+        # Keep the combined memory use of all in-progress deltarpm creation below this number
         self.max_concurrent_delta_rpm_size = self.max_delta_rpm_size
+        self.delta_timeout = None # seconds before a makedeltarpm is killed
         
 class SimpleMDCallBack(object):
     def errorlog(self, thing):
@@ -135,6 +153,25 @@ class SimpleMDCallBack(object):
         sys.stdout.flush()
 
 
+# the MetaDataGenerator the --delta-workers read drpms for, which they get
+# by forking rather than pickling
+_drpm_reader = None
+
+def _init_drpm_reader(mdgen):
+    global _drpm_reader
+    _drpm_reader = mdgen
+
+def _read_drpm_batch(drpm_fns):
+    """returns [(drpm_fn, what _read_drpm() returned, error)] for the batch"""
+    results = []
+    for drpm_fn in drpm_fns:
+        try:
+            results.append((drpm_fn, _drpm_reader._read_drpm(drpm_fn), None))
+        except Exception, e:
+            results.append((drpm_fn, None, str(e)))
+    return results
+
+
 class MetaDataGenerator:
     def __init__(self, config_obj=None, callback=None):
         self.conf = config_obj
@@ -153,6 +190,19 @@ class MetaDataGenerator:
         self.rpmlib_reqs = {}
         self.read_pkgs = []
         self.compat_compress = False
+        # identifies this run's entries in the checksum cache
+        self._cache_run = time.time()
+        self._sqlite_direct = False
+        self._sqlite_patch = False
+        # workers started by the scan, and what it gave them and found out
+        self._worker_pool = None
+        self._worker_pool_pkgs = set()
+        self._manifest = None
+        # where the change journal was up to when we started
+        self._journal_state = None
+        # for --profile-json
+        self.timings = timing.RunTimings(per_package=bool(
+                                                    self.conf.profile_json))
 
         if not self.conf.directory and not self.conf.directories:
             raise MDError, "No directory given on which to run."
@@ -293,40 +343,63 @@ class MetaDataGenerator:
             self.conf.cachedir = a
 
 
-    def _os_path_walk(self, top, func, arg):
-        """Directory tree walk with callback function.
-         copy of os.path.walk, fixes the link/stating problem
-         """
-
-        try:
-            names = os.listdir(top)
-        except os.error:
-            return
-        func(arg, top, names)
-        for name in names:
-            name = os.path.join(top, name)
-            if os.path.isdir(name):
-                self._os_path_walk(name, func, arg)
     def getFileList(self, directory, ext):
         """Return all files in path matching ext, store them in filelist,
         recurse dirs. Returns a list object"""
-
-        extlen = len(ext)
-
-        def extension_visitor(filelist, dirname, names):
-            for fn in names:
-                fn = os.path.join(dirname, fn)
-                if os.path.isdir(fn):
+        return list(walk_files(directory, ext, self.conf.skip_symlinks,
+                               self.conf.scan_threads))
+
+    def _journal_packages(self):
+        """the packages in the package dir, made from those in the old
+           manifest and whatever the change journal says changed, rather
+           than by walking the dir"""
+        packages = set()
+        for relpath in self.oldData.changed:
+            path = os.path.join(self.package_dir, relpath)
+            if self.conf.skip_symlinks and os.path.islink(path):
+                continue
+            if os.path.isdir(path):
+                for pkg in walk_files(path, '.rpm', self.conf.skip_symlinks,
+                                      self.conf.scan_threads):
+                    packages.add(os.path.join(relpath, pkg))
+            elif relpath.lower().endswith('.rpm'):
+                packages.add(relpath)
+        packages.update(self.oldData.manifest_paths)
+
+        for pkg in sorted(packages):
+            if self.oldData.isChanged(pkg):
+                path = os.path.join(self.package_dir, pkg)
+                if not os.path.isfile(path):
                     continue
-                if self.conf.skip_symlinks and os.path.islink(fn):
+                if self.conf.skip_symlinks and os.path.islink(path):
                     continue
-                elif fn[-extlen:].lower() == '%s' % (ext):
-                    filelist.append(fn[len(startdir):])
-
-        filelist = []
-        startdir = directory + '/'
-        self._os_path_walk(startdir, extension_visitor, filelist)
-        return filelist
+            yield pkg
+
+    def _scan_packages(self):
+        """getFileList() and trimRpms() of the package dir, handing the new
+        packages to the workers as soon as they are found, so they are being
+        read while the scan is still going. Returns the list of packages"""
+        reldir = os.path.join(self.conf.basedir, self.conf.directory)
+        packages = []
+        if self.conf.update and self.oldData.changed is not None:
+            found = self._journal_packages()
+        else:
+            found = walk_files(self.package_dir, '.rpm',
+                               self.conf.skip_symlinks, self.conf.scan_threads)
+        for pkg in found:
+            if self._excluded(pkg):
+                continue
+            packages.append(pkg)
+            if self.conf.update and pkg in self.oldData.pkg_tups_by_path:
+                # writeMetadataDocs() will get it from the old metadata
+                continue
+            if self._worker_pool is None:
+                self._worker_pool = self._start_worker_pool(reldir)
+            self._worker_pool.submit(pkg, pkg)
+            self._worker_pool_pkgs.add(pkg)
+            if len(self._worker_pool_pkgs) % 64 == 0:
+                self._worker_pool.poll()
+        return packages
 
     def errorlog(self, thing):
         """subclass this if you want something different...."""
@@ -336,6 +409,10 @@ class MetaDataGenerator:
         """check the timestamp of our target dir. If it is not newer than
            the repodata return False, else True"""
         if self.conf.checkts and self.conf.mdtimestamp:
+            changed = self._journal_changes()
+            if changed is not None:
+                # nothing's changed if the journal says so
+                return not changed
             dn = os.path.join(self.conf.basedir, self.conf.directory)
             files = self.getFileList(dn, '.rpm')
             files = self.trimRpms(files)
@@ -350,16 +427,44 @@ class MetaDataGenerator:
 
         return False
 
+    def _journal_changes(self):
+        """the paths under the package dir which the change journal says
+           changed since the repodata was made, leaving out the repodata
+           itself, or None if it can't tell"""
+        if not self.conf.change_journal:
+            return None
+        repodata = os.path.join(self.conf.outputdir, self.conf.finaldir)
+        manifest = readMetadata.read_manifest(os.path.join(repodata,
+                                              readMetadata.MANIFEST_FILE))
+        if manifest is None:
+            return None
+        (state, changed) = journal.read_journal(self.conf.change_journal,
+                                                manifest[0].get('journal'))
+        if changed is None:
+            return None
+        ours = (self.conf.finaldir, self.conf.tempdir, self.conf.olddir)
+        return [relpath for relpath in changed
+                if relpath.split('/')[0] not in ours and
+                   not relpath.startswith(WORKER_DIR_PREFIX)]
+
+    def _exclude_matcher(self):
+        """the compiled conf.excludes, see utils.compile_globs()"""
+        excludes = tuple(self.conf.excludes)
+        if getattr(self, '_excludes', None) != excludes:
+            self._excludes = excludes
+            self._exclude_match = compile_globs(excludes)
+        return self._exclude_match
+
+    def _excluded(self, rpm_file):
+        match = self._exclude_matcher()
+        return match is not None and match(rpm_file) is not None
+
     def trimRpms(self, files):
-        badrpms = []
-        for rpm_file in files:
-            for glob in self.conf.excludes:
-                if fnmatch.fnmatch(rpm_file, glob):
-                    if rpm_file not in badrpms:
-                        badrpms.append(rpm_file)
-        for rpm_file in badrpms:
-            if rpm_file in files:
-                files.remove(rpm_file)
+        """drop the files matching conf.excludes, in place"""
+        match = self._exclude_matcher()
+        if match is not None:
+            files[:] = [rpm_file for rpm_file in files
+                        if match(rpm_file) is None]
         return files
 
     def _setup_old_metadata_lookup(self):
@@ -374,7 +479,12 @@ class MetaDataGenerator:
             opts = {
                 'verbose' : self.conf.verbose,
                 'sumtype' : self.conf.sumtype,
-                'pkgdir'  : os.path.normpath(self.package_dir)
+                'pkgdir'  : os.path.normpath(self.package_dir),
+                # for copying the old xml, see readMetadata.FRAGMENT_OPTS
+                'baseurl' : self.conf.baseurl,
+                'changelog_limit' : self.conf.changelog_limit,
+                'collapse_libc_requires' : self.conf.collapse_glibc_requires,
+                'journal' : self.conf.change_journal,
             }
 
             if self.conf.skip_stat:
@@ -404,8 +514,14 @@ class MetaDataGenerator:
 
     def doPkgMetadata(self):
         """all the heavy lifting for the package metadata"""
+        if self.conf.change_journal:
+            # anything recorded from here on is left for the next run
+            self._journal_state = journal.read_journal(
+                                            self.conf.change_journal)[0]
         if self.conf.update:
-            self._setup_old_metadata_lookup()
+            with self.timings.stage('old_metadata'):
+                self._setup_old_metadata_lookup()
+        scan_st = time.time()
         # rpms we're going to be dealing with
         if isinstance(self.conf.pkglist, MetaSack):
             packages = self.conf.pkglist
@@ -421,11 +537,11 @@ class MetaDataGenerator:
                     continue
                 # not fatal, yet
                 self.callback.errorlog('Cannot read file: %s' % path)
+            packages = self.trimRpms(packages)
         else:
-            packages = self.getFileList(self.package_dir, '.rpm')
+            packages = self._scan_packages()
+        self.timings.add('scan', time.time() - scan_st)
 
-        if not isinstance(packages, MetaSack):
-            packages = self.trimRpms(packages)
         self.pkgcount = len(packages)
         try:
             self.openMetadataDocs()
@@ -442,15 +558,58 @@ class MetaDataGenerator:
             self.primaryfile = self._setupPrimary()
             self.flfile = self._setupFilelists()
             self.otherfile = self._setupOther()
+            if not self.conf.split:
+                # --update doesn't know the split media paths
+                self._manifest = []
+            if self._use_sqlite_patch():
+                # only the changed packages need to go into the old dbs
+                self._sqlite_patch = self._patch_sqlite_dbs()
+            if self._sqlite_patch:
+                self._sqlite_direct = True
+            elif self.conf.sqlite_direct and self._use_sqlite_direct():
+                #  the dbs are filled in as the packages are written out,
+                # rather than by parsing the xml back in doRepoMetadata
+                self.setup_sqlite_dbs()
+                self._sqlite_direct = True
         if self.conf.deltas:
             self.deltafile = self._setupDelta()
 
+    def _use_sqlite_direct(self):
+        return (self.conf.database and not self.conf.database_only and
+                (self.conf.sqlite_direct or self._use_sqlite_patch()))
+
+    def _use_sqlite_patch(self):
+        return (self.conf.database and self.conf.update and
+                not self.conf.database_only and not self.conf.split and
+                getattr(self, 'oldData', None) is not None and
+                self.oldData.old_dbs is not None)
+
+    def _patch_sqlite_dbs(self):
+        """set up the dbs as copies of the old ones, returns False if they
+           can't be used"""
+        destdir = os.path.join(self.conf.outputdir, self.conf.tempdir)
+        try:
+            self.md_sqlite = MetaDataSqlite(destdir, self.oldData.old_dbs)
+        except (sqlite.Error, IOError, OSError, MDError), e:
+            if self.conf.verbose:
+                self.callback.log(_('Cannot update the old sqlite dbs: %s') % e)
+            for ftype in ('primary', 'filelists', 'other'):
+                try:
+                    os.unlink(os.path.join(destdir, '%s.sqlite' % ftype))
+                except OSError:
+                    pass
+            return False
+        return True
+
     def _setupPrimary(self):
         # setup the primary metadata file
         fpz = self.conf.primaryfile + '.' + self.conf.compress_type
         primaryfilepath = os.path.join(self.conf.outputdir, self.conf.tempdir,
                                        fpz)
-        fo = compressOpen(primaryfilepath, 'w', self.conf.compress_type)
+        #  compressed (and checksummed, for repomd.xml) in a thread of its own,
+        # alongside reading the packages
+        fo = ThreadedWriter(ChecksumCompressFile(primaryfilepath,
+                                  self.conf.compress_type, self.conf.sumtype))
         fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         fo.write('<metadata xmlns="http://linux.duke.edu/metadata/common"' \
             ' xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%s">' %
@@ -462,7 +621,8 @@ class MetaDataGenerator:
         fpz = self.conf.filelistsfile + '.' + self.conf.compress_type
         filelistpath = os.path.join(self.conf.outputdir, self.conf.tempdir,
                                     fpz)
-        fo = compressOpen(filelistpath, 'w', self.conf.compress_type)
+        fo = ThreadedWriter(ChecksumCompressFile(filelistpath,
+                                  self.conf.compress_type, self.conf.sumtype))
         fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         fo.write('<filelists xmlns="http://linux.duke.edu/metadata/filelists"' \
                  ' packages="%s">' % self.pkgcount)
@@ -473,7 +633,8 @@ class MetaDataGenerator:
         fpz = self.conf.otherfile + '.' + self.conf.compress_type
         otherfilepath = os.path.join(self.conf.outputdir, self.conf.tempdir,
                                      fpz)
-        fo = compressOpen(otherfilepath, 'w', self.conf.compress_type)
+        fo = ThreadedWriter(ChecksumCompressFile(otherfilepath,
+                                  self.conf.compress_type, self.conf.sumtype))
         fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         fo.write('<otherdata xmlns="http://linux.duke.edu/metadata/other"' \
                  ' packages="%s">' %
@@ -485,7 +646,8 @@ class MetaDataGenerator:
         fpz = self.conf.deltafile + '.' + self.conf.compress_type        
         deltafilepath = os.path.join(self.conf.outputdir, self.conf.tempdir,
                                      fpz)
-        fo = compressOpen(deltafilepath, 'w', self.conf.compress_type)
+        fo = ThreadedWriter(ChecksumCompressFile(deltafilepath,
+                                  self.conf.compress_type, self.conf.sumtype))
         fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         fo.write('<prestodelta>\n')
         return fo
@@ -522,6 +684,9 @@ class MetaDataGenerator:
         else:
             rpmfile = '%s/%s' % (pkgpath, rpmfile)
 
+        if self.conf.cachedir:
+            cache.get_checksum_cache(self.conf.cachedir, self.conf.sumtype,
+                                     self._cache_run)
         external_data = { '_cachedir': self.conf.cachedir,
                           '_baseurl': baseurl,
                           '_reldir': reldir,
@@ -532,7 +697,8 @@ class MetaDataGenerator:
         try:
             po = yumbased.CreateRepoPackage(self.ts, rpmfile,
                                             sumtype=self.conf.sumtype,
-                                            external_data = external_data)
+                                            external_data = external_data,
+                                            clog_limit=self.conf.changelog_limit)
         except Errors.MiscError, e:
             raise MDError, "Unable to open package: %s" % e
 
@@ -562,6 +728,7 @@ class MetaDataGenerator:
         
         newpkgs = []
         keptpkgs = []
+        oldpkgs = set() # the keptpkgs from the old metadata
         if self.conf.update:
             # if we're in --update mode then only act on the new/changed pkgs
             for pkg in pkglist:
@@ -572,12 +739,23 @@ class MetaDataGenerator:
                 old_pkg = pkg
                 if pkg.find("://") != -1:
                     old_pkg = os.path.basename(pkg)
+                elif ((not self._sqlite_direct or self._sqlite_patch) and
+                      self.oldData.hasFragments(old_pkg)):
+                    #  its xml can be copied from the old metadata as is, so
+                    # don't even load the old package
+                    if self.conf.verbose:
+                        self.callback.log(_("Using data from old metadata for %s")
+                                            % pkg)
+                    keptpkgs.append((pkg, None))
+                    oldpkgs.add(pkg)
+                    continue
                 old_po = self.oldData.getNodes(old_pkg)
                 if old_po: # we have a match in the old metadata
                     if self.conf.verbose:
                         self.callback.log(_("Using data from old metadata for %s")
                                             % pkg)
                     keptpkgs.append((pkg, old_po))
+                    oldpkgs.add(pkg)
 
                     #FIXME - if we're in update and we have deltas enabled
                     # check the presto data for this pkg and write its info back out
@@ -619,14 +797,38 @@ class MetaDataGenerator:
         # Need to write them in sorted(filename) order.  We loop over pkgfiles,
         # inserting keptpkgs in right spots (using the upto argument).
         def save_keptpkgs(upto):
+            kept_st = time.time()
             while keptpkgs and (upto is None or keptpkgs[-1][0] < upto):
                 filename, po = keptpkgs.pop()
+                self.timings.count('packages_kept')
+                if po is None:
+                    xml = self.oldData.getFragments(filename)
+                    if xml is not None:
+                        entry = self.oldData.manifest[filename]
+                        self._write_package(filename, xml, entry[1:6])
+                        if self._sqlite_patch:
+                            self.md_sqlite.keep_package(entry[3], filename)
+                        continue
+                    # the old xml isn't what the manifest said, read it again
+                    po = self.oldData.getNodes(filename)
+                    if po is None:
+                        po = self.read_in_package(filename, pkgpath=pkgpath,
+                                                  reldir=reldir)
+                        oldpkgs.discard(filename)
                 # reset baseurl in the old pkg
                 po.basepath = self.conf.baseurl
-                self.primaryfile.write(po.xml_dump_primary_metadata())
-                self.flfile.write(po.xml_dump_filelists_metadata())
-                self.otherfile.write(po.xml_dump_other_metadata(
-                    clog_limit=self.conf.changelog_limit))
+                self._write_package(filename,
+                    (po.xml_dump_primary_metadata(),
+                     po.xml_dump_filelists_metadata(),
+                     po.xml_dump_other_metadata(
+                        clog_limit=self.conf.changelog_limit)),
+                    yumbased.manifest_info(po))
+                if self._sqlite_patch and filename in oldpkgs:
+                    self.md_sqlite.keep_package(po.checksum, po.relativepath)
+                elif self._sqlite_direct:
+                    self.md_sqlite.add_package(po.checksum,
+                        yumbased.sqlite_rows(po, self.conf.changelog_limit))
+            self.timings.add('kept_packages', time.time() - kept_st)
 
         if pkgfiles:
             # divide that list by the number of workers and fork off that many
@@ -634,306 +836,225 @@ class MetaDataGenerator:
             # waitfor the workers to finish and as each one comes in
             # open the files they created and write them out to our metadata
             # add up the total pkg counts and return that value
-            self._worker_tmp_path = tempfile.mkdtemp() # setting this in the base object so we can clean it up later
-            if self.conf.workers < 1:
-                self.conf.workers = min(num_cpus_online(), len(pkgfiles))
             pkgfiles.sort()
-            worker_chunks = split_list_into_equal_chunks(pkgfiles, self.conf.workers)
-            worker_cmd_dict = {}
-            worker_jobs = {}
-            base_worker_cmdline = [self.conf.worker_cmd, 
-                    '--pkgoptions=_reldir=%s' % reldir,
-                    '--pkgoptions=_collapse_libc_requires=%s' % self.conf.collapse_glibc_requires, 
-                    '--pkgoptions=_cachedir=%s' % self.conf.cachedir,
-                    '--pkgoptions=_baseurl=%s' % self.conf.baseurl,
-                    '--globalopts=clog_limit=%s' % self.conf.changelog_limit,
-                    '--globalopts=sumtype=%s' % self.conf.sumtype, ]
-            
-            if self.conf.quiet:
-                base_worker_cmdline.append('--quiet')
-            
-            if self.conf.verbose:
-                base_worker_cmdline.append('--verbose')
-                
-            for worker_num in range(self.conf.workers):
-                pkl = self._worker_tmp_path + '/pkglist-%s' % worker_num
-                f = open(pkl, 'w') 
-                f.write('\n'.join(worker_chunks[worker_num]))
-                f.close()
-                
-                workercmdline = []
-                workercmdline.extend(base_worker_cmdline)
-                workercmdline.append('--pkglist=%s/pkglist-%s' % (self._worker_tmp_path, worker_num))
-                worker_cmd_dict[worker_num] = workercmdline
-            
-                
-
-            for (num, cmdline) in worker_cmd_dict.items():
-                if not self.conf.quiet:
-                    self.callback.log("Spawning worker %s with %s pkgs" % (num, 
-                                                      len(worker_chunks[num])))
-                job = subprocess.Popen(cmdline, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-                worker_jobs[num] = job
-            
-            files = self.primaryfile, self.flfile, self.otherfile
-            def log_messages(num):
-                job = worker_jobs[num]
-                while True:
-                    # check stdout and stderr
-                    for stream in select((job.stdout, job.stderr), (), ())[0]:
-                        line = stream.readline()
-                        if line: break
-                    else:
-                        return # EOF, EOF
-                    if stream is job.stdout:
-                        if line.startswith('*** '):
-                            if line == '*** \n':
-                                return True
-                            # get data, save to local files
-                            for out, size in zip(files, line[4:].split()):
-                                out.write(stream.read(int(size)))
-                            return
-                        self.callback.log('Worker %s: %s' % (num, line.rstrip()))
-                    else:
-                        self.callback.errorlog('Worker %s: %s' % (num, line.rstrip()))
-
+            pool = self._worker_pool
+            if pool is None:
+                pool = self._start_worker_pool(reldir, len(pkgfiles))
+
+                # hand out the biggest packages first, so that one huge rpm
+                # near the end of the list can't leave the other workers idle
+                def pkgsize(pkg):
+                    try:
+                        return os.stat(os.path.join(reldir, pkg)).st_size
+                    except OSError:
+                        return 0
+                for pkg in sorted(pkgfiles, key=pkgsize, reverse=True):
+                    pool.submit(pkg, pkg)
+            else:
+                # the scan handed them out as it found them
+                for pkg in pkgfiles:
+                    if pkg not in self._worker_pool_pkgs:
+                        pool.submit(pkg, pkg)
+                self._worker_pool = None
+                self._worker_pool_pkgs = set()
+            pool.close()
+
+            results = {}
+            pool_results = pool.results()
             err = 0
-            for i, pkg in enumerate(pkgfiles):
+            delta_pkgs = []
+            for pkg in pkgfiles:
                 # insert cached packages
                 save_keptpkgs(pkg)
 
-                # save output to local files
-                if log_messages(i % self.conf.workers):
+                # workers finish out of order, hold on to whatever comes
+                # back early until it is this package's turn - only where
+                # it is in the workers' shards, the xml stays on disk
+                wait_st = time.time()
+                while pkg not in results:
+                    done, parts = pool_results.next()
+                    results[done] = parts
+                self.timings.add('ipc_wait', time.time() - wait_st)
+                parts = results.pop(pkg)
+                if parts is None:
                     err += 1
-
-            for (num, job) in worker_jobs.items():
-                # process remaining messages on stderr
-                log_messages(num)
-
-                if job.wait() != 0:
-                    msg = "Worker exited with non-zero value: %s. Fatal." % job.returncode
-                    self.callback.errorlog(msg)
-                    raise MDError, msg
+                    continue
+                # save output to local files
+                write_st = time.time()
+                info = marshal.loads(parts[3])
+                if isinstance(parts, ShardParts):
+                    # big filelists never have to be in memory all at once
+                    xml = [parts.chunks(item) for item in range(3)]
+                else:
+                    xml = parts[:3]
+                self._write_package(pkg, xml, info)
+                self.timings.add('write', time.time() - write_st)
+                if self.conf.deltas:
+                    # what the worker read is all the deltas need
+                    delta_pkgs.append(deltarpms.DeltaPackage(
+                        os.path.join(reldir, pkg), info[4], info[0]))
+                stages = marshal.loads(parts[4])
+                stages['total'] = pool.timings.get(pkg, 0.0)
+                self.timings.package(pkg, stages)
+                self.timings.count('packages_read')
+                self.timings.count('bytes_read', info[0])
+                if self._sqlite_direct:
+                    with self.timings.stage('sqlite'):
+                        rows = marshal.loads(parts[5])
+                        self.md_sqlite.add_package(rows['packages'][0][0],
+                                                   rows)
+
+            # process remaining messages on stderr
+            for done, parts in pool_results:
+                pass
+            pool.wait()
+            # the workers' shards, all the xml of the directory, are done with
+            shutil.rmtree(self._worker_tmp_path, ignore_errors=True)
+            self._worker_tmp_path = None
+            self.timings.pool(self.conf.workers, sum(pool.timings.values()),
+                              time.time() - pool.started)
                     
             if not self.conf.quiet:
                 self.callback.log("Workers Finished")
+            if self.conf.profile and pool.timings:
+                slowest = max(pool.timings, key=pool.timings.get)
+                self.callback.log('workers time: %0.3f, slowest: %s %0.3f' % (
+                                  sum(pool.timings.values()), slowest,
+                                  pool.timings[slowest]))
+            if self.conf.profile and pool.memory:
+                peak = max([rss for (rss, rise) in pool.memory.values()])
+                hungriest = max(pool.memory,
+                                key=lambda pkg: pool.memory[pkg][1])
+                self.callback.log('workers peak rss: %d kB, biggest rise: '
+                                  '%s %d kB' % (peak, hungriest,
+                                  pool.memory[hungriest][1]))
                     
             if err:
                 raise MDError, "Failed to process %d package(s)." % err
 
-            if self.conf.delta_workers == 1:
-                for pkgfile in pkgfiles:
-                    if self.conf.deltas:
-                        try:
-                            po = self.read_in_package(pkgfile, pkgpath=pkgpath, reldir=reldir)
-                            self._do_delta_rpm_package(po)
-                        except MDError, e:
-                            errorprint(e)
-                            continue
-                    self.read_pkgs.append(pkgfile)
-            else:
-                self._parallel_deltas(pkgfiles, pkgpath, reldir)
+            if self.conf.deltas:
+                self._make_deltas(delta_pkgs)
+            self.read_pkgs.extend(pkgfiles)
 
         save_keptpkgs(None) # append anything left
         return self.current_pkg
 
-    def _parallel_deltas(self, pkgfiles, pkgpath, reldir):
-        class WrappedMDCallBack(object):
-            def __init__(self, log_queue):
-                self.log_queue = log_queue
-            def errorlog(self, thing):
-                self.log_queue.put([ "errorlog", os.getpid(), thing ])
-
-            def log(self, thing):
-                self.log_queue.put([ "log", os.getpid(), thing ])
-
-            def progress(self, item, current, total):
-                # progress messages in a multiprocess context are likely to just be a confusing mess
-                pass
-
-        # Init a few things that we'd rather do in the main process and then
-        # inherit in the children
-        if not hasattr(self, 'tempdir'):
-            self.tempdir = tempfile.mkdtemp()
-        self._get_old_package_dict()
-
-        # queue containing packages that are candidates for processing
-        # now within the memory constraints
-        work_queue = multiprocessing.Queue(1)
-
-        # queue containing callback messages from the workers
-        log_queue = multiprocessing.Queue()
-
-        # Event used to allow the manager, when needed, to block for a completed task in a worker
-        completion_event = multiprocessing.Event()
-
-        # wrapped callback to pass in to workers
-        callback_wrap = WrappedMDCallBack(log_queue)
-
-        # list containing the completed packages
-        # accessed in children via a Manager and proxy as each child proc
-        # will be appending as it finishes
-        manager = multiprocessing.Manager()
-        read_pkgs_proxy = manager.list()
-
-        # lists used by the package size reading workers
-        pkgfiles_proxy = manager.list(pkgfiles)
-        pkgfiles_withsize_proxy = manager.list()
-
-        # process-safe value - total size of RPM payloads being deltaed
-        # The lock for entry into this also functions as our critical section
-        # elsewhere, as changes in the "in-flight" size of deltas is the key
-        # decision point in our work queue
-        # 'L' is unsigned long
-        active_work_size = multiprocessing.Value('L',0)
-
-        # Our candidate list is the packages sorted from largest to smallest
-        # Do this with workers as well because, parallel is good
-        # Seriously though, this is also CPU-bound
-        self.callback.log("Reading package sizes in preparation for deltarpm creation")
-
-        def size_reader_entry(pkgfiles_proxy, pkgpath, reldir, pkgfiles_withsize_proxy, repo_obj):
-            while True:
-                try:
-                    pkgfile = pkgfiles_proxy.pop()
-                    po = repo_obj.read_in_package(pkgfile, pkgpath=pkgpath, reldir=reldir)
-                    pkgfiles_withsize_proxy.append([ pkgfile, po.size ])
-                except IndexError:
-                    break
-
-        sort_workers = [ ]
-        for i in range(0,self.conf.delta_workers):
-            sw = multiprocessing.Process(target = size_reader_entry, args = (pkgfiles_proxy, pkgpath, reldir, pkgfiles_withsize_proxy, self))
-            sort_workers.append(sw)
-            sw.start()
-
-        for worker in sort_workers:
-            worker.join()
-
-        self.callback.log("Sorting package files by size")
-        sorted_packages = sorted(pkgfiles_withsize_proxy, key=lambda package: package[1], reverse=True)
-
-        def worker_entry(work_queue, log_queue, read_pkgs_proxy, repo_obj, callback_wrap, active_work_size, completion_event, pkgpath, reldir):
-            # We are now a new process - replace the callback with the wrapper that pushes log messages
-            # to a queue for processing in the main process
-            repo_obj.callback = callback_wrap
-            while True:
-                try:
-                    pkg = None
-                    pkg = work_queue.get()
-                    if not pkg:
-                        # The manager feeds each worker a None to indicate we are finished
-                        # this allows us to use a blocking get without fear - I think
-                        break
-                    po = repo_obj.read_in_package(pkg[0], pkgpath=pkgpath, reldir=reldir)
-                    repo_obj._do_delta_rpm_package(po)
-                except Exception, e:
-                    callback_wrap.errorlog(e)
-                    continue
-                finally:
-                    if pkg:
-                        with active_work_size.get_lock():
-                            active_work_size.value -= pkg[1]
-                            completion_event.set()
-                        read_pkgs_proxy.append(pkg)
-
-        def manager_entry(packages, active_work_size, log_queue, completion_event, work_queue, callback_wrap, read_pkgs_proxy, repo_obj, pkgpath, reldir):
-            max_work_size = repo_obj.conf.max_concurrent_delta_rpm_size
-            num_workers = repo_obj.conf.delta_workers
-            workers = [ ]
-            callback_wrap.log("Starting %d workers to process deltarpms - max total work size (%d) bytes" % (num_workers, max_work_size))
-            for i in range(0,repo_obj.conf.delta_workers):
-                wp = multiprocessing.Process(target = worker_entry, args = (work_queue, log_queue, read_pkgs_proxy, repo_obj, callback_wrap, active_work_size, completion_event, pkgpath, reldir))
-                workers.append(wp)
-                wp.start()
-
-            pending_packages = 0
-            while len(packages) > 0:
-                # Look through the package list and add things that fit under the max size limit
-                # until we reach the end of the list
-
-                # Don't read shared state for every package - it is an expensive operation
-                work_size_snap = active_work_size.value
-                #log_queue.put("Entered main loop with package list of length %d and size snap %d" % (len(packages), work_size_snap))
-                consumed = [ ]
-                for i in range(0,len(packages)):
-                    package = packages[i]
-                    if package[1] + work_size_snap < max_work_size:
-                        with active_work_size.get_lock():
-                            # As long as we have the lock we may as well refresh our view of the actual size
-                            active_work_size.value += package[1]
-                            #Turn on profiling if you want to convince yourself that this really does keep the size sane
-                            if self.conf.profile:
-                                callback_wrap.log("Adding package (%s) of size %d to deltarpm work queue" % (package[0], package[1]))
-                                callback_wrap.log("Current TOTAL in-flight work size: %d" % (active_work_size.value))
-                                callback_wrap.log("Packages remaining to process: %d" % (len(packages)-len(consumed)-1))
-                            work_size_snap = active_work_size.value
-                            # Note that we block here if the queue is full
-                            pending_packages = work_queue.qsize() + 1
-                            consumed.append(i)
-                        # This can block - do it without the lock
-                        work_queue.put(package)
-                # Now prune the added items from the list, going backwards to ensure that we don't
-                # shift the index and delete the wrong thing
-                for i in reversed(consumed):
-                    del packages[i]
-                if len(packages) == 0:
-                    break
-
-                with active_work_size.get_lock():
-                    work_queue_size = work_queue.qsize()
-                    if pending_packages > work_queue_size:
-                        # Some work was started since we last touched the queue - try to add more
-                        # Note that this guarantees there is at least one free slot in the work_queue
-                        # This should also prevent us from constantly spinning in the package loop when
-                        # we have space in the queue but not enough active_work_size to allow us to add any
-                        # available package
-                        pending_packages = work_queue_size
-                        continue
-                    else:
-                        completion_event.clear()
-
-                # We either have too many items on the work_queue or too much total work size
-                # Wait for a worker to finish and then try again
-                completion_event.wait()
-
-            # We are done - tell the workers to stop
-            for worker in workers:
-                work_queue.put(None)
-
-            for worker in workers:
-                worker.join()
-
-            # Now signal to the main thread that we are done adding work
-            log_queue.put(None)
-
-        manager = multiprocessing.Process(target = manager_entry, args = (sorted_packages, active_work_size, log_queue, completion_event, work_queue, callback_wrap, read_pkgs_proxy, self, pkgpath, reldir))
-        manager.start()
-
-        def log_digest(callback, log_message):
-            if log_message[0] == "errorlog":
-                callback.errorlog("Worker PID(%d) - %s" % (log_message[1], log_message[2]))
-            elif log_message[0] == "log":
-                callback.log("Worker PID(%d) - %s" % (log_message[1], log_message[2]))
+    def _write_package(self, pkg, xml, info):
+        """write out the primary, filelists and other xml of pkg, noting
+           where they went in the manifest. The xml may be iterables of
+           chunks. info is yumbased.manifest_info()"""
+        offsets = []
+        for out, buf in zip((self.primaryfile, self.flfile, self.otherfile),
+                            xml):
+            start = out.tell()
+            if isinstance(buf, basestring):
+                out.write(buf)
             else:
-                callback.errorlog("Malformed error in queue (%s)" % (str(log_message)))
-
-        # Process log messages until we get the finished signal "None"
-        while True:
-            log_message = log_queue.get()
-            if log_message is None:
-                break
-            log_digest(self.callback, log_message)
+                for chunk in buf:
+                    out.write(chunk)
+            offsets.extend((start, out.tell() - start))
+        if self._manifest is None or not isinstance(pkg, basestring):
+            return
+        if pkg.find('://') != -1:
+            # as --update looks it up
+            pkg = os.path.basename(pkg)
+        self._manifest.append((pkg,) + tuple(info) + (tuple(offsets),))
+
+    def _write_manifest(self):
+        """write the manifest of the packages just written out, see
+           readMetadata"""
+        header = {'sumtype': self.conf.sumtype,
+                  'baseurl': self.conf.baseurl,
+                  'changelog_limit': self.conf.changelog_limit,
+                  'collapse_libc_requires': self.conf.collapse_glibc_requires,
+                  'journal': self._journal_state}
+        for ftype in ('primary', 'filelists', 'other'):
+            sums = self._written_checksums(ftype)
+            if sums is None:
+                # it couldn't be checked against the repomd.xml
+                return
+            header[ftype] = sums[1]
+        fn = os.path.join(self.conf.outputdir, self.conf.tempdir,
+                          readMetadata.MANIFEST_FILE)
+        readMetadata.write_manifest(fn, header, self._manifest)
+
+    def _start_worker_pool(self, reldir, num_pkgs=None):
+        """start the workers reading packages from reldir, for num_pkgs
+           packages if it's known"""
+        #  setting this in the base object so we can clean it up later. The
+        # workers spool all the (uncompressed) xml there, far too much for a
+        # /tmp which is often in memory, so it goes next to the tempdir
+        self._worker_tmp_path = tempfile.mkdtemp(prefix=WORKER_DIR_PREFIX,
+                                                 dir=self.conf.outputdir)
+        if self.conf.workers < 1:
+            self.conf.workers = num_cpus_online()
+            if num_pkgs is not None:
+                self.conf.workers = min(self.conf.workers, num_pkgs)
+        sqlite_direct = self._use_sqlite_direct()
+
+        if self.conf.worker_pool == 'fork':
+            # the same as the --pkgoptions and --globalopts below
+            external_data = {'_reldir': reldir,
+                '_collapse_libc_requires': self.conf.collapse_glibc_requires,
+                '_cachedir': self.conf.cachedir,
+                '_baseurl': self.conf.baseurl,
+                '_packagenumber': 1}
+            fork_opts = {'reldir': reldir,
+                         'external_data': external_data,
+                         'clog_limit': self.conf.changelog_limit,
+                         'sumtype': self.conf.sumtype,
+                         'cache_run': self._cache_run,
+                         'sqlite': sqlite_direct,
+                         'shard_dir': self._worker_tmp_path}
+            return ForkWorkerPool(self.conf.workers, self.callback,
+                                  fork_opts, quiet=self.conf.quiet)
+
+        base_worker_cmdline = [self.conf.worker_cmd, 
+                '--pkgoptions=_reldir=%s' % reldir,
+                '--pkgoptions=_collapse_libc_requires=%s' % self.conf.collapse_glibc_requires, 
+                '--pkgoptions=_cachedir=%s' % self.conf.cachedir,
+                '--pkgoptions=_baseurl=%s' % self.conf.baseurl,
+                '--globalopts=clog_limit=%s' % self.conf.changelog_limit,
+                '--globalopts=sumtype=%s' % self.conf.sumtype,
+                '--globalopts=cache_run=%r' % self._cache_run, ]
+        
+        if self.conf.quiet:
+            base_worker_cmdline.append('--quiet')
+        
+        if self.conf.verbose:
+            base_worker_cmdline.append('--verbose')
 
-        # now empty our proxy list
-        for pkg in read_pkgs_proxy:
-            self.read_pkgs.append(pkg)
+        if sqlite_direct:
+            base_worker_cmdline.append('--sqlite')
 
-        # TODO: we may be able to explicitly stop the Manager at this point
+        return WorkerPool(base_worker_cmdline, self.conf.workers,
+                          self.callback, quiet=self.conf.quiet,
+                          shard_dir=self._worker_tmp_path)
 
+    def _close_checksum_cache(self):
+        """write out our checksum cache entries, trim the cache and report on
+           it if asked to"""
+        if not self.conf.cachedir:
+            return
+        csum_cache = cache.get_checksum_cache(self.conf.cachedir,
+                                              self.conf.sumtype, self._cache_run)
+        csum_cache.flush()
+        evicted = 0
+        try:
+            if self.conf.cache_max_entries:
+                evicted = csum_cache.evict(self.conf.cache_max_entries)
+            if self.conf.cache_stats:
+                (entries, hits, misses) = csum_cache.stats()
+                self.callback.log(_('Checksum cache: %d entries, %d hits, '
+                                    '%d misses, %d evicted') % (entries, hits,
+                                                              misses, evicted))
+        except sqlite.Error, e:
+            self.callback.errorlog(_('Could not update checksum cache %s: %s')
+                                   % (csum_cache.path, e))
 
     def closeMetadataDocs(self):
+        self._close_checksum_cache()
+
         # save them up to the tmp locations:
         if not self.conf.quiet:
             self.callback.log(_('Saving Primary metadata'))
@@ -941,7 +1062,8 @@ class MetaDataGenerator:
             self.md_sqlite.pri_cx.close()
         else:
             self.primaryfile.write('\n</metadata>')
-            self.primaryfile.close()
+            with self.timings.stage('compression'):
+                self.primaryfile.close()
 
         if not self.conf.quiet:
             self.callback.log(_('Saving file lists metadata'))
@@ -949,7 +1071,8 @@ class MetaDataGenerator:
             self.md_sqlite.file_cx.close()
         else:
             self.flfile.write('\n</filelists>')
-            self.flfile.close()
+            with self.timings.stage('compression'):
+                self.flfile.close()
 
         if not self.conf.quiet:
             self.callback.log(_('Saving other metadata'))
@@ -957,7 +1080,11 @@ class MetaDataGenerator:
             self.md_sqlite.other_cx.close()
         else:
             self.otherfile.write('\n</otherdata>')
-            self.otherfile.close()
+            with self.timings.stage('compression'):
+                self.otherfile.close()
+
+        if self._manifest is not None:
+            self._write_manifest()
 
         if self.conf.deltas:
             deltam_st = time.time()
@@ -966,14 +1093,36 @@ class MetaDataGenerator:
             self.deltafile.write(self.generate_delta_xml())
             self.deltafile.write('\n</prestodelta>')
             self.deltafile.close()
+            self.timings.add('deltas', time.time() - deltam_st)
             if self.conf.profile:
                 self.callback.log('deltam time: %0.3f' % (time.time() - deltam_st))
 
-    def _do_delta_rpm_package(self, pkg):
-        """makes the drpms, if possible, for this package object.
-           returns the presto/delta xml metadata as a string
+    def _delta_pool(self):
+        return deltarpms.DeltaPool(self.conf.delta_workers,
+                                   self.conf.max_concurrent_delta_rpm_size,
+                                   self.callback,
+                                   timeout=self.conf.delta_timeout,
+                                   verbose=not self.conf.quiet or
+                                           self.conf.profile)
+
+    def _make_deltas(self, pkgs):
+        """make the drpms of the new packages pkgs, all of them sharing the
+           one pool of makedeltarpm processes"""
+        pool = self._delta_pool()
+        if self.conf.profile:
+            self.callback.log('Starting %d workers to process deltarpms - '
+                              'max total memory %d bytes' % (
+                              self.conf.delta_workers,
+                              self.conf.max_concurrent_delta_rpm_size))
+        for pkg in pkgs:
+            self._do_delta_rpm_package(pkg, pool)
+        with self.timings.stage('deltas'):
+            pool.run()
+
+    def _do_delta_rpm_package(self, pkg, pool=None):
+        """queue up the drpms, if possible, for this package object in
+           pool, or make them right away if there's no pool
         """
-        drpm_pkg_time = time.time()
         # duck and cover if the pkg.size is > whatever
         if int(pkg.size) > self.conf.max_delta_rpm_size:
             if not self.conf.quiet:
@@ -981,47 +1130,27 @@ class MetaDataGenerator:
                                     "that is > max_delta_rpm_size"  % pkg)
             return
 
-        # generate a list of all the potential 'old rpms'
-        opd = self._get_old_package_dict()
-        # for each of our old_package_paths -
-        # make a drpm from the newest of that pkg
-        # get list of potential candidates which are likely to match
+        run = pool is None
+        if run:
+            pool = self._delta_pool()
+        # the old versions of this package, newest first
+        index = self._get_old_package_index()
         for d in self.conf.oldpackage_paths:
-            pot_cand = []
-            if d not in opd:
-                continue
-            for fn in opd[d]:
-                if os.path.basename(fn).startswith(pkg.name):
-                    pot_cand.append(fn)
-
-            candidates = []
-            for fn in pot_cand:
-                try:
-                    thispo = yumbased.CreateRepoPackage(self.ts, fn,
-                                                     sumtype=self.conf.sumtype)
-                except Errors.MiscError, e:
-                    continue
-                if (thispo.name, thispo.arch) != (pkg.name, pkg.arch):
-                    # not the same, doesn't matter
-                    continue
-                if thispo == pkg: #exactly the same, doesn't matter
-                    continue
-                if thispo.EVR >= pkg.EVR: # greater or equal, doesn't matter
+            made = 0
+            for (epoch, ver, rel, fn, size) in index.get(d, {}).get(
+                                                  (pkg.name, pkg.arch), ()):
+                if made >= self.conf.num_deltas:
+                    break
+                if compareEVR((epoch, ver, rel),
+                              (pkg.epoch, pkg.ver, pkg.rel)) >= 0:
+                    # greater or equal, doesn't matter
                     continue
-                candidates.append(thispo)
-                candidates.sort()
-                candidates.reverse()
-
-            for delta_p in candidates[0:self.conf.num_deltas]:
-                #make drpm of pkg and delta_p
-                dt_st = time.time()
-                drpmfn = deltarpms.create_drpm(delta_p, pkg, self.conf.deltadir)
-                if not self.conf.quiet or self.conf.profile:
-                    self.callback.log('created drpm from %s to %s: %s in %0.3f' % (
-                        delta_p, pkg, drpmfn, (time.time() - dt_st)))
-        if self.conf.profile:
-            self.callback.log('total drpm time for %s: %0.3f' % (pkg,
-                                                 (time.time() - drpm_pkg_time)))
+                delta_p = deltarpms.DeltaPackage(fn, (pkg.name, pkg.arch,
+                                                 epoch, ver, rel), size)
+                made += 1
+                pool.add(delta_p, pkg, self.conf.deltadir)
+        if run:
+            pool.run()
 
     def _get_old_package_dict(self):
         if hasattr(self, '_old_package_dict'):
@@ -1042,6 +1171,64 @@ class MetaDataGenerator:
 
         return self._old_package_dict
 
+    def _get_old_package_index(self):
+        """return {old package dir: {(name, arch): [(epoch, version, release,
+           path, size), ...]}} of the packages to make deltas against, newest
+           first. Their headers are read once, and kept in the cachedir"""
+        if hasattr(self, '_old_package_index'):
+            return self._old_package_index
+
+        old_cache = None
+        if self.conf.cachedir:
+            old_cache = cache.OldPackageCache(self.conf.cachedir)
+        def newest_first(pkg1, pkg2):
+            return compareEVR(pkg2[:3], pkg1[:3])
+
+        self._old_package_index = {}
+        for (d, paths) in self._get_old_package_dict().items():
+            pkgs = {}
+            for fn in paths:
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                nevra = None
+                if old_cache is not None:
+                    nevra = old_cache.get(fn, st)
+                if nevra is None:
+                    try:
+                        po = yumbased.CreateRepoPackage(self.ts, fn,
+                                                    sumtype=self.conf.sumtype,
+                                                    header_only=True)
+                    except Errors.MiscError, e:
+                        continue
+                    nevra = (po.name, po.arch, po.epoch, po.ver, po.rel)
+                    if old_cache is not None:
+                        old_cache.put(fn, st, nevra)
+                (name, arch, epoch, ver, rel) = nevra
+                pkgs.setdefault((name, arch), []).append((epoch, ver, rel, fn,
+                                                          st.st_size))
+            for versions in pkgs.values():
+                versions.sort(newest_first)
+            self._old_package_index[d] = pkgs
+
+        if old_cache is not None:
+            old_cache.flush(self.conf.oldpackage_paths)
+        return self._old_package_index
+
+    def _read_drpm(self, drpm_fn):
+        """read drpm_fn in the deltadir, returns (the pkgtup of the package
+           it makes, its DeltaRPMPackage.catalog_info())"""
+        drpm_rel_fn = os.path.normpath(self.conf.delta_relative +
+                                       '/' + drpm_fn) # this is annoying
+        drpm_po = yumbased.CreateRepoPackage(self.ts,
+             self.conf.deltadir + '/' + drpm_fn, sumtype=self.conf.sumtype,
+             header_only=True)
+
+        drpm = deltarpms.DeltaRPMPackage(drpm_po, self.conf.outputdir,
+                                         drpm_rel_fn)
+        return (tuple(drpm_po.pkgtup), drpm.catalog_info())
+
     def generate_delta_xml(self):
         """take the delta rpm output dir, process all the drpm files
            produce the text output for the presto/delta xml metadata"""
@@ -1050,22 +1237,48 @@ class MetaDataGenerator:
         # appending the output. for each of the keys in the dict, return
         # the tag for the target + each of the drpm infos + closure for the target
         # tag
-        results = []
-        if self.conf.delta_workers == 1:
-            targets = {}
-            for drpm_fn in self.getFileList(self.conf.deltadir, '.drpm'):
-                drpm_rel_fn = os.path.normpath(self.conf.delta_relative +
-                                               '/' + drpm_fn) # this is annoying
-                drpm_po = yumbased.CreateRepoPackage(self.ts,
-                     self.conf.deltadir + '/' + drpm_fn, sumtype=self.conf.sumtype)
-
-                drpm = deltarpms.DeltaRPMPackage(drpm_po, self.conf.outputdir,
-                                                 drpm_rel_fn)
-                if not targets.has_key(drpm_po.pkgtup):
-                    targets[drpm_po.pkgtup] = []
-                targets[drpm_po.pkgtup].append(drpm.xml_dump_metadata())
+        # only the drpms which aren't in the catalog from before get read
+        catalog = None
+        if self.conf.cachedir:
+            catalog = cache.DrpmCatalog(self.conf.cachedir)
+        deltadir = os.path.abspath(self.conf.deltadir)
+        drpm_fns = self.getFileList(self.conf.deltadir, '.drpm')
+        drpms = {}
+        unread = {}
+        for drpm_fn in drpm_fns:
+            st = None
+            if catalog is not None:
+                st = os.stat(os.path.join(deltadir, drpm_fn))
+                entry = catalog.get(os.path.join(deltadir, drpm_fn), st)
+                if entry is not None:
+                    drpms[drpm_fn] = (entry[:5], entry[5:])
+                    continue
+            unread[drpm_fn] = st
+
+        if self.conf.delta_workers == 1 or len(unread) < 2:
+            for drpm_fn in unread:
+                drpms[drpm_fn] = self._read_drpm(drpm_fn)
         else:
-            targets = self._parallel_generate_delta_xml()
+            drpms.update(self._parallel_read_drpms(unread.keys()))
+        if catalog is not None:
+            for (drpm_fn, st) in unread.items():
+                if drpm_fn in drpms:
+                    (pkgtup, info) = drpms[drpm_fn]
+                    catalog.put(os.path.join(deltadir, drpm_fn), st,
+                                pkgtup + info)
+            catalog.flush([deltadir])
+
+        results = []
+        targets = {}
+        for drpm_fn in drpm_fns:
+            if drpm_fn not in drpms:
+                continue
+            (pkgtup, info) = drpms[drpm_fn]
+            drpm_rel_fn = os.path.normpath(self.conf.delta_relative +
+                                           '/' + drpm_fn)
+            drpm = deltarpms.DeltaRPMPackage(None, self.conf.outputdir,
+                                             drpm_rel_fn, info)
+            targets.setdefault(pkgtup, []).append(drpm.xml_dump_metadata())
 
         for (n, a, e, v, r) in targets.keys():
             results.append("""  <newpackage name="%s" epoch="%s" version="%s" release="%s" arch="%s">\n""" % (
@@ -1078,51 +1291,30 @@ class MetaDataGenerator:
 
         return ' '.join(results)
 
-    def _parallel_generate_delta_xml(self):
-        drpm_fns = [ ]
-        for drpm_fn in self.getFileList(self.conf.deltadir, '.drpm'):
-            drpm_fns.append(drpm_fn)
-
-        manager = multiprocessing.Manager()
-        drpm_fns_proxy = manager.list(drpm_fns)
-        targets_proxy = manager.dict()
-        targets_lock = manager.RLock()
-
-        def drpm_xml_entry(drpm_fns_proxy, targets_proxy, targets_lock, repo_obj):
-            while True:
-                try:
-                    drpm_fn = drpm_fns_proxy.pop()
-                    drpm_rel_fn = os.path.normpath(repo_obj.conf.delta_relative +
-                                                   '/' + drpm_fn) # this is annoying
-                    drpm_po = yumbased.CreateRepoPackage(repo_obj.ts,
-                         repo_obj.conf.deltadir + '/' + drpm_fn, sumtype=repo_obj.conf.sumtype)
-
-                    drpm = deltarpms.DeltaRPMPackage(drpm_po, repo_obj.conf.outputdir,
-                                                     drpm_rel_fn)
-
-                    with targets_lock:
-                        d_element = targets_proxy.get(drpm_po.pkgtup, [ ])
-                        d_element.append(drpm.xml_dump_metadata())
-                        # managed dict requires that we re-assign modified list rather than modify in place
-                        targets_proxy[drpm_po.pkgtup] = d_element
-                except IndexError:
-                    break
-
-        xml_workers = [ ]
-        for i in range(0,self.conf.delta_workers):
-            xw = multiprocessing.Process(target = drpm_xml_entry, args = (drpm_fns_proxy, targets_proxy, targets_lock, self))
-            xml_workers.append(xw)
-            xw.start()
-
-        for worker in xml_workers:
-            worker.join()
-
-        # I'm doing a copy in this way as I believe that prevents references to the manager from lingering
-        # TODO: Verify?
-        targets_copy = { }
-        for key in targets_proxy.keys():
-            targets_copy[key] = targets_proxy[key]
-        return targets_copy
+    def _parallel_read_drpms(self, drpm_fns):
+        """_read_drpm() the drpm_fns in delta_workers processes, returns
+           {drpm_fn: what _read_drpm() returned}"""
+        # batches small enough to keep all the workers busy to the end, big
+        # enough that passing them about costs next to nothing
+        workers = self.conf.delta_workers
+        size = max(1, min(64, len(drpm_fns) // (workers * 4)))
+        batches = [drpm_fns[i:i + size]
+                   for i in range(0, len(drpm_fns), size)]
+        pool = multiprocessing.Pool(workers, _init_drpm_reader, (self,))
+        drpms = {}
+        try:
+            for results in pool.imap_unordered(_read_drpm_batch, batches):
+                for (drpm_fn, drpm, error) in results:
+                    if error is not None:
+                        self.callback.errorlog(_('Error reading drpm %s: %s')
+                                               % (drpm_fn, error))
+                        continue
+                    drpms[drpm_fn] = drpm
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return drpms
 
     def _createRepoDataObject(self, mdfile, mdtype, compress=True, 
                               compress_type=None, attribs={}):
@@ -1140,27 +1332,25 @@ class MetaDataGenerator:
         if compress:
             sfile = '%s.%s' % (sfile, compress_type)
             outfn = os.path.join(outdir, sfile)
-            output = compressOpen(outfn, mode='wb', compress_type=compress_type)
-                
+            output = ChecksumCompressFile(outfn, compress_type,
+                                          self.conf.sumtype)
         else:
             outfn  = os.path.join(outdir, sfile)
-            output = open(outfn, 'w')
+            output = ChecksumWriter(open(outfn, 'w'), self.conf.sumtype)
 
         output.write(fo.read())
         output.close()
-        fo.seek(0)
-        open_csum = misc.checksum(self.conf.sumtype, fo)
         fo.close()
 
+        if compress:
+            open_csum = output.openchecksum
+            csum = output.checksum
+        else:
+            open_csum = csum = output.hexdigest()
 
         if self.conf.unique_md_filenames:
-            (csum, outfn) = checksum_and_rename(outfn, self.conf.sumtype)
+            (csum, outfn) = checksum_and_rename(outfn, self.conf.sumtype, csum)
             sfile = os.path.basename(outfn)
-        else:
-            if compress:
-                csum = misc.checksum(self.conf.sumtype, outfn)
-            else:
-                csum = open_csum
 
         thisdata = RepoData()
         thisdata.type = mdtype
@@ -1177,6 +1367,20 @@ class MetaDataGenerator:
         return thisdata
         
 
+    def _written_checksums(self, ftype):
+        """return (checksum, openchecksum, opensize) of the ftype metadata
+           file, as recorded while we wrote it, or None if we didn't"""
+        fo = {'primary': getattr(self, 'primaryfile', None),
+              'filelists': getattr(self, 'flfile', None),
+              'other': getattr(self, 'otherfile', None),
+              'prestodelta': getattr(self, 'deltafile', None)}.get(ftype)
+        fo = getattr(fo, 'fo', fo)
+        if not isinstance(fo, ChecksumCompressFile) or not fo.closed:
+            return None
+        if fo.sumtype != self.conf.sumtype:
+            return None
+        return (fo.checksum, fo.openchecksum, fo.opensize)
+
     def doRepoMetadata(self):
         """wrapper to generate the repomd.xml file that stores the info
            on the other files"""
@@ -1210,8 +1414,10 @@ class MetaDataGenerator:
                 dbversion = str(sqlitecachec.DBVERSION)
             except AttributeError:
                 dbversion = '9'
-            #FIXME - in theory some sort of try/except  here
-            rp = sqlitecachec.RepodataParserSqlite(repopath, repomd.repoid, None)
+            if not self._sqlite_direct:
+                #FIXME - in theory some sort of try/except  here
+                rp = sqlitecachec.RepodataParserSqlite(repopath, repomd.repoid,
+                                                       None)
 
         for (rpm_file, ftype) in workfiles:
             unpath = os.path.join(repopath, rpm_file)
@@ -1220,29 +1426,35 @@ class MetaDataGenerator:
                         not in _available_compression)):
                 rpm_file = rpm_file + '.' + self.conf.compress_type
             complete_path = os.path.join(repopath, rpm_file)
-            zfo = compressOpen(complete_path)
+            sums = self._written_checksums(ftype)
             dfo = None
             if (self.conf.compress_type == 'bz2' and self.conf.database and
+                    not self._sqlite_direct and
                     ftype in ('other', 'filelists', 'primary')):
                 # yum-metadata-parser doesn't understand bz2 so let's write the
                 # decompressed data to a file and pass that via gen_func
                 # instead of the compressed version
                 dfo = open(unpath, 'w')
-            # This is misc.checksum() done locally so we can get the size too.
-            data = misc.Checksums([sumtype])
-            while True:
-                chunk = data.read(zfo, 2**16)
-                if not chunk:
-                    break
+            if sums is None or dfo is not None:
+                zfo = compressOpen(complete_path)
+                # This is misc.checksum() done locally so we can get the size too.
+                data = misc.Checksums([sumtype])
+                while True:
+                    chunk = data.read(zfo, 2**16)
+                    if not chunk:
+                        break
+                    if dfo is not None:
+                        dfo.write(chunk)
+                uncsum = data.hexdigest(sumtype)
+                unsize = len(data)
+                zfo.close()
                 if dfo is not None:
-                    dfo.write(chunk)
-            uncsum = data.hexdigest(sumtype)
-            unsize = len(data)
-            zfo.close()
-            if dfo is not None:
-                dfo.close()
-
-            csum = misc.checksum(sumtype, complete_path)
+                    dfo.close()
+
+            if sums is None:
+                csum = misc.checksum(sumtype, complete_path)
+            else:
+                (csum, uncsum, unsize) = sums
             timestamp = os.stat(complete_path)[8]
 
             db_csums = {}
@@ -1254,8 +1466,12 @@ class MetaDataGenerator:
                         self.callback.log("Starting %s db creation: %s" % (ftype,
                                                                   time.ctime()))
 
+                sqlite_st = time.time()
                 gen_func = None
-                if ftype == 'primary':
+                if self._sqlite_direct:
+                    if ftype in ['primary', 'filelists', 'other']:
+                        self.md_sqlite.finish(ftype, csum)
+                elif ftype == 'primary':
                     gen_func = rp.getPrimary
                 elif ftype == 'filelists':
                     gen_func = rp.getFilelists
@@ -1270,6 +1486,7 @@ class MetaDataGenerator:
                         #FIXME and here
                         gen_func(unpath, uncsum)
                         os.unlink(unpath)
+                self.timings.add('sqlite', time.time() - sqlite_st)
 
                 if ftype in ['primary', 'filelists', 'other']:
                     if dfo is None:
@@ -1286,18 +1503,19 @@ class MetaDataGenerator:
                     if self.compat_compress:
                         compress_type = 'bz2'
                         
-                    # rename from silly name to not silly name
-                    os.rename(tmp_result_path, resultpath)
+                    if not self._sqlite_direct:
+                        # rename from silly name to not silly name
+                        os.rename(tmp_result_path, resultpath)
                     compressed_name = '%s.%s' % (good_name, compress_type)
                     result_compressed = os.path.join(repopath, compressed_name)
-                    db_csums[ftype] = misc.checksum(sumtype, resultpath)
-
-                    # compress the files
 
-                    compressFile(resultpath, result_compressed, compress_type)
-                    # csum the compressed file
-                    db_compressed_sums[ftype] = misc.checksum(sumtype,
-                                                             result_compressed)
+                    # compress the files, checksumming both sides on the way
+                    with self.timings.stage('compression'):
+                        dbfo = checksumCompressFile(resultpath,
+                                                    result_compressed,
+                                                    compress_type, sumtype)
+                    db_csums[ftype] = dbfo.openchecksum
+                    db_compressed_sums[ftype] = dbfo.checksum
                     # timestamp+size the uncompressed file
                     un_stat = os.stat(resultpath)
                     # remove the uncompressed file
@@ -1385,6 +1603,9 @@ class MetaDataGenerator:
             fo = open(repofilepath, 'w')
             fo.write(repomd.dump_xml())
             fo.close()
+            self.timings.count('bytes_written', os.path.getsize(repofilepath))
+            for data in repomd.repoData.values():
+                self.timings.count('bytes_written', int(data.size))
         except (IOError, OSError, TypeError), e:
             self.callback.errorlog(
                   _('Error saving temp file for repomd.xml: %s') % repofilepath)
@@ -1432,6 +1653,15 @@ class MetaDataGenerator:
                     raise MDError, _(
                     'Could not remove old metadata file: %s: %s') % (oldfile, e)
 
+        # the old manifest only goes with the old metadata
+        oldfile = os.path.join(output_old_dir, readMetadata.MANIFEST_FILE)
+        if os.path.exists(oldfile):
+            try:
+                os.remove(oldfile)
+            except OSError, e:
+                raise MDError, _(
+                'Could not remove old metadata file: %s: %s') % (oldfile, e)
+
         old_to_remove = []
         old_pr = []
         old_fl = []
@@ -1528,7 +1758,7 @@ class MetaDataGenerator:
                     self.errorlog(_('Error was %s') % e)
                     self.errorlog(_('Please clean up this directory manually.'))
         # our worker tmp path
-        if hasattr(self, '_worker_tmp_path') and os.path.exists(self._worker_tmp_path):
+        if getattr(self, '_worker_tmp_path', None) and os.path.exists(self._worker_tmp_path):
             shutil.rmtree(self._worker_tmp_path, ignore_errors=True)
         
     def setup_sqlite_dbs(self, initdb=True):
@@ -1611,12 +1841,36 @@ class SplitMetaDataGenerator(MetaDataGenerator):
 
 
 class MetaDataSqlite(object):
-    def __init__(self, destdir):
+    # packages queued up by add_package() before their rows are inserted
+    batch_size = 1000
+
+    # the delete triggers patch() relies on
+    triggers = {'primary': 'removals',
+                'filelists': 'remove_filelist',
+                'other': 'remove_changelogs'}
+
+    def __init__(self, destdir, old_dbs=None):
+        """old_dbs are the compressed primary, filelists and other dbs, by
+           type, to patch rather than starting from empty ones"""
         self.pri_sqlite_file = os.path.join(destdir, 'primary.sqlite')
-        self.pri_cx = sqlite.Connection(self.pri_sqlite_file)
         self.file_sqlite_file = os.path.join(destdir, 'filelists.sqlite')
-        self.file_cx = sqlite.Connection(self.file_sqlite_file)
         self.other_sqlite_file = os.path.join(destdir, 'other.sqlite')
+        if old_dbs:
+            for (db, fn) in ((self.pri_sqlite_file, old_dbs['primary']),
+                             (self.file_sqlite_file, old_dbs['filelists']),
+                             (self.other_sqlite_file, old_dbs['other'])):
+                src = compressOpen(fn)
+                try:
+                    dst = open(db, 'wb')
+                    try:
+                        shutil.copyfileobj(src, dst, 2**20)
+                    finally:
+                        dst.close()
+                finally:
+                    src.close()
+
+        self.pri_cx = sqlite.Connection(self.pri_sqlite_file)
+        self.file_cx = sqlite.Connection(self.file_sqlite_file)
         self.other_cx = sqlite.Connection(self.other_sqlite_file)
         self.primary_cursor = self.pri_cx.cursor()
 
@@ -1624,9 +1878,103 @@ class MetaDataSqlite(object):
 
         self.other_cursor = self.other_cx.cursor()
 
-        self.create_primary_db()
-        self.create_filelists_db()
-        self.create_other_db()
+        self.pkgKey = 0
+        self.patched = bool(old_dbs)
+        if self.patched:
+            self.open_old_dbs()
+        else:
+            self.create_primary_db()
+            self.create_filelists_db()
+            self.create_other_db()
+
+        self._batch = {}
+        self._batched = 0
+        # (pkgId, location_href) of the packages kept from the old dbs
+        self._kept = set()
+
+    def open_old_dbs(self):
+        """check the copied old dbs can be patched, and carry on numbering
+           the packages after the ones in them"""
+        for (db, cur) in (('primary', self.primary_cursor),
+                          ('filelists', self.filelists_cursor),
+                          ('other', self.other_cursor)):
+            executeSQL(cur, 'PRAGMA synchronous="OFF"')
+            executeSQL(cur, 'pragma locking_mode="EXCLUSIVE"')
+            executeSQL(cur, "SELECT dbversion FROM db_info")
+            row = cur.fetchone()
+            if row is None or str(row[0]) != str(sqlitecachec.DBVERSION):
+                raise MDError, _('old %s db is not version %s') % (db,
+                                                      sqlitecachec.DBVERSION)
+            executeSQL(cur, "SELECT name FROM sqlite_master WHERE "
+                            "type = 'trigger' AND name = ?",
+                       (self.triggers[db],))
+            if cur.fetchone() is None:
+                raise MDError, _('old %s db has no %s trigger') % (db,
+                                                      self.triggers[db])
+            executeSQL(cur, "SELECT MAX(pkgKey) FROM packages")
+            self.pkgKey = max(self.pkgKey, cur.fetchone()[0] or 0)
+        # everything up to here came from the old dbs
+        self._old_pkgKey = self.pkgKey
+
+    def keep_package(self, pkgId, href):
+        """keep the package from the old dbs, patch() removes the others"""
+        self._kept.add((pkgId, yumbased._sqlite_text(href)))
+
+    def patch(self, db):
+        """remove the packages of the old db which weren't kept, the
+           triggers take their other rows with them"""
+        if db == 'primary':
+            cur = self.primary_cursor
+            executeSQL(cur, "SELECT pkgKey, pkgId, location_href FROM packages "
+                            "WHERE pkgKey <= ?", (self._old_pkgKey,))
+            gone = [(pkgKey,) for (pkgKey, pkgId, href) in cur.fetchall()
+                    if (pkgId, href) not in self._kept]
+        else:
+            cur = {'filelists': self.filelists_cursor,
+                   'other': self.other_cursor}[db]
+            kept = set([pkgId for (pkgId, href) in self._kept])
+            executeSQL(cur, "SELECT pkgKey, pkgId FROM packages "
+                            "WHERE pkgKey <= ?", (self._old_pkgKey,))
+            gone = [(pkgKey,) for (pkgKey, pkgId) in cur.fetchall()
+                    if pkgId not in kept]
+        cur.executemany("DELETE FROM packages WHERE pkgKey = ?", gone)
+        return len(gone)
+
+    def add_package(self, pkgId, rows):
+        """add a package, with the rows from yumbased.sqlite_rows(), under
+           the next pkgKey. The rows are inserted batch_size packages at a
+           time, all in one transaction per db until finish()"""
+        self.pkgKey += 1
+        yumbased.add_sqlite_rows(self._batch, self.pkgKey, pkgId, rows)
+        self._batched += 1
+        if self._batched >= self.batch_size:
+            self.flush()
+        return self.pkgKey
+
+    def flush(self):
+        """insert the queued rows"""
+        cursors = {'primary': self.primary_cursor,
+                   'filelists': self.filelists_cursor,
+                   'other': self.other_cursor}
+        yumbased.insert_sqlite_rows(cursors, self._batch)
+        self._batch = {}
+        self._batched = 0
+
+    def finish(self, db, checksum):
+        """commit and close db ('primary', 'filelists' or 'other'), recording
+           checksum as that of the xml it goes with, like yum-metadata-parser"""
+        self.flush()
+        (cx, cur) = {'primary': (self.pri_cx, self.primary_cursor),
+                     'filelists': (self.file_cx, self.filelists_cursor),
+                     'other': (self.other_cx, self.other_cursor)}[db]
+        if self.patched:
+            self.patch(db)
+        cur.execute("UPDATE db_info SET checksum = ?", (checksum,))
+        cx.commit()
+        if self.patched:
+            # give back the space of what was removed
+            cur.execute("VACUUM")
+        cx.close()
 
     def create_primary_db(self):
         # make the tables
@@ -0,0 +1,309 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# the --cachedir checksum cache, one sqlite file shared by every process
+# (and every createrepo run, mash does this) using the cachedir. And next to
+# it the index of the --oldpackagedirs packages and the catalog of the drpms
+# made from them, for --deltas
+
+import os
+def _get_umask():
+    oumask = os.umask(0)
+    os.umask(oumask)
+    return oumask
+_b4rpm_oumask = _get_umask()
+import time
+import atexit
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    import sqlite
+
+
+class ChecksumCache(object):
+    """Package checksums keyed by the stat identity of the file (device,
+       inode, size, mtime) and a key made from its header and signatures.
+       All entries for our checksum type are loaded up front; new ones are
+       kept in memory and written out in one transaction by flush(), which
+       also marks the ones we used so the least recently used can be evicted.
+    """
+
+    filename = 'checksums.sqlite'
+    # how long to wait for another process writing to the cache
+    timeout = 300
+
+    def __init__(self, cachedir, sumtype, run_id=None):
+        self.path = os.path.join(cachedir, self.filename)
+        self.sumtype = sumtype
+        if run_id is None:
+            run_id = time.time()
+        self.run_id = float(run_id)
+        self._checksums = {}
+        self._new = {}
+        self._used = set()
+
+        created = not os.path.exists(self.path)
+        try:
+            cx = self._connect()
+            try:
+                cur = cx.execute("""SELECT dev, ino, size, mtime, hdrkey,
+                                    checksum FROM checksums WHERE sumtype = ?""",
+                                 (self.sumtype,))
+                for row in cur:
+                    self._checksums[row[:5]] = row[5]
+            finally:
+                cx.close()
+        except sqlite.Error:
+            # can't read it, we'll just have to checksum everything
+            pass
+        if created and os.path.exists(self.path):
+            #  sqlite honours the umask, undo that so users can share the
+            # cache. BZ 833350.
+            try:
+                os.chmod(self.path, 0666 ^ _b4rpm_oumask)
+            except OSError:
+                pass
+
+    def _connect(self):
+        cx = sqlite.connect(self.path, timeout=self.timeout)
+        cx.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                      dev INTEGER, ino INTEGER, size INTEGER, mtime REAL,
+                      hdrkey TEXT, sumtype TEXT, checksum TEXT,
+                      created REAL, used REAL,
+                      PRIMARY KEY (dev, ino, size, mtime, hdrkey, sumtype))""")
+        cx.execute("""CREATE INDEX IF NOT EXISTS checksumsused
+                      ON checksums (used)""")
+        return cx
+
+    def _key(self, st, hdrkey):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, hdrkey)
+
+    def get(self, st, hdrkey):
+        """return the cached checksum for the file with stat result st and
+           header key hdrkey, or None"""
+        key = self._key(st, hdrkey)
+        checksum = self._checksums.get(key)
+        if checksum is not None:
+            self._used.add(key)
+        return checksum
+
+    def put(self, st, hdrkey, checksum):
+        key = self._key(st, hdrkey)
+        self._checksums[key] = checksum
+        self._new[key] = checksum
+
+    def flush(self):
+        """write out new checksums and mark the ones used. The cache is only
+           an optimisation: if the database can't be written to the entries
+           are just dropped"""
+        if not self._new and not self._used:
+            return
+        try:
+            cx = self._connect()
+            try:
+                cx.executemany("""INSERT OR REPLACE INTO checksums
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                               [key + (self.sumtype, checksum,
+                                       self.run_id, self.run_id)
+                                for (key, checksum) in self._new.items()])
+                cx.executemany("""UPDATE checksums SET used = ?
+                                  WHERE dev = ? AND ino = ? AND size = ?
+                                  AND mtime = ? AND hdrkey = ? AND sumtype = ?""",
+                               [(self.run_id,) + key + (self.sumtype,)
+                                for key in self._used])
+                cx.commit()
+            finally:
+                cx.close()
+        except sqlite.Error:
+            pass
+        self._new = {}
+        self._used = set()
+
+    def evict(self, max_entries):
+        """drop the least recently used entries so at most max_entries are
+           left, returns how many were dropped"""
+        cx = self._connect()
+        try:
+            (count,) = cx.execute("SELECT COUNT(*) FROM checksums").fetchone()
+            if count <= max_entries:
+                return 0
+            cx.execute("""DELETE FROM checksums WHERE rowid IN
+                          (SELECT rowid FROM checksums ORDER BY used LIMIT ?)""",
+                       (count - max_entries,))
+            cx.commit()
+            return count - max_entries
+        finally:
+            cx.close()
+
+    def stats(self):
+        """return (entries, hits, misses) for this run, counting every process
+           which used run_id"""
+        cx = self._connect()
+        try:
+            (entries, misses, hits) = cx.execute(
+                      """SELECT COUNT(*), TOTAL(created = ?),
+                                TOTAL(used = ? AND created < ?)
+                         FROM checksums""",
+                      (self.run_id, self.run_id, self.run_id)).fetchone()
+        finally:
+            cx.close()
+        return (entries, int(hits), int(misses))
+
+
+class _PathCache(object):
+    """A value for each file, keyed by its path and (some of) its stat()
+       result, kept in the table of a sqlite file in the cachedir. The
+       subclasses give the file, the table, the key_columns, named after
+       the fields of the stat result, and the value_columns. Like the
+       ChecksumCache it is all loaded up front, and what's new is written
+       out by flush(), which also drops the files which are gone.
+    """
+
+    filename = None
+    table = None
+    # (column, sqlite type)s
+    key_columns = ()
+    value_columns = ()
+    timeout = 300
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, self.filename)
+        self._entries = {}
+        self._new = {}
+        self._seen = set()
+        nkey = len(self.key_columns)
+
+        created = not os.path.exists(self.path)
+        try:
+            cx = self._connect()
+            try:
+                columns = ['path'] + [name for (name, sqltype)
+                                      in self.key_columns + self.value_columns]
+                cur = cx.execute("SELECT %s FROM %s" % (', '.join(columns),
+                                                        self.table))
+                for row in cur:
+                    self._entries[row[0]] = (tuple(row[1:nkey + 1]),
+                                             tuple(row[nkey + 1:]))
+            finally:
+                cx.close()
+        except sqlite.Error:
+            pass
+        if created and os.path.exists(self.path):
+            try:
+                os.chmod(self.path, 0666 ^ _b4rpm_oumask)
+            except OSError:
+                pass
+
+    def _connect(self):
+        cx = sqlite.connect(self.path, timeout=self.timeout)
+        # paths and names as the strs we look them up with
+        cx.text_factory = str
+        columns = ['path TEXT PRIMARY KEY'] + ['%s %s' % column for column
+                                  in self.key_columns + self.value_columns]
+        cx.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (self.table,
+                                                          ', '.join(columns)))
+        return cx
+
+    def _key(self, st):
+        return tuple([getattr(st, 'st_' + name)
+                      for (name, sqltype) in self.key_columns])
+
+    def get(self, path, st):
+        """return the value for the file at path with stat result st, or
+           None"""
+        self._seen.add(path)
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != self._key(st):
+            return None
+        return entry[1]
+
+    def put(self, path, st, value):
+        self._seen.add(path)
+        self._entries[path] = self._new[path] = (self._key(st), tuple(value))
+
+    def flush(self, dirs):
+        """write out the new entries, and forget the files under dirs which
+           weren't looked up, they're gone"""
+        gone = [path for path in self._entries if path not in self._seen and
+                [d for d in dirs if path.startswith(d.rstrip('/') + '/')]]
+        if not self._new and not gone:
+            return
+        ncolumns = 1 + len(self.key_columns) + len(self.value_columns)
+        try:
+            cx = self._connect()
+            try:
+                cx.executemany("INSERT OR REPLACE INTO %s VALUES (%s)" % (
+                               self.table, ', '.join(['?'] * ncolumns)),
+                               [(path,) + key + value
+                                for (path, (key, value)) in self._new.items()])
+                cx.executemany("DELETE FROM %s WHERE path = ?" % self.table,
+                               [(path,) for path in gone])
+                cx.commit()
+            finally:
+                cx.close()
+        except sqlite.Error:
+            pass
+        for path in gone:
+            del self._entries[path]
+        self._new = {}
+
+
+class OldPackageCache(_PathCache):
+    """The (name, arch, epoch, version, release) of the packages in the
+       --oldpackagedirs, keyed by path and the stat identity of the file,
+       so --deltas doesn't have to read all of their headers every run.
+    """
+
+    filename = 'oldpackages.sqlite'
+    table = 'oldpackages'
+    key_columns = (('dev', 'INTEGER'), ('ino', 'INTEGER'),
+                   ('size', 'INTEGER'), ('mtime', 'REAL'))
+    value_columns = (('name', 'TEXT'), ('arch', 'TEXT'), ('epoch', 'TEXT'),
+                     ('version', 'TEXT'), ('release', 'TEXT'))
+
+
+class DrpmCatalog(_PathCache):
+    """What prestodelta.xml says about each drpm: the (name, arch, epoch,
+       version, release) of the package it makes, the checksum of the drpm,
+       the old nevr and the sequence, keyed by its path, size and mtime. So
+       only the drpms made since the last run have to be read and checksummed.
+    """
+
+    filename = 'drpms.sqlite'
+    table = 'drpms'
+    key_columns = (('size', 'INTEGER'), ('mtime', 'REAL'))
+    value_columns = (('name', 'TEXT'), ('arch', 'TEXT'), ('epoch', 'TEXT'),
+                     ('version', 'TEXT'), ('release', 'TEXT'),
+                     ('checksum', 'TEXT'), ('old_nevr', 'TEXT'),
+                     ('sequence', 'TEXT'))
+
+
+_checksum_caches = {}
+
+def get_checksum_cache(cachedir, sumtype, run_id=None):
+    """return the ChecksumCache for cachedir, shared by everything in this
+       process (which may be making metadata more than once, see daemon.py),
+       marking what's used and added from now on as run_id's"""
+    key = (os.path.realpath(cachedir), sumtype)
+    if key not in _checksum_caches:
+        _checksum_caches[key] = ChecksumCache(cachedir, sumtype, run_id)
+    elif run_id is not None:
+        _checksum_caches[key].run_id = float(run_id)
+    return _checksum_caches[key]
+
+def flush_checksum_caches():
+    for csum_cache in _checksum_caches.values():
+        csum_cache.flush()
+
+atexit.register(flush_checksum_caches)
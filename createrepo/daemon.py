@@ -0,0 +1,323 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+#  createrepo --daemon: makes metadata on request, from a process which has
+# yum imported, the checksum cache loaded and forks its workers already
+# warmed up, rather than starting from scratch every time.
+#
+#  Requests come in on a unix socket, one json object per connection, as a
+# line (package paths are absolute or relative to the basedir, like the
+# directory, and have to be under it):
+#   {"command": "regenerate", "args": [createrepo options and directory]}
+#   {"command": "add", "args": [...], "packages": [paths of packages]}
+#   {"command": "remove", "args": [...], "packages": [...]}
+# and are answered, once the metadata is made, with a line of
+#   {"status": "ok"} or {"status": "error", "message": "..."}
+#
+#  Every run is an --update. Each repo gets a change journal (see journal.py)
+# of its own: add and remove note their packages in it, so the run only
+# looks at those, regenerate notes that anything might have changed. Requests
+# for a repo which arrive within batch_delay of each other and ask for the
+# same options are made into one run, and runs happen one at a time (rpm
+# isn't thread safe).
+
+import os
+import sys
+import stat
+import socket
+import shutil
+import tempfile
+import threading
+import Queue
+import SocketServer
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import createrepo
+import cache
+import journal
+from utils import MDError, _
+
+
+def request(sockname, command, args, packages=()):
+    """send a request to the daemon listening on sockname and wait for the
+       metadata to be made, raises MDError if it couldn't be"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockname)
+        fo = sock.makefile('r+')
+        fo.write(json.dumps({'command': command, 'args': list(args),
+                             'packages': list(packages)}) + '\n')
+        fo.flush()
+        reply = fo.readline()
+        fo.close()
+    finally:
+        sock.close()
+    if not reply:
+        raise MDError, _('No reply from createrepo daemon at %s') % sockname
+    reply = json.loads(reply)
+    if reply.get('status') != 'ok':
+        raise MDError, reply.get('message', _('Unknown error'))
+
+
+def _str_list(items):
+    """json gives us unicode, the rest of createrepo wants utf-8 strs"""
+    if not isinstance(items, list):
+        raise ValueError, _('not a list: %r') % (items,)
+    return [isinstance(item, unicode) and item.encode('utf-8') or str(item)
+            for item in items]
+
+
+class _RunCallBack(object):
+    """logs like the cli, keeping the errors for the reply"""
+    def __init__(self):
+        self.errors = []
+
+    def errorlog(self, thing):
+        self.errors.append(str(thing))
+        print >> sys.stderr, thing
+
+    def log(self, thing):
+        print thing
+
+    def progress(self, item, current, total):
+        pass
+
+
+def make_metadata(conf, callback):
+    """what genpkgmetadata.main() does with conf, raising MDError"""
+    mdgen = createrepo.MetaDataGenerator(config_obj=conf, callback=callback)
+    try:
+        try:
+            if mdgen.checkTimeStamps():
+                mdgen._cleanup_tmp_repodata_dir()
+                return
+            mdgen.doPkgMetadata()
+            mdgen.doRepoMetadata()
+            mdgen.doFinalMove()
+        except:
+            # whatever went wrong, the next run for the repo starts clean
+            _cleanup_failed_run(conf)
+            raise
+    finally:
+        mdgen.cleanup()
+        cache.flush_checksum_caches()
+
+
+def _cleanup_failed_run(conf):
+    """remove what a run which failed left of its new repodata, putting the
+       old repodata back if doFinalMove() had moved it out of the way"""
+    tmp = os.path.join(conf.outputdir, conf.tempdir)
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+    final = os.path.join(conf.outputdir, conf.finaldir)
+    old = os.path.join(conf.outputdir, conf.olddir)
+    if os.path.exists(old):
+        if not os.path.exists(final):
+            os.rename(old, final)
+        else:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _pkgdir_path(pkgdir, basedir, pkg):
+    """the path of package pkg (absolute or relative to basedir) relative to
+       pkgdir, as the change journal has them. Raises ValueError if it isn't
+       in pkgdir"""
+    path = os.path.normpath(os.path.join(basedir, pkg))
+    # the package itself may well be gone, or a symlink
+    path = os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
+    if not path.startswith(pkgdir.rstrip('/') + '/'):
+        raise ValueError, _('%s is not in %s') % (pkg, pkgdir)
+    return path[len(pkgdir.rstrip('/')) + 1:]
+
+
+class _Request(object):
+    def __init__(self, command, args, packages):
+        self.command = command
+        self.args = args
+        self.packages = packages
+        self.done = threading.Event()
+        self.error = None
+
+
+class _Repo(object):
+    """the requests for one repo, and the thread running them"""
+
+    def __init__(self, daemon, journal_fn):
+        self.daemon = daemon
+        self.journal = journal.JournalWriter(journal_fn)
+        self.queue = Queue.Queue()
+        thread = threading.Thread(target=self._run_requests)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run_requests(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get(timeout=self.daemon.batch_delay))
+                except Queue.Empty:
+                    break
+
+            # one run for each set of options, in the order they came
+            runs = []
+            for req in batch:
+                for (args, reqs) in runs:
+                    if args == req.args:
+                        reqs.append(req)
+                        break
+                else:
+                    runs.append((req.args, [req]))
+
+            for (args, reqs) in runs:
+                try:
+                    for req in reqs:
+                        if req.command == 'regenerate':
+                            self.journal.overflow()
+                        else:
+                            for pkg in req.packages:
+                                self.journal.changed(os.path.normpath(pkg))
+                    error = self.daemon.run(args, self.journal.filename)
+                except (IOError, OSError), e:
+                    error = _('Could not write change journal: %s') % e
+                for req in reqs:
+                    req.error = error
+                    req.done.set()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline())
+            if not isinstance(req, dict):
+                raise ValueError, _('not an object')
+            error = self.server.daemon.handle(req)
+        except ValueError, e:
+            error = _('Bad request: %s') % e
+        if error is None:
+            reply = {'status': 'ok'}
+        else:
+            reply = {'status': 'error', 'message': error}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """serves the requests on sockname, parse_args turns a request's args
+       into a MetaDataConfig (and may sys.exit() doing so, like the cli)"""
+
+    # how long to wait for more requests for a repo before running them
+    batch_delay = 2.0
+
+    def __init__(self, sockname, parse_args):
+        self.sockname = sockname
+        self.parse_args = parse_args
+        self._repos = {}
+        self._repos_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._journal_dir = tempfile.mkdtemp(prefix='createrepo-daemon')
+
+    def _parse(self, args):
+        """return (conf, error)"""
+        # the workers can fork from us, with everything already imported
+        args = ['--worker-pool=fork'] + list(args)
+        try:
+            conf = self.parse_args(args)
+        except SystemExit:
+            return (None, _('Bad createrepo arguments: %s') % ' '.join(args))
+        if conf.split or conf.watch or conf.daemon:
+            return (None, _('--split, --watch and --daemon can not be used '
+                            'in requests'))
+        return (conf, None)
+
+    def handle(self, req):
+        """queue up the request and wait for it to be run, returns the
+           error, if any"""
+        command = req.get('command')
+        if command not in ('regenerate', 'add', 'remove'):
+            return _('Unknown command: %s') % command
+        packages = _str_list(req.get('packages') or [])
+        args = _str_list(req.get('args') or [])
+        (conf, error) = self._parse(args)
+        if error:
+            return error
+        pkgdir = os.path.realpath(os.path.join(conf.basedir, conf.directory))
+        packages = [_pkgdir_path(pkgdir, conf.basedir, pkg)
+                    for pkg in packages]
+        key = (pkgdir, os.path.realpath(conf.outputdir or pkgdir))
+        self._repos_lock.acquire()
+        try:
+            if key not in self._repos:
+                fn = os.path.join(self._journal_dir, 'journal%d' %
+                                  len(self._repos))
+                self._repos[key] = _Repo(self, fn)
+            repo = self._repos[key]
+        finally:
+            self._repos_lock.release()
+
+        request = _Request(command, args, packages)
+        repo.queue.put(request)
+        request.done.wait()
+        return request.error
+
+    def run(self, args, journal_fn):
+        """make the metadata, returns the error, if any"""
+        (conf, error) = self._parse(args)
+        if error:
+            return error
+        conf.update = True
+        conf.change_journal = journal_fn
+        callback = _RunCallBack()
+        self._run_lock.acquire()
+        try:
+            try:
+                make_metadata(conf, callback)
+            except MDError, e:
+                return '\n'.join(callback.errors + [str(e)])
+            except Exception, e:
+                # keep serving the other requests
+                return _('createrepo failed: %s') % e
+        finally:
+            self._run_lock.release()
+        return None
+
+    def serve(self):
+        """serve requests until interrupted"""
+        try:
+            if stat.S_ISSOCK(os.stat(self.sockname).st_mode):
+                os.unlink(self.sockname)
+        except OSError:
+            pass
+        oumask = os.umask(077)
+        try:
+            server = _Server(self.sockname, _Handler)
+        finally:
+            os.umask(oumask)
+        server.daemon = self
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self.sockname)
+            except OSError:
+                pass
+            shutil.rmtree(self._journal_dir, ignore_errors=True)
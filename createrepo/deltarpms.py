@@ -15,8 +15,10 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 # copyright 2009 - Red Hat
 
-import os.path
-import commands
+import os
+import time
+import tempfile
+import subprocess
 from yum import misc
 import deltarpm
 from utils import MDError
@@ -28,7 +30,9 @@ class DeltaRPMPackage:
 
     mode_cache = {}
 
-    def __init__(self, po, basedir, filename):
+    def __init__(self, po, basedir, filename, info=None):
+        """info is the catalog_info() of this drpm from before, if it's
+           known, then the drpm isn't read (and po isn't needed)"""
         try:
             stats = os.stat(os.path.join(basedir, filename))
             self.size = stats[6]
@@ -40,6 +44,10 @@ class DeltaRPMPackage:
         self.relativepath = filename
         self.po  = po
 
+        if info is not None:
+            (self.csum, self.oldnevrstring, self.sequence) = info
+            self.oldnevr = self._stringToNEVR(self.oldnevrstring)
+            return
         fd = os.open(self.po.localpath, os.O_RDONLY)
         os.lseek(fd, 0, 0)
         fo = os.fdopen(fd, 'rb')
@@ -48,6 +56,10 @@ class DeltaRPMPackage:
         del fd
         self._getDRPMInfo(os.path.join(basedir, filename))
 
+    def catalog_info(self):
+        """what to keep of this drpm to make it again, see above"""
+        return (self.csum, self.oldnevrstring, str(self.sequence))
+
     def _stringToNEVR(self, string):
         i = string.rfind("-", 0, string.rfind("-")-1)
         name = string[:i]
@@ -104,21 +116,226 @@ class DeltaRPMPackage:
                     self.size, self.csum_type, self.csum)
         return delta_tag
 
+class DeltaPackage(object):
+    """a package file as the drpm making needs it, from its pkgtup and size
+       as already known, rather than reading its header again"""
+    def __init__(self, localpath, pkgtup, size):
+        self.localpath = localpath
+        (self.name, self.arch, self.epoch, self.ver, self.rel) = pkgtup
+        self.release = self.rel
+        self.size = size
+
+    def __str__(self):
+        if self.epoch and self.epoch != '0':
+            return '%s-%s:%s-%s.%s' % (self.name, self.epoch, self.ver,
+                                       self.rel, self.arch)
+        return '%s-%s-%s.%s' % (self.name, self.ver, self.rel, self.arch)
+
+MAKEDELTARPM = '/usr/bin/makedeltarpm'
+
+def drpm_filename(old_pkg, new_pkg):
+    return '%s-%s-%s_%s-%s.%s.drpm' % (old_pkg.name, old_pkg.ver,
+                            old_pkg.release, new_pkg.ver, new_pkg.release,
+                            old_pkg.arch)
+
+def _nevr_matches(nevr, pkg):
+    """whether the name-[epoch:]version-release nevr is pkg's"""
+    try:
+        (name, ver, rel) = nevr.rsplit('-', 2)
+    except ValueError:
+        return False
+    return (name, ver.split(':')[-1], rel) == (pkg.name, pkg.ver,
+                                               pkg.release)
+
+def verify_drpm(path, old_pkg, new_pkg):
+    """whether path is a drpm deltarpm can read, from old_pkg to new_pkg"""
+    try:
+        if not os.path.getsize(path):
+            return False
+        d = deltarpm.readDeltaRPM(path)
+    except Exception:
+        # the binding raises whatever it likes on a broken file
+        return False
+    if not _nevr_matches(d.get('old_nevr', ''), old_pkg):
+        return False
+    if 'nevr' in d and not _nevr_matches(d['nevr'], new_pkg):
+        return False
+    return True
+
+def _proc_rss(pid):
+    """the resident and peak resident memory of process pid, in bytes, or
+       None if it can't be told"""
+    rss = hwm = None
+    try:
+        fo = open('/proc/%d/status' % pid)
+        try:
+            for line in fo:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1]) * 1024
+        finally:
+            fo.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    if rss is None:
+        return None
+    return (rss, hwm or rss)
+
+class _DeltaJob(object):
+    def __init__(self, old_pkg, new_pkg, destdir):
+        self.old_pkg = old_pkg
+        self.new_pkg = new_pkg
+        self.path = os.path.join(destdir, drpm_filename(old_pkg, new_pkg))
+        # not ending in .drpm, so nothing picks it up half written
+        self.tmp = os.path.join(destdir, '.%s.tmp' % os.path.basename(
+                                                                self.path))
+        #  the size of the two package files. makedeltarpm's memory use goes
+        # with their uncompressed payloads, several times that
+        self.size = int(old_pkg.size) + int(new_pkg.size)
+        self.proc = None
+        self.output = None
+        self.started = None
+        self.estimate = 0
+        self.rss = 0
+        self.peak = 0
+
+class DeltaPool(object):
+    """Makes the drpms of (old, new) package pairs, running makedeltarpm for
+       up to workers of them at once. A job is only started while the
+       memory the running ones use (as the kernel says, or as expected if
+       that's more) plus what it is expected to need fits in max_rss, so
+       the biggest packages don't all run at once. Expectations start at
+       initial_rss_ratio bytes per byte of the two package files, on the
+       safe side of how much their payloads are compressed, and follow what
+       the finished jobs really used. Jobs are killed after timeout
+       seconds, and a drpm is only put in place once deltarpm reads it back
+       as the delta between the two packages."""
+
+    poll_interval = 0.1
+    # memory per byte of package file until a job has finished
+    initial_rss_ratio = 4.0
+
+    def __init__(self, workers, max_rss, callback, timeout=None,
+                 verbose=False):
+        self.workers = max(1, workers)
+        self.max_rss = max_rss
+        self.callback = callback
+        self.timeout = timeout
+        self.verbose = verbose
+        # bytes of memory per byte of job size, over the jobs done so far
+        self.rss_ratio = None
+        self._done_peak = 0
+        self._done_size = 0
+        self.pending = []
+        self.running = []
+        self.created = []
+
+    def add(self, old_pkg, new_pkg, destdir):
+        """queue up the drpm from old_pkg to new_pkg, into destdir"""
+        job = _DeltaJob(old_pkg, new_pkg, destdir)
+        if os.path.exists(job.path):
+            if verify_drpm(job.path, old_pkg, new_pkg):
+                self.created.append(job.path)
+                return
+            os.unlink(job.path)
+        self.pending.append(job)
+
+    def _estimate(self, job):
+        return int(job.size * (self.rss_ratio or self.initial_rss_ratio))
+
+    def _in_use(self):
+        return sum([max(job.estimate, job.rss) for job in self.running])
+
+    def _start_jobs(self):
+        # the biggest first, so no huge one is left to run alone at the end
+        self.pending.sort(key=lambda job: job.size, reverse=True)
+        in_use = self._in_use()
+        for job in self.pending[:]:
+            if len(self.running) >= self.workers:
+                break
+            job.estimate = self._estimate(job)
+            if self.running and in_use + job.estimate > self.max_rss:
+                continue
+            self.pending.remove(job)
+            job.output = tempfile.TemporaryFile()
+            job.started = time.time()
+            try:
+                job.proc = subprocess.Popen([MAKEDELTARPM,
+                                             job.old_pkg.localpath,
+                                             job.new_pkg.localpath, job.tmp],
+                                            stdout=job.output,
+                                            stderr=subprocess.STDOUT)
+            except OSError, e:
+                self._failed(job, str(e))
+                continue
+            self.running.append(job)
+            in_use += job.estimate
+
+    def _failed(self, job, msg):
+        self.callback.errorlog('Error genDeltaRPM for %s: %s' % (
+                               job.old_pkg.name, msg))
+        if os.path.exists(job.tmp):
+            os.unlink(job.tmp)
+        job.output.close()
+
+    def _finished(self, job):
+        if job.peak and job.size:
+            # weighted by size, the small jobs are mostly process overhead
+            self._done_peak += job.peak
+            self._done_size += job.size
+            self.rss_ratio = float(self._done_peak) / self._done_size
+        if job.proc.returncode:
+            job.output.seek(0)
+            self._failed(job, 'exitcode was %s - Reported Error: %s' % (
+                         job.proc.returncode, job.output.read().strip()))
+            return
+        if not verify_drpm(job.tmp, job.old_pkg, job.new_pkg):
+            self._failed(job, 'makedeltarpm made a bad drpm')
+            return
+        job.output.close()
+        os.rename(job.tmp, job.path)
+        self.created.append(job.path)
+        if self.verbose:
+            self.callback.log('created drpm from %s to %s: %s in %0.3f' % (
+                              job.old_pkg, job.new_pkg, job.path,
+                              time.time() - job.started))
+
+    def _poll(self):
+        now = time.time()
+        for job in self.running[:]:
+            if job.proc.poll() is None:
+                usage = _proc_rss(job.proc.pid)
+                if usage is not None:
+                    (job.rss, peak) = usage
+                    job.peak = max(job.peak, peak)
+                if self.timeout and now - job.started > self.timeout:
+                    job.proc.kill()
+                    job.proc.wait()
+                    self.running.remove(job)
+                    self._failed(job, 'killed after %d seconds' % self.timeout)
+                continue
+            self.running.remove(job)
+            self._finished(job)
+
+    def run(self):
+        """make all the drpms, returns the paths of those there now"""
+        while self.pending or self.running:
+            self._start_jobs()
+            time.sleep(self.poll_interval)
+            self._poll()
+        return self.created
+
 def create_drpm(old_pkg, new_pkg, destdir):
     """make a drpm file, if possible. returns None if nothing could
        be created"""
-    drpmfn = '%s-%s-%s_%s-%s.%s.drpm' % (old_pkg.name, old_pkg.ver,
-                            old_pkg.release, new_pkg.ver, new_pkg.release,
-                            old_pkg.arch)
-    delta_rpm_path  = os.path.join(destdir, drpmfn)
-    delta_command = '/usr/bin/makedeltarpm %s %s %s' % (old_pkg.localpath,
-                                                        new_pkg.localpath,
-                                                        delta_rpm_path)
-    if not os.path.exists(delta_rpm_path):
-        #TODO - check/verify the existing one a bit?
-        (code, out) = commands.getstatusoutput(delta_command)
-        if code:
-            print "Error genDeltaRPM for %s: exitcode was %s - Reported Error: %s" % (old_pkg.name, code, out)
-            return None
-
-    return delta_rpm_path
+    class Callback:
+        def log(self, thing):
+            print thing
+        errorlog = log
+    pool = DeltaPool(1, 0, Callback())
+    pool.add(old_pkg, new_pkg, destdir)
+    created = pool.run()
+    if not created:
+        return None
+    return created[0]
@@ -0,0 +1,156 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+#  The --change-journal: createrepo --watch records every path under the
+# package dir which changes, so that --update only has to look at those
+# rather than stat()ing every package. The journal is a header line with an
+# id, which is new every time the watcher starts, then one record per line.
+# A run notes (id, offset) of where the journal was up to in the manifest,
+# and the next run only trusts the journal if it's still the same one, and
+# nothing was lost since then.
+
+import os
+from utils import MDError, _
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+JOURNAL_MAGIC = 'createrepo-journal'
+JOURNAL_VERSION = 1
+
+# a path which was written, created, removed, moved or touched
+CHANGED = 'C'
+# events were lost, anything might have changed
+OVERFLOW = 'O'
+
+
+class JournalWriter(object):
+    """Starts a new journal in filename and appends records to it"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.journal_id = os.urandom(8).encode('hex')
+        # so nobody sees the old journal with a new header, or half a header
+        tmp = filename + '.tmp'
+        fo = open(tmp, 'w')
+        fo.write('%s %d %s\n' % (JOURNAL_MAGIC, JOURNAL_VERSION,
+                                 self.journal_id))
+        fo.close()
+        os.rename(tmp, filename)
+        self._fo = open(filename, 'a')
+
+    def record(self, code, relpath=''):
+        self._fo.write('%s %s\n' % (code, relpath.encode('string_escape')))
+        self._fo.flush()
+
+    def changed(self, relpath):
+        self.record(CHANGED, relpath)
+
+    def overflow(self):
+        self.record(OVERFLOW)
+
+    def close(self):
+        self._fo.close()
+
+
+def read_journal(filename, since=None):
+    """read the journal, returns (state, changed) where state is the
+       (journal id, offset) it is complete up to now, to be passed as since
+       by the next run, and changed is the set of paths changed since since.
+       changed is None if it can't be told, state is None if there's no
+       (readable) journal"""
+    try:
+        fo = open(filename)
+    except IOError:
+        return (None, None)
+    try:
+        header = fo.readline().split()
+        if (len(header) != 3 or header[0] != JOURNAL_MAGIC or
+                header[1] != str(JOURNAL_VERSION)):
+            return (None, None)
+        journal_id = header[2]
+        start = fo.tell()
+
+        if since is None or since[0] != journal_id or since[1] < start:
+            # just find where the last complete record ends, they're short
+            size = os.fstat(fo.fileno()).st_size
+            pos = max(start, size - 65536)
+            fo.seek(pos)
+            end = fo.read().rfind('\n')
+            if end == -1:
+                return ((journal_id, start), None)
+            return ((journal_id, pos + end + 1), None)
+
+        fo.seek(since[1])
+        pos = since[1]
+        changed = set()
+        overflowed = False
+        for line in fo:
+            if not line.endswith('\n'):
+                # still being written
+                break
+            pos += len(line)
+            (code, relpath) = line[:-1].split(' ', 1)
+            if code == CHANGED:
+                changed.add(relpath.decode('string_escape'))
+            else:
+                overflowed = True
+        if overflowed:
+            changed = None
+        return ((journal_id, pos), changed)
+    finally:
+        fo.close()
+
+
+def watch(directory, filename):
+    """record what changes under directory in a new journal in filename,
+       until interrupted"""
+    if pyinotify is None:
+        raise MDError, _('--watch needs pyinotify')
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        raise MDError, _('Directory %s must exist') % directory
+
+    journal = []
+    lost = pyinotify.IN_Q_OVERFLOW | pyinotify.IN_UNMOUNT | \
+           pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF
+
+    class ChangeHandler(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            if event.mask & lost and (event.mask & pyinotify.IN_Q_OVERFLOW or
+                                      event.pathname == directory):
+                journal[0].overflow()
+                return
+            if event.mask & pyinotify.IN_IGNORED:
+                return
+            relpath = event.pathname[len(directory):].lstrip('/')
+            if relpath:
+                journal[0].changed(relpath)
+
+    wm = pyinotify.WatchManager()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | \
+           pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | \
+           pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB | lost
+    notifier = pyinotify.Notifier(wm, ChangeHandler())
+    #  watch first, then start the journal: anything which changed before is
+    # covered by the new journal id, the next run will stat everything
+    wm.add_watch(directory, mask, rec=True, auto_add=True)
+    journal.append(JournalWriter(filename))
+    try:
+        notifier.loop()
+    finally:
+        notifier.stop()
+        journal[0].close()
@@ -18,12 +18,92 @@
 import os
 import shutil
 import stat
-from utils import errorprint, _
+import marshal
+import zlib
+from utils import errorprint, _, _gzipOpen, compressOpen
+import journal
 
 import yum
 from yum import misc
 from yum.Errors import YumBaseError
+from yum.repoMDObject import RepoMD
 import tempfile
+
+#  The manifest createrepo writes along with the rest of the repodata, so
+# --update can tell which packages are unchanged without loading the old
+# metadata. For each package it has: the location, size, mtime, pkgId,
+# checksum type, pkgtup and the (offset, length) of its fragment in each of
+# the uncompressed primary, filelists and other xml. The header has the
+# open-checksums of those, so a manifest which doesn't go with the repomd.xml
+# next to it is ignored, and the options the xml depends on.
+MANIFEST_FILE = 'manifest.gz'
+MANIFEST_VERSION = 1
+
+def write_manifest(filename, header, packages):
+    """write the manifest, header is a dict and packages a list of
+       (relpath, size, mtime, pkgId, checksum type, pkgtup, offsets) where
+       offsets is (primary offset, primary length, filelists offset, ...)"""
+    fo = _gzipOpen(filename, 'wb')
+    try:
+        fo.write(marshal.dumps({'version': MANIFEST_VERSION,
+                                'header': header,
+                                'packages': packages}))
+    finally:
+        fo.close()
+
+def read_manifest(filename):
+    """return (header, packages) from the manifest written by
+       write_manifest(), or None if there isn't a (readable) one"""
+    try:
+        fo = _gzipOpen(filename)
+        try:
+            data = marshal.loads(fo.read())
+        finally:
+            fo.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError, zlib.error):
+        return None
+    if not isinstance(data, dict) or data.get('version') != MANIFEST_VERSION:
+        return None
+    return (data['header'], data['packages'])
+
+# what the xml fragments of the packages depend on, besides the package
+FRAGMENT_OPTS = ('baseurl', 'changelog_limit', 'collapse_libc_requires')
+
+
+class FragmentReader(object):
+    """Reads package fragments out of an old (compressed) xml file. They
+       have to be asked for in the order they are in the file, which is the
+       order createrepo writes the packages in, as it only reads forwards"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fo = None
+        self._pos = 0
+
+    def read(self, offset, length):
+        """return the length bytes at offset, or None if they are behind us
+           or past the end of the file"""
+        if self._fo is None:
+            self._fo = compressOpen(self.filename)
+        if offset < self._pos:
+            return None
+        while self._pos < offset:
+            chunk = self._fo.read(min(offset - self._pos, 2**20))
+            if not chunk:
+                return None
+            self._pos += len(chunk)
+        data = self._fo.read(length)
+        self._pos += len(data)
+        if len(data) != length:
+            return None
+        return data
+
+    def close(self):
+        if self._fo is not None:
+            self._fo.close()
+            self._fo = None
+
+
 class CreaterepoPkgOld(yum.sqlitesack.YumAvailablePackageSqlite):
     # special for special people like us.
     def _return_remote_location(self):
@@ -55,61 +135,200 @@ class MetadataIndex(object):
         self._repo.gpgcheck = 0
         self._repo.repo_gpgcheck = 0
         self._repo._sack = yum.sqlitesack.YumSqlitePackageSack(CreaterepoPkgOld)
+        self._populated = False
         self.pkg_tups_by_path = {}
+        # the manifest entries of the unchanged packages, by relpath
+        self.manifest = {}
+        self.manifest_header = None
+        # FragmentReaders of the old xml, if its fragments can be copied
+        self._fragments = None
+        # the compressed old primary, filelists and other dbs, if they can be
+        # patched rather than made again
+        self.old_dbs = None
+        # the relpaths of all the packages in the manifest
+        self.manifest_paths = []
+        #  the paths the --change-journal says changed since the manifest was
+        # written, None if there's no telling
+        self.changed = None
+        if self.scan_manifest():
+            return
         try:
             self.scan()
         except YumBaseError, e:
             print "Could not find valid repo at: %s" % self.outputdir
         
 
+    def _populate(self):
+        """load the old repodata into the sack, returns False if it can't"""
+        if not self._populated:
+            self._repo.sack.populate(self._repo, 'all', None, False)
+            self._populated = True
+        return self._populated
+
+    def isChanged(self, relpath):
+        """does the change journal say relpath, or a dir it's in, changed.
+           Everything has if there's no journal"""
+        if self.changed is None:
+            return True
+        while relpath:
+            if relpath in self.changed:
+                return True
+            relpath = os.path.dirname(relpath)
+        return False
+
+    def _unchanged(self, relpath, size, mtime):
+        """check the package at relpath is still the size and mtime it was"""
+        if mtime is None:
+            print _("mtime missing for %s") % relpath
+            return False
+        if size is None:
+            print _("size missing for %s") % relpath
+            return False
+        if not self.opts.get('do_stat', True):
+            return True
+        if not self.isChanged(relpath):
+            # the journal would know
+            return True
+        filepath = os.path.join(self.opts['pkgdir'], relpath)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            #file missing -- ignore
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            #ignore non files
+            return False
+        #check size and mtime
+        if st.st_size != size:
+            if self.opts.get('verbose'):
+                print _("Size (%i -> %i) changed for file %s") % (size,st.st_size,filepath)
+            return False
+        if int(st.st_mtime) != mtime:
+            if self.opts.get('verbose'):
+                print _("Modification time changed for %s") % filepath
+            return False
+        return True
+
+    def scan_manifest(self):
+        """Read in the manifest of the old repodata, rather than the repodata
+           itself. Returns False if there's no manifest to go with it"""
+        repodatadir = os.path.join(self.outputdir, 'repodata')
+        manifest = read_manifest(os.path.join(repodatadir, MANIFEST_FILE))
+        if manifest is None:
+            return False
+        (header, packages) = manifest
+        try:
+            repomd = RepoMD('garbageid', os.path.join(repodatadir, 'repomd.xml'))
+            xmlfiles = {}
+            for ftype in ('primary', 'filelists', 'other'):
+                data = repomd.getData(ftype)
+                openchecksum = data.openchecksum
+                if not openchecksum or openchecksum[1] != header.get(ftype):
+                    if self.opts.get('verbose'):
+                        print _("Manifest doesn't match the old repodata")
+                    return False
+                xmlfiles[ftype] = os.path.join(self.outputdir, data.location[1])
+        except (YumBaseError, IOError, OSError):
+            return False
+
+        for key in FRAGMENT_OPTS:
+            if key not in header or header[key] != self.opts.get(key):
+                break
+        else:
+            self._fragments = dict((ftype, FragmentReader(fn))
+                                   for (ftype, fn) in xmlfiles.items())
+            try:
+                self.old_dbs = dict((ftype, os.path.join(self.outputdir,
+                                        repomd.getData(ftype + '_db').location[1]))
+                                    for ftype in ('primary', 'filelists', 'other'))
+            except YumBaseError:
+                # made with --no-database
+                pass
+
+        if self.opts.get('journal'):
+            (state, self.changed) = journal.read_journal(self.opts['journal'],
+                                                         header.get('journal'))
+            if self.changed is None and self.opts.get('verbose'):
+                print _("Change journal doesn't go back to the old repodata")
+
+        if self.opts.get('verbose'):
+            print _("Scanning old repo manifest")
+        for entry in packages:
+            (relpath, size, mtime, pkgid, sumtype, pkgtup, offsets) = entry
+            self.manifest_paths.append(relpath)
+            if sumtype != self.opts['sumtype']:
+                continue
+            if not self._unchanged(relpath, size, mtime):
+                continue
+            self.pkg_tups_by_path[relpath] = pkgtup
+            self.manifest[relpath] = entry
+        self.manifest_header = header
+        return True
+
     def scan(self):
         """Read in old repodata"""
         if self.opts.get('verbose'):
             print _("Scanning old repo data")
-        self._repo.sack.populate(self._repo, 'all', None, False)
+        self._populate()
         for thispo in self._repo.sack:
             if thispo.checksum_type != self.opts['sumtype']:
                 continue
-            mtime = thispo.filetime
-            size = thispo.size
             relpath = thispo.relativepath
-            do_stat = self.opts.get('do_stat', True)
-            if mtime is None:
-                print _("mtime missing for %s") % relpath
-                continue
-            if size is None:
-                print _("size missing for %s") % relpath
+            if not self._unchanged(relpath, thispo.size, thispo.filetime):
                 continue
-            if do_stat:
-                filepath = os.path.join(self.opts['pkgdir'], relpath)
-                try:
-                    st = os.stat(filepath)
-                except OSError:
-                    #file missing -- ignore
-                    continue
-                if not stat.S_ISREG(st.st_mode):
-                    #ignore non files
-                    continue
-                #check size and mtime
-                if st.st_size != size:
-                    if self.opts.get('verbose'):
-                        print _("Size (%i -> %i) changed for file %s") % (size,st.st_size,filepath)
-                    continue
-                if int(st.st_mtime) != mtime:
-                    if self.opts.get('verbose'):
-                        print _("Modification time changed for %s") % filepath
-                    continue
 
             self.pkg_tups_by_path[relpath] = thispo.pkgtup
 
 
 
+    def hasFragments(self, relpath):
+        """can getFragments() be used for the package at relpath"""
+        return self._fragments is not None and relpath in self.manifest
+
+    def getFragments(self, relpath):
+        """return the primary, filelists and other xml of the package at
+           relpath exactly as they were written out last time, or None.
+           Packages must be asked for in the order they were written in"""
+        if not self.hasFragments(relpath):
+            return None
+        offsets = self.manifest[relpath][6]
+        xml = []
+        try:
+            for (i, ftype) in enumerate(('primary', 'filelists', 'other')):
+                data = self._fragments[ftype].read(offsets[2 * i],
+                                                   offsets[2 * i + 1])
+                if data is None:
+                    return None
+                xml.append(data)
+        except (IOError, OSError, EOFError, zlib.error), e:
+            if self.opts.get('verbose'):
+                print _("Could not read old metadata: %s") % e
+            self._close_fragments()
+            return None
+        return tuple(xml)
+
+    def _close_fragments(self):
+        if self._fragments is not None:
+            for reader in self._fragments.values():
+                reader.close()
+            self._fragments = None
+
     def getNodes(self, relpath):
         """return a package object based on relative path of pkg
         """
         if relpath in self.pkg_tups_by_path:
+            try:
+                self._populate()
+            except YumBaseError, e:
+                print "Could not find valid repo at: %s" % self.outputdir
+                self.pkg_tups_by_path = {}
+                self.manifest = {}
+                return None
             pkgtup = self.pkg_tups_by_path[relpath]
             pos = self._repo.sack.searchPkgTuple(pkgtup)
+            if relpath in self.manifest:
+                pkgid = self.manifest[relpath][3]
+                pos = [po for po in pos if po.checksum == pkgid]
             if len(pos) == 1:
                 return pos[0]
             elif len(pos) > 1:
@@ -123,6 +342,7 @@ class MetadataIndex(object):
 
     def cleanup(self):
         """Delete temporary files in /var/tmp."""
+        self._close_fragments()
         shutil.rmtree(self._repo.basecachedir, ignore_errors=True)
         shutil.rmtree(self._repo.base_persistdir, ignore_errors=True)
 
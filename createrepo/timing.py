@@ -0,0 +1,96 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+#  What --profile-json writes out: the time the parent spent in each stage
+# of the run, the time the workers spent on each stage of each package,
+# some counters and how busy the workers were, as a json object of
+#   {"version": 1, "started": ..., "wall": seconds,
+#    "stages": {stage: seconds}, "counters": {counter: number},
+#    "package_stages": {stage: seconds for all the packages},
+#    "packages": {package: {stage: seconds}},
+#    "workers": {"count": n, "busy": seconds, "wall": seconds,
+#                "utilization": busy / (count * wall)}}
+# which is meant to be kept for comparing runs, so only ever add to it.
+
+import time
+from contextlib import contextmanager
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+TIMINGS_VERSION = 1
+
+
+class RunTimings(object):
+    """collects the timings of a run, see above. The packages are only kept
+       track of one by one with per_package, there can be a lot of them"""
+
+    def __init__(self, per_package=False):
+        self.started = time.time()
+        self.per_package = per_package
+        self.stages = {}
+        self.counters = {}
+        self.packages = {}
+        self.package_stages = {}
+        self.workers = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        """time the with block as (part of) stage"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def count(self, counter, num=1):
+        self.counters[counter] = self.counters.get(counter, 0) + num
+
+    def package(self, pkg, stages):
+        """note the {stage: seconds} a worker spent on pkg"""
+        if self.per_package:
+            self.packages[pkg] = stages
+        for (stage, seconds) in stages.items():
+            self.package_stages[stage] = (self.package_stages.get(stage, 0.0)
+                                          + seconds)
+
+    def pool(self, count, busy, wall):
+        """note that count workers were busy for busy of wall seconds"""
+        utilization = 0.0
+        if count and wall > 0:
+            utilization = busy / (count * wall)
+        self.workers = {'count': count, 'busy': busy, 'wall': wall,
+                        'utilization': utilization}
+
+    def report(self):
+        return {'version': TIMINGS_VERSION,
+                'started': self.started,
+                'wall': time.time() - self.started,
+                'stages': self.stages,
+                'counters': self.counters,
+                'package_stages': self.package_stages,
+                'packages': self.packages,
+                'workers': self.workers}
+
+    def write(self, filename):
+        fo = open(filename, 'w')
+        try:
+            json.dump(self.report(), fo, indent=1, sort_keys=True)
+            fo.write('\n')
+        finally:
+            fo.close()
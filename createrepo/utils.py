@@ -20,10 +20,20 @@ import os
 import os.path
 import re
 import sys
+import stat
+import fnmatch
 import bz2
 import gzip
+import threading
+import Queue
 from gzip import write32u, FNAME
 from yum import misc
+try:
+    # the scandir module (os.scandir in python 3.5) tells us about the type of
+    # directory entries without stat()ing them
+    import scandir
+except ImportError:
+    scandir = None
 _available_compression = ['gz', 'bz2']
 try:
     import lzma
@@ -136,7 +146,305 @@ def compressOpen(fn, mode='rb', compress_type=None):
         return _gzipOpen(fn, mode)
     else:
         raise MDError, "Unknown compression type %s" % compress_type
-    
+
+class ChecksumWriter:
+    """Passes writes on to fo, checksumming and counting them on the way."""
+
+    def __init__(self, fo, sumtype):
+        self.fo = fo
+        self.sumtype = sumtype
+        self._csums = misc.Checksums([sumtype])
+
+    def write(self, data):
+        self._csums.update(data)
+        self.fo.write(data)
+
+    def flush(self):
+        if hasattr(self.fo, 'flush'):
+            self.fo.flush()
+
+    def close(self):
+        self.fo.close()
+
+    def hexdigest(self):
+        return self._csums.hexdigest(self.sumtype)
+
+    def size(self):
+        return len(self._csums)
+
+class _CompressorWriter:
+    """File-like object feeding writes through a bz2/lzma compressor object
+       into fo, the modules' own file classes only take filenames."""
+
+    def __init__(self, fo, compressor):
+        self.fo = fo
+        self.compressor = compressor
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.fo.write(data)
+
+    def close(self):
+        self.fo.write(self.compressor.flush())
+        self.fo.close()
+
+class ChecksumCompressFile:
+    """Like compressOpen(fn, 'w', compress_type), but the checksum and size
+       of both the compressed and uncompressed data are worked out as it is
+       written, so nobody has to read the file back for repomd.xml. They are
+       available as checksum, size, openchecksum and opensize after close()."""
+
+    def __init__(self, fn, compress_type, sumtype):
+        self.name = fn
+        self.sumtype = sumtype
+        self._compressed = ChecksumWriter(open(fn, 'wb'), sumtype)
+        if compress_type == 'xz':
+            if lzma is None:
+                raise MDError, "Cannot use xz for compression, library/module is not available"
+            self._cfo = _CompressorWriter(self._compressed,
+                                          lzma.LZMACompressor())
+        elif compress_type == 'bz2':
+            self._cfo = _CompressorWriter(self._compressed,
+                                          bz2.BZ2Compressor(9))
+        elif compress_type == 'gz':
+            self._cfo = GzipFile(fileobj=self._compressed, mode='wb',
+                                 compresslevel=9)
+        else:
+            self._compressed.close()
+            raise MDError, "Unknown compression type %s" % compress_type
+        self._uncompressed = misc.Checksums([sumtype])
+        self.closed = False
+
+    def write(self, data):
+        # empty writes upset some lzma versions, see compressOpen()
+        if not data:
+            return
+        self._uncompressed.update(data)
+        self._cfo.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._cfo.close()
+        if isinstance(self._cfo, GzipFile):
+            # GzipFile leaves a fileobj it was given open
+            self._compressed.close()
+        self.closed = True
+
+    checksum = property(lambda self: self._compressed.hexdigest())
+    size = property(lambda self: self._compressed.size())
+    openchecksum = property(lambda self:
+                            self._uncompressed.hexdigest(self.sumtype))
+    opensize = property(lambda self: len(self._uncompressed))
+
+def checksumCompressFile(source, dest, compress_type, sumtype):
+    """compressFile() which also checksums source and dest on the way,
+       returns the closed ChecksumCompressFile"""
+    s_fn = open(source, 'rb')
+    destination = ChecksumCompressFile(dest, compress_type, sumtype)
+    while True:
+        data = s_fn.read(1024000)
+
+        if not data: break
+        destination.write(data)
+
+    destination.close()
+    s_fn.close()
+    return destination
+
+class ThreadedWriter:
+    """Wraps a (compressed) file object so that writing to it happens in a
+       thread of its own, fed through a bounded queue.  Compression of the
+       metadata then runs alongside whatever is producing it - zlib, bz2 and
+       lzma all drop the GIL while they work - instead of in between."""
+
+    def __init__(self, fo, bufsize=2**20, queue_size=16):
+        self.fo = fo
+        self.bufsize = bufsize
+        self._buf = []
+        self._buflen = 0
+        self._pos = 0
+        self._error = None
+        self._queue = Queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is None:
+                try:
+                    self.fo.write(data)
+                except:
+                    # keep draining the queue, so write() can't block forever
+                    self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            (etype, value, tb) = self._error
+            raise etype, value, tb
+
+    def _flush_buf(self):
+        if self._buf:
+            self._queue.put(''.join(self._buf))
+            self._buf = []
+            self._buflen = 0
+
+    def write(self, data):
+        self._raise_error()
+        if not data:
+            return
+        self._buf.append(data)
+        self._buflen += len(data)
+        self._pos += len(data)
+        if self._buflen >= self.bufsize:
+            self._flush_buf()
+
+    def tell(self):
+        """how much has been written, uncompressed"""
+        return self._pos
+
+    def close(self):
+        self._flush_buf()
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self.fo.close()
+        finally:
+            # the writer thread's error is the one that counts
+            self._raise_error()
+
+def _list_dir(dirname, skip_symlinks):
+    """return (subdirs, files) of dirname, symlinks to directories count as
+       directories, symlinks to files as files unless skip_symlinks"""
+    dirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir.scandir(dirname):
+            # is_dir() only stats symlinks, the rest come with their type
+            if entry.is_dir():
+                dirs.append(entry.path)
+            elif not (skip_symlinks and entry.is_symlink()):
+                files.append(entry.path)
+        return (dirs, files)
+
+    for name in os.listdir(dirname):
+        path = os.path.join(dirname, name)
+        try:
+            mode = os.lstat(path).st_mode
+            if stat.S_ISLNK(mode):
+                if skip_symlinks and not os.path.isdir(path):
+                    continue
+                mode = os.stat(path).st_mode
+        except OSError:
+            # dangling symlinks are files to os.path.isdir()
+            mode = stat.S_IFREG
+        if stat.S_ISDIR(mode):
+            dirs.append(path)
+        else:
+            files.append(path)
+    return (dirs, files)
+
+def _walk_dirs_threaded(top, skip_symlinks, threads):
+    """generator of the lists of files found by threads listing the
+       directories under top concurrently"""
+    todo = Queue.Queue()
+    # lists of files, None once everything is listed, or the exc_info() of
+    # a lister which failed
+    found = Queue.Queue()
+    # directories queued or being listed, the last one out says we're done
+    outstanding = [1]
+    # set once the walk is over, the listers skip what's left in todo
+    stopped = []
+    lock = threading.Lock()
+
+    def lister():
+        while True:
+            dirname = todo.get()
+            if dirname is None:
+                return
+            if stopped:
+                continue
+            try:
+                try:
+                    (dirs, files) = _list_dir(dirname, skip_symlinks)
+                except (OSError, IOError):
+                    (dirs, files) = ([], [])
+                lock.acquire()
+                outstanding[0] += len(dirs) - 1
+                done = not outstanding[0]
+                lock.release()
+                for subdir in dirs:
+                    todo.put(subdir)
+                if files:
+                    found.put(files)
+                if done:
+                    found.put(None)
+            except:
+                found.put(sys.exc_info())
+                return
+
+    todo.put(top)
+    for num in range(threads):
+        thread = threading.Thread(target=lister)
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        while True:
+            files = found.get()
+            if files is None:
+                break
+            if isinstance(files, tuple):
+                raise files[0], files[1], files[2]
+            yield files
+    finally:
+        # however the walk ended, let the listers go
+        stopped.append(True)
+        for num in range(threads):
+            todo.put(None)
+
+def walk_files(top, ext, skip_symlinks=False, threads=1):
+    """generator of the files under top (relative to it) ending in ext,
+       case insensitively, in no particular order. With threads > 1, that
+       many threads list directories at once - listing a directory doesn't
+       hold the GIL, and big trees are often on slow or network storage."""
+    top = top.rstrip('/') + '/'
+    ext = ext.lower()
+    extlen = len(ext)
+
+    if threads > 1:
+        batches = _walk_dirs_threaded(top, skip_symlinks, threads)
+    else:
+        def walk(dirname):
+            try:
+                (dirs, files) = _list_dir(dirname, skip_symlinks)
+            except (OSError, IOError):
+                return
+            yield files
+            for subdir in dirs:
+                for files in walk(subdir):
+                    yield files
+        batches = walk(top)
+
+    for files in batches:
+        for fn in files:
+            if fn[-extlen:].lower() == ext:
+                yield fn[len(top):]
+
+def compile_globs(globs):
+    """return a function telling whether a path matches any of the globs, as
+       fnmatch.fnmatch() would, with a single regex for all of them. None if
+       there are no globs"""
+    if not globs:
+        return None
+    return re.compile('|'.join(['(?:%s)' % fnmatch.translate(glob)
+                                for glob in globs])).match
+
 def returnFD(filename):
     try:
         fdno = os.open(filename, os.O_RDONLY)
@@ -168,10 +476,12 @@ def checkAndMakeDir(directory):
             result = True
     return result
 
-def checksum_and_rename(fn_path, sumtype='sha256'):
+def checksum_and_rename(fn_path, sumtype='sha256', csum=None):
     """checksum the file rename the file to contain the checksum as a prefix
-       return the new filename"""
-    csum = misc.checksum(sumtype, fn_path)
+       return the new filename. csum saves the checksumming, if it's
+       already known"""
+    if csum is None:
+        csum = misc.checksum(sumtype, fn_path)
     fn = os.path.basename(fn_path)
     fndir = os.path.dirname(fn_path)
     fn_match = re.match(r'[0-9A-Fa-f]{32,128}-(.+)', fn)
@@ -0,0 +1,628 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# pool of worker.py processes reading packages for the MetaDataGenerator
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import resource
+import struct
+import subprocess
+import traceback
+import marshal
+import multiprocessing
+import multiprocessing.util
+import multiprocessing.queues
+import Queue
+from collections import deque
+from select import select
+
+import rpmUtils.transaction
+from yum import Errors
+
+import cache
+import yumbased
+from utils import MDError
+
+#  Results come back from the workers on a pipe of their own (--resultfd), in
+# frames of: the index of the package in the order it was handed to the
+# worker, a status, the seconds spent on it, the worker's peak rss and how
+# much reading the package raised it (in kB), and the number of parts, then
+# the length of each part followed by the parts (the primary, filelists and
+# other xml, then anything else asked for)
+_FRAME_HEADER = struct.Struct('>IBdIIH')
+_PART_LENGTH = struct.Struct('>I')
+
+#  Given a shard dir, the workers don't send the parts down the pipe: each
+# appends its frames to a shard file of its own, in a dir of its own in
+# there, and sends the frame without them. So neither side waits on the
+# other however slowly the parent writes out the metadata, and the parent
+# only holds on to where the results are until it's their turn.
+SHARD_FILE = 'results'
+
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+
+
+def max_rss():
+    """the peak rss of this process so far, in kB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def read_package(ts, reldir, pkgfile, external_data, sumtype=None,
+                 clog_limit=None, sqlite=False):
+    """read pkgfile for the workers, returns (status, parts, error message)
+       where parts are the primary, filelists and other xml, the marshalled
+       yumbased.manifest_info(), the marshalled {stage: seconds} spent on it
+       (see timing.py) and the marshalled sqlite rows if asked for. The
+       filelists xml is a generator of chunks, made as write_result()
+       writes it out"""
+    pkgpath = reldir + '/' + pkgfile
+    if not os.path.exists(pkgpath):
+        return (STATUS_NOT_FOUND, [], "File not found: %s" % pkgpath)
+
+    try:
+        pkg = yumbased.CreateRepoPackage(ts, package=pkgpath,
+                                         sumtype=sumtype,
+                                         external_data=external_data,
+                                         clog_limit=clog_limit)
+        stages = dict(pkg._read_times)
+        start = time.time()
+        parts = [pkg.xml_dump_primary_metadata(),
+                 pkg.xml_dump_filelists_chunks(),
+                 pkg.xml_dump_other_metadata(clog_limit=clog_limit),
+                 marshal.dumps(yumbased.manifest_info(pkg))]
+        stages['xml'] = time.time() - start
+        if sqlite:
+            start = time.time()
+            rows = marshal.dumps(yumbased.sqlite_rows(pkg, clog_limit))
+            stages['sqlite_rows'] = time.time() - start
+        parts.append(marshal.dumps(stages))
+        if sqlite:
+            parts.append(rows)
+    except Errors.YumBaseError, e:
+        return (STATUS_ERROR, [], "Error: %s" % e)
+    except Exception:
+        # one bad package mustn't take the worker down with it
+        return (STATUS_ERROR, [], "Error: %s: %s" % (pkgfile,
+                ''.join(traceback.format_exception(*sys.exc_info())).strip()))
+    return (STATUS_OK, parts, None)
+
+
+def pack_result(index, status, elapsed, maxrss, rss_rise, parts=()):
+    """return the frame for a package's result"""
+    frame = [_FRAME_HEADER.pack(index, status, elapsed, maxrss, rss_rise,
+                                len(parts))]
+    frame.extend([_PART_LENGTH.pack(len(part)) for part in parts])
+    frame.extend(parts)
+    return ''.join(frame)
+
+
+def write_frame(fd, frame):
+    """write all of frame to fd"""
+    while frame:
+        frame = frame[os.write(fd, frame):]
+
+
+def join_part(part):
+    """part, which may be an iterable of chunks, as a string"""
+    if isinstance(part, basestring):
+        return part
+    return ''.join(part)
+
+
+def write_result(fd, index, status, elapsed, maxrss, rss_rise, parts):
+    """write the frame of a package's result to fd, as pack_result() makes
+       it. parts may be iterables of chunks too, which are written out as
+       they come if fd is a file (a shard) rather than a pipe. If making
+       them fails, the shard is cut back to where the frame started"""
+    try:
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+    except OSError:
+        write_frame(fd, pack_result(index, status, elapsed, maxrss, rss_rise,
+                                    [join_part(part) for part in parts]))
+        return
+    # the lengths are filled in once they are known
+    write_frame(fd, _FRAME_HEADER.pack(index, status, elapsed, maxrss,
+                                       rss_rise, len(parts)) +
+                    '\0' * (len(parts) * _PART_LENGTH.size))
+    lengths = []
+    try:
+        for part in parts:
+            if isinstance(part, basestring):
+                part = (part,)
+            length = 0
+            for chunk in part:
+                write_frame(fd, chunk)
+                length += len(chunk)
+            lengths.append(length)
+    except:
+        os.ftruncate(fd, start)
+        os.lseek(fd, start, os.SEEK_SET)
+        raise
+    end = os.lseek(fd, 0, os.SEEK_CUR)
+    os.lseek(fd, start + _FRAME_HEADER.size, os.SEEK_SET)
+    write_frame(fd, struct.pack('>%dI' % len(lengths), *lengths))
+    os.lseek(fd, end, os.SEEK_SET)
+
+
+def open_shard(filename):
+    """open a shard for reading while its worker is still writing to it.
+       Unbuffered: write_result() fills in the lengths of a frame after
+       writing its parts, and a buffer read ahead could still hold the
+       zeros from before"""
+    return open(filename, 'rb', 0)
+
+
+def read_shard_frame(fo, offset):
+    """read the frame at offset in the shard file fo, returns (spans, end)
+       where spans are the (offset, length) of its parts and end is where
+       the next frame starts"""
+    fo.seek(offset)
+    header = fo.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        raise MDError, "Worker shard %s is truncated" % fo.name
+    nparts = _FRAME_HEADER.unpack(header)[-1]
+    lengths = fo.read(nparts * _PART_LENGTH.size)
+    if len(lengths) < nparts * _PART_LENGTH.size:
+        raise MDError, "Worker shard %s is truncated" % fo.name
+    pos = offset + len(header) + len(lengths)
+    spans = []
+    for length in struct.unpack('>%dI' % nparts, lengths):
+        spans.append((pos, length))
+        pos += length
+    return (spans, pos)
+
+
+class ShardParts(object):
+    """the parts of a result, read from the shard file they are in only
+       when they're asked for"""
+
+    def __init__(self, fo, spans):
+        self.fo = fo
+        self.spans = spans
+
+    def __len__(self):
+        return len(self.spans)
+
+    def _read(self, span):
+        (offset, length) = span
+        self.fo.seek(offset)
+        part = self.fo.read(length)
+        if len(part) < length:
+            raise MDError, "Worker shard %s is truncated" % self.fo.name
+        return part
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._read(span) for span in self.spans[item]]
+        return self._read(self.spans[item])
+
+    def chunks(self, item, chunk_size=2**20):
+        """generator of part item in chunks of up to chunk_size"""
+        (offset, length) = self.spans[item]
+        while length > 0:
+            chunk = self._read((offset, min(length, chunk_size)))
+            offset += len(chunk)
+            length -= len(chunk)
+            yield chunk
+
+
+class FrameReader(object):
+    """Reassembles result frames from whatever chunks of the pipe we get"""
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        # bytes needed before the next frame can be complete
+        self.need = _FRAME_HEADER.size
+
+    def feed(self, data):
+        """add data, returns the list of (index, status, elapsed, maxrss,
+           rss_rise, parts) of the frames now complete"""
+        self.chunks.append(data)
+        self.length += len(data)
+        if self.length < self.need:
+            # don't copy a big frame around every time a bit more arrives
+            return []
+
+        buf = ''.join(self.chunks)
+        frames = []
+        pos = 0
+        while True:
+            self.need = _FRAME_HEADER.size
+            if len(buf) - pos < self.need:
+                break
+            (index, status, elapsed, maxrss, rss_rise,
+             nparts) = _FRAME_HEADER.unpack_from(buf, pos)
+            self.need += nparts * _PART_LENGTH.size
+            if len(buf) - pos < self.need:
+                break
+            lengths = struct.unpack_from('>%dI' % nparts, buf,
+                                         pos + _FRAME_HEADER.size)
+            self.need += sum(lengths)
+            if len(buf) - pos < self.need:
+                break
+            start = pos + _FRAME_HEADER.size + nparts * _PART_LENGTH.size
+            parts = []
+            for length in lengths:
+                parts.append(buf[start:start + length])
+                start += length
+            frames.append((index, status, elapsed, maxrss, rss_rise, parts))
+            pos = start
+        buf = buf[pos:]
+        self.chunks = [buf]
+        self.length = len(buf)
+        return frames
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class WorkerPool(object):
+    """Runs a set of worker.py processes and hands packages out to them one
+       at a time as they become free, so a single huge package only ties up
+       the worker reading it.  Results come back in the order the workers
+       finish them - callers are expected to put them back in order using
+       the key they submitted each package with."""
+
+    # packages handed to a worker ahead of the one it is reading, so it never
+    # sits idle waiting on us
+    depth = 2
+
+    def __init__(self, cmdline, num_workers, callback, quiet=False,
+                 shard_dir=None):
+        self.callback = callback
+        self.started = time.time()
+        self.jobs = {}
+        self.inflight = {}
+        self.pending = deque()
+        self.finished = deque()
+        self.closed = False
+        # seconds each package took its worker, by key
+        self.timings = {}
+        # (peak rss of its worker after, how much it raised it) in kB, by key
+        self.memory = {}
+        # fd -> (worker, what comes out of it)
+        self._fds = {}
+        self._readers = {}
+        self._done = {}
+        self._logbufs = {}
+        # worker -> {'filename', 'fo', 'pos'} of the next frame in its shard
+        self._shards = {}
+
+        for num in range(num_workers):
+            if not quiet:
+                self.callback.log("Spawning worker %s" % num)
+            args = ['--stdin']
+            if shard_dir:
+                tmpmdpath = os.path.join(shard_dir, 'worker%d' % num)
+                os.mkdir(tmpmdpath)
+                args.append('--tmpmdpath=%s' % tmpmdpath)
+                self._shards[num] = {'pos': 0, 'fo': None,
+                    'filename': os.path.join(tmpmdpath, SHARD_FILE)}
+            (rfd, wfd) = os.pipe()
+            _set_cloexec(rfd)
+            args.append('--resultfd=%d' % wfd)
+            try:
+                job = subprocess.Popen(cmdline + args,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            finally:
+                os.close(wfd)
+            # workers spawned later must not inherit our end of this one's
+            # pipes, or it would never see EOF on stdin
+            for fo in (job.stdin, job.stdout, job.stderr):
+                _set_cloexec(fo.fileno())
+            self.jobs[num] = job
+            self.inflight[num] = deque()
+            self._done[num] = 0
+            self._fds[rfd] = (num, 'result')
+            self._fds[job.stdout.fileno()] = (num, 'log')
+            self._fds[job.stderr.fileno()] = (num, 'errorlog')
+            self._readers[rfd] = FrameReader()
+        self._open_fds = self._fds.keys()
+        for fd in self._fds:
+            self._logbufs[fd] = ''
+
+    def submit(self, key, pkgfile):
+        """queue pkgfile for reading, its result will be returned under key"""
+        self.pending.append((key, pkgfile))
+        self._dispatch()
+
+    def close(self):
+        """no more packages will be submitted"""
+        self.closed = True
+        self._dispatch()
+
+    def _dispatch(self):
+        for num, job in self.jobs.items():
+            if job.stdin.closed:
+                continue
+            while self.pending and len(self.inflight[num]) < self.depth:
+                key, pkgfile = self.pending.popleft()
+                try:
+                    job.stdin.write(pkgfile + '\n')
+                except IOError:
+                    # worker is gone, leave its share for the others
+                    self.pending.appendleft((key, pkgfile))
+                    job.stdin.close()
+                    break
+                self.inflight[num].append(key)
+            if self.closed and not self.pending and not job.stdin.closed:
+                job.stdin.close()
+
+    def _handle_frames(self, num, frames):
+        for (index, status, elapsed, maxrss, rss_rise, parts) in frames:
+            if index != self._done[num] or not self.inflight[num]:
+                raise MDError, "Worker %s sent a result out of order" % num
+            self._done[num] += 1
+            key = self.inflight[num].popleft()
+            self.timings[key] = elapsed
+            self.memory[key] = (maxrss, rss_rise)
+            if status == STATUS_OK:
+                if num in self._shards:
+                    parts = self._shard_parts(num)
+                self.finished.append((key, parts))
+            else:
+                self.finished.append((key, None))
+        if frames:
+            self._dispatch()
+
+    def _shard_parts(self, num):
+        """the parts of worker num's next result, from its shard"""
+        shard = self._shards[num]
+        if shard['fo'] is None:
+            shard['fo'] = open_shard(shard['filename'])
+        (spans, shard['pos']) = read_shard_frame(shard['fo'], shard['pos'])
+        return ShardParts(shard['fo'], spans)
+
+    def _handle_log(self, num, kind, lines):
+        for line in lines:
+            if kind == 'errorlog':
+                self.callback.errorlog('Worker %s: %s' % (num, line.rstrip()))
+            else:
+                self.callback.log('Worker %s: %s' % (num, line.rstrip()))
+
+    def _pump(self, timeout=None):
+        """read whatever the workers have for us, waiting up to timeout
+           seconds (forever if None) for something to arrive"""
+        for fd in select(self._open_fds, (), (), timeout)[0]:
+            (num, kind) = self._fds[fd]
+            data = os.read(fd, 2**16)
+            if kind == 'result':
+                self._handle_frames(num, self._readers[fd].feed(data))
+            else:
+                lines = (self._logbufs[fd] + data).split('\n')
+                self._logbufs[fd] = lines.pop()
+                if not data and self._logbufs[fd]:
+                    lines.append(self._logbufs[fd])
+                self._handle_log(num, kind, lines)
+            if not data:
+                self._open_fds.remove(fd)
+                if kind == 'result':
+                    os.close(fd)
+
+    def poll(self):
+        """take in what the workers have finished so far, without waiting.
+           Call now and then while submitting, or workers whose results
+           aren't collected stop"""
+        if self._open_fds:
+            self._pump(0)
+
+    def results(self):
+        """generator of (key, parts) as workers finish packages; parts is the
+           list (or ShardParts) of the primary, filelists and other xml (and
+           whatever else the workers were asked for) or None if the package
+           failed"""
+        while self._open_fds:
+            while self.finished:
+                yield self.finished.popleft()
+            self._pump()
+
+        while self.finished:
+            yield self.finished.popleft()
+
+        # workers which died on us never answered for what they were given,
+        # and nobody is left to take what was never handed out
+        for num in self.inflight:
+            while self.inflight[num]:
+                yield self.inflight[num].popleft(), None
+        while self.pending:
+            yield self.pending.popleft()[0], None
+
+    def wait(self):
+        """reap the workers, raising MDError if any of them failed"""
+        for shard in self._shards.values():
+            if shard['fo'] is not None:
+                shard['fo'].close()
+        for num, job in self.jobs.items():
+            if not job.stdin.closed:
+                job.stdin.close()
+            if job.wait() != 0:
+                msg = "Worker exited with non-zero value: %s. Fatal." % job.returncode
+                self.callback.errorlog(msg)
+                raise MDError, msg
+
+
+# what a ForkWorkerPool process reads packages with, see _fork_worker_init()
+_fork_worker = {}
+
+def _fork_worker_init(opts, started):
+    _fork_worker.update(opts)
+    _fork_worker['started'] = started
+    _fork_worker['ts'] = rpmUtils.transaction.initReadOnlyTransaction()
+    if opts.get('shard_dir'):
+        tmpmdpath = os.path.join(opts['shard_dir'], 'worker%d' % os.getpid())
+        os.mkdir(tmpmdpath)
+        _fork_worker['shard'] = os.path.join(tmpmdpath, SHARD_FILE)
+        _fork_worker['shard_fd'] = os.open(_fork_worker['shard'],
+                                           os.O_WRONLY | os.O_CREAT, 0600)
+    cachedir = opts['external_data'].get('_cachedir')
+    if cachedir:
+        # share the parent's run id, so it can tell what we used and added
+        cache.get_checksum_cache(cachedir, opts['sumtype'], opts['cache_run'])
+    # pool processes leave through os._exit(), never running atexit handlers
+    multiprocessing.util.Finalize(None, cache.flush_checksum_caches,
+                                  exitpriority=10)
+
+def _fork_worker_read(key, pkgfile):
+    # so the parent knows what was lost if we die
+    _fork_worker['started'].put((key, os.getpid()))
+    start = time.time()
+    start_rss = max_rss()
+    try:
+        (status, parts, msg) = read_package(_fork_worker['ts'],
+                                     _fork_worker['reldir'], pkgfile,
+                                     _fork_worker['external_data'],
+                                     sumtype=_fork_worker['sumtype'],
+                                     clog_limit=_fork_worker['clog_limit'],
+                                     sqlite=_fork_worker['sqlite'])
+        shard = None
+        if status == STATUS_OK and 'shard_fd' in _fork_worker:
+            fd = _fork_worker['shard_fd']
+            shard = (_fork_worker['shard'], os.lseek(fd, 0, os.SEEK_CUR))
+            write_result(fd, 0, status, 0, 0, 0, parts)
+            parts = []
+        else:
+            parts = [join_part(part) for part in parts]
+    except:
+        # anything escaping would leave the parent waiting for this result
+        (status, parts, shard) = (STATUS_ERROR, [], None)
+        msg = "Error: %s: %s" % (pkgfile,
+                 ''.join(traceback.format_exception(*sys.exc_info())).strip())
+    rss = max_rss()
+    return (key, status, time.time() - start, (rss, rss - start_rss), parts,
+            shard, msg)
+
+
+def _pid_alive(pid):
+    """whether our child pid is still there. The pool reaps its workers
+       when they die, a zombie not yet reaped is still alive here"""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+class ForkWorkerPool(object):
+    """WorkerPool lookalike reading the packages in processes forked from
+       this one by multiprocessing, so they start with yum and rpm already
+       imported rather than each running worker_cmd from scratch. opts are
+       the reldir, external_data (the --pkgoptions of worker.py), sumtype,
+       clog_limit, cache_run, sqlite and shard_dir (see SHARD_FILE)."""
+
+    def __init__(self, num_workers, callback, opts, quiet=False):
+        self.callback = callback
+        self.started = time.time()
+        self.submitted = 0
+        self.closed = False
+        # seconds each package took its worker, by key
+        self.timings = {}
+        # (peak rss of its worker after, how much it raised it) in kB, by key
+        self.memory = {}
+        self.finished = Queue.Queue()
+        # filename -> open shard file
+        self._shards = {}
+        #  multiprocessing replaces a process which dies and forgets its task,
+        # so the workers say which package they're starting on, and the pid
+        # of the one reading each package not yet returned is kept here
+        self._started = multiprocessing.queues.SimpleQueue()
+        self._reading = {}
+        if not quiet:
+            self.callback.log("Forking %s workers" % num_workers)
+        self.pool = multiprocessing.Pool(num_workers, _fork_worker_init,
+                                         (opts, self._started))
+
+    def submit(self, key, pkgfile):
+        """queue pkgfile for reading, its result will be returned under key"""
+        self.submitted += 1
+        self.pool.apply_async(_fork_worker_read, (key, pkgfile),
+                              callback=self.finished.put)
+
+    def close(self):
+        """no more packages will be submitted"""
+        self.closed = True
+        self.pool.close()
+
+    def poll(self):
+        """nothing to do, results are collected by multiprocessing's thread"""
+        pass
+
+    def results(self):
+        """generator of (key, parts) as workers finish packages, see
+           WorkerPool.results()"""
+        received = 0
+        lost = set()
+        while not self.closed or received < self.submitted:
+            while not self._started.empty():
+                (key, pid) = self._started.get()
+                if key not in self.timings:
+                    self._reading[key] = pid
+            try:
+                # time out now and then, a plain get() can't be interrupted
+                (key, status, elapsed, memory, parts, shard,
+                 msg) = self.finished.get(True, 1)
+            except Queue.Empty:
+                lost = self._check_lost(lost)
+                continue
+            received += 1
+            self._reading.pop(key, None)
+            lost.discard(key)
+            self.timings[key] = elapsed
+            self.memory[key] = memory
+            if msg:
+                self.callback.errorlog('Worker: %s' % msg)
+            if status != STATUS_OK:
+                yield key, None
+                continue
+            if shard is not None:
+                (filename, offset) = shard
+                if filename not in self._shards:
+                    self._shards[filename] = open_shard(filename)
+                fo = self._shards[filename]
+                parts = ShardParts(fo, read_shard_frame(fo, offset)[0])
+            yield key, parts
+
+    def _check_lost(self, suspects):
+        """return the packages whose workers are gone, raising MDError for
+           those which were already in suspects: their results would have
+           come in by now"""
+        gone = set([key for (key, pid) in self._reading.items()
+                    if not _pid_alive(pid)])
+        for key in gone & suspects:
+            msg = "Worker %d died reading %s. Fatal." % (self._reading[key],
+                                                         key)
+            self.callback.errorlog(msg)
+            self.pool.terminate()
+            raise MDError, msg
+        return gone
+
+    def wait(self):
+        """reap the workers"""
+        if not self.closed:
+            self.close()
+        self.pool.join()
+        for fo in self._shards.values():
+            fo.close()
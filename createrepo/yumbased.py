@@ -16,87 +16,341 @@
 
 
 import os
-def _get_umask():
-   oumask = os.umask(0)
-   os.umask(oumask)
-   return oumask
-_b4rpm_oumask = _get_umask()
+import re
+import cache
 import rpm
-import types
+import time
+import struct
+from operator import itemgetter
+from xml.sax import saxutils
 
-from yum.packages import YumLocalPackage
+from yum.packages import YumLocalPackage, YumHeaderPackage, FakeRepository
 from yum.Errors import *
 from yum import misc
+from rpmUtils.miscutils import compareVerOnly
 import utils
-import tempfile
+
+# lead and header magic, see rpm's lib/rpmlead.c and lib/header.c
+_RPM_LEAD_MAGIC = '\xed\xab\xee\xdb'
+_RPM_HEADER_MAGIC = '\x8e\xad\xe8\x01'
+_RPM_LEAD_SIZE = 96
+# signature header tags which rpm merges into the main header when reading
+# a package and which we have to look up ourselves
+_RPMSIGTAG_DSA = 267
+_RPMSIGTAG_RSA = 268
+_RPMSIGTAG_SHA1 = 269
+_RPMSIGTAG_LONGARCHIVESIZE = 271
+_RPMSIGTAG_PGP = 1002
+_RPMSIGTAG_GPG = 1005
+_RPMSIGTAG_PAYLOADSIZE = 1007
+# main header tags of the changelog, parallel arrays, newest entry first
+_RPMTAG_CHANGELOGTIME = 1080
+_RPMTAG_CHANGELOGNAME = 1081
+_RPMTAG_CHANGELOGTEXT = 1082
+
+# big enough for the lead, signature and header of nearly every package
+_HEADER_READ_SIZE = 2**18
+_CHECKSUM_READ_SIZE = 2**20
+# about how much of the filelists xml of a package to make at a time
+_FILELISTS_CHUNK_SIZE = 2**16
+
+
+def _header_byte_range(data):
+    """return (hdrstart, hdrend) for a package starting with data, either
+       may be None if data is too short to tell yet"""
+    if len(data) < _RPM_LEAD_SIZE + 16:
+        return None, None
+    if data[:4] != _RPM_LEAD_MAGIC or \
+           data[_RPM_LEAD_SIZE:_RPM_LEAD_SIZE + 4] != _RPM_HEADER_MAGIC:
+        raise MiscError, 'not an rpm package'
+    # each index entry is 4 32bit ints, and the signature is padded out to
+    # the next 8 byte boundary
+    (sigindex, sigdata) = struct.unpack('>II', data[104:112])
+    sigsize = sigindex * 16 + sigdata
+    hdrstart = 112 + sigsize + (8 - sigsize % 8) % 8
+    if len(data) < hdrstart + 16:
+        return hdrstart, None
+    if data[hdrstart:hdrstart + 4] != _RPM_HEADER_MAGIC:
+        raise MiscError, 'bad header magic'
+    (hdrindex, hdrdata) = struct.unpack('>II', data[hdrstart + 8:hdrstart + 16])
+    hdrend = hdrstart + 16 + hdrindex * 16 + hdrdata
+    return hdrstart, hdrend
+
+
+def _signature_tags(data):
+    """return {tag: value} of the signature header tags we care about, from
+       a package starting with data. Binary and string tags are returned as
+       strings, integer ones as an int"""
+    (sigindex, sigdata) = struct.unpack('>II', data[104:112])
+    store = 112 + sigindex * 16
+    tags = {}
+    for i in range(sigindex):
+        entry = 112 + i * 16
+        (tag, tagtype, offset, count) = struct.unpack('>IIII',
+                                                      data[entry:entry + 16])
+        if tag in (_RPMSIGTAG_PGP, _RPMSIGTAG_GPG, _RPMSIGTAG_DSA,
+                   _RPMSIGTAG_RSA) and tagtype == 7: # BIN
+            tags[tag] = data[store + offset:store + offset + count]
+        elif tag == _RPMSIGTAG_SHA1 and tagtype == 6: # STRING
+            end = data.find('\0', store + offset)
+            if end != -1:
+                tags[tag] = data[store + offset:end]
+        elif tag == _RPMSIGTAG_PAYLOADSIZE and tagtype == 4: # INT32
+            (tags[tag],) = struct.unpack('>I', data[store + offset:
+                                                    store + offset + 4])
+        elif tag == _RPMSIGTAG_LONGARCHIVESIZE and tagtype == 5: # INT64
+            (tags[tag],) = struct.unpack('>Q', data[store + offset:
+                                                    store + offset + 8])
+    return tags
+
+
+def _header_changelog(hdr, limit):
+    """return the newest limit changelog entries of the header blob hdr (with
+       the magic) like YumHeaderPackage.returnChangelog() does, decoding only
+       those rather than all of the arrays. Returns None if the header
+       doesn't look like we expect, for rpm to deal with"""
+    (hdrindex, hdrdata) = struct.unpack('>II', hdr[8:16])
+    store = 16 + hdrindex * 16
+    tags = {}
+    for i in range(hdrindex):
+        entry = 16 + i * 16
+        (tag, tagtype, offset, count) = struct.unpack('>IIII',
+                                                      hdr[entry:entry + 16])
+        if tag in (_RPMTAG_CHANGELOGTIME, _RPMTAG_CHANGELOGNAME,
+                   _RPMTAG_CHANGELOGTEXT):
+            tags[tag] = (tagtype, store + offset, count)
+    if not tags:
+        return []
+    if len(tags) != 3 or tags[_RPMTAG_CHANGELOGTIME][0] != 4 or \
+           tags[_RPMTAG_CHANGELOGNAME][0] != 8 or \
+           tags[_RPMTAG_CHANGELOGTEXT][0] != 8: # INT32, STRING_ARRAY
+        return None
+    counts = set([count for (tagtype, offset, count) in tags.values()])
+    if len(counts) != 1:
+        return None
+    num = min(limit, counts.pop())
+
+    offset = tags[_RPMTAG_CHANGELOGTIME][1]
+    if offset + num * 4 > len(hdr):
+        return None
+    times = struct.unpack('>%dI' % num, hdr[offset:offset + num * 4])
+    strings = []
+    for tag in (_RPMTAG_CHANGELOGNAME, _RPMTAG_CHANGELOGTEXT):
+        offset = tags[tag][1]
+        items = []
+        for i in range(num):
+            end = hdr.find('\0', offset)
+            if end == -1:
+                return None
+            items.append(hdr[offset:end])
+            offset = end + 1
+        strings.append(items)
+    return zip(times, strings[0], strings[1])
+
 
 class CreateRepoPackage(YumLocalPackage):
-    def __init__(self, ts, package, sumtype=None, external_data={}):
-        YumLocalPackage.__init__(self, ts, package)
+    def __init__(self, ts, package, sumtype=None, external_data={},
+                 header_only=False, clog_limit=None):
+        """read the package at path package. Unlike YumLocalPackage, which has
+           rpm read the header and then reopens the file for the header byte
+           range and again for the checksum, the file is opened once: the
+           lead, signature and header are read in one go and the checksum is
+           computed carrying on from there. ts is unused, it is only kept for
+           API compatibility.
+           header_only skips the checksum, it is then computed (from scratch)
+           the first time it is asked for.
+           clog_limit makes the changelog only the newest clog_limit
+           entries, which are all that are decoded from the header."""
+        self.pkgtype = 'local'
+        self.localpath = package
+        self._checksum = None
+        self.checksum_type = misc._default_checksums[0]
         if sumtype:
             self.checksum_type = sumtype
-        
-        if external_data:
-            for (key, val) in external_data.items():
-                setattr(self, key, val)
-                
+
+        try:
+            fd = os.open(self.localpath, os.O_RDONLY)
+        except OSError, e:
+            raise MiscError, 'Could not open local rpm file: %s: %s' % (
+                                                            self.localpath, e)
+        try:
+            start = time.time()
+            self._stat = os.fstat(fd)
+            data = self._read_header(fd)
+            self._clog_limit = clog_limit
+            self._clog = None
+            self._clog_hdr = None
+            if clog_limit:
+                self._clog_hdr = data[self._hdrstart:self._hdrend]
+
+            fakerepo = FakeRepository(package)
+            fakerepo.cost = 0
+            YumHeaderPackage.__init__(self, fakerepo, self.hdr)
+            self.id = self.pkgid
+            self.filetime = str(self._stat[-2])
+            self.packagesize = str(self._stat[6])
+            self.arch = self.isSrpm()
+            self.pkgtup = (self.name, self.arch, self.epoch, self.ver, self.rel)
+
+            # these can be set by callers that need these features (ex: createrepo)
+            self._reldir = None
+            self._baseurl = ""
+            self._packagenumber = None
+            self._cachedir = None
+            if external_data:
+                for (key, val) in external_data.items():
+                    setattr(self, key, val)
+
+            # seconds reading the header and checksumming, for --profile
+            self._read_times = {'header': time.time() - start}
+
+            if not header_only:
+                start = time.time()
+                self._checksum = self._read_cached_checksum()
+                if self._checksum is None:
+                    csum = misc.Checksums([self.checksum_type])
+                    csum.update(data)
+                    del data
+                    while True:
+                        chunk = os.read(fd, _CHECKSUM_READ_SIZE)
+                        if not chunk:
+                            break
+                        csum.update(chunk)
+                    self._checksum = csum.hexdigest()
+                    self._write_cached_checksum(self._checksum)
+                self._checksums = [(self.checksum_type, self._checksum, 1)]
+                self._read_times['checksum'] = time.time() - start
+        finally:
+            os.close(fd)
+
+    def _read_header(self, fd):
+        """read up to the end of the header from fd, setting up self.hdr, the
+           signature tags and the header byte range. Returns all the data
+           read so the checksum can carry on from it"""
+        data = os.read(fd, _HEADER_READ_SIZE)
+        (hdrstart, hdrend) = _header_byte_range(data)
+        while hdrend is None or len(data) < hdrend:
+            if hdrend is None:
+                want = _HEADER_READ_SIZE
+            else:
+                want = hdrend - len(data)
+            chunk = os.read(fd, want)
+            if not chunk:
+                raise MiscError, 'Could not open local rpm file: %s: ' \
+                                 'truncated package' % self.localpath
+            data += chunk
+            (hdrstart, hdrend) = _header_byte_range(data)
+
+        self._hdrstart = hdrstart
+        self._hdrend = hdrend
+        self._sigtags = _signature_tags(data)
+        try:
+            # headerLoad() wants the blob without the magic and reserved bytes
+            self.hdr = rpm.headerLoad(data[hdrstart + 8:hdrend])
+        except (rpm.error, TypeError), e:
+            raise MiscError, 'Could not open local rpm file: %s: %s' % (
+                                                            self.localpath, e)
+        if self.hdr is None:
+            raise MiscError, 'Could not open local rpm file: %s: bad header' \
+                             % self.localpath
+        return data
+
+    def _get_archivesize(self):
+        # rpm only merges this in from the signature when it reads the package
+        size = self.hdr[rpm.RPMTAG_ARCHIVESIZE]
+        if not size:
+            # payloads over 4GB only have the 64bit one
+            size = self._sigtags.get(_RPMSIGTAG_LONGARCHIVESIZE,
+                                     self._sigtags.get(_RPMSIGTAG_PAYLOADSIZE))
+        return size
+
+    archivesize = property(fget=lambda self: self._get_archivesize())
+
+    def returnChangelog(self):
+        """with a clog_limit, the newest entries, decoded straight from the
+           header the first time they're asked for"""
+        if not self._clog_limit:
+            return YumLocalPackage.returnChangelog(self)
+        if self._clog is None:
+            self._clog = _header_changelog(self._clog_hdr, self._clog_limit)
+            if self._clog is None:
+                self._clog = YumLocalPackage.returnChangelog(self)
+                self._clog = self._clog[:self._clog_limit]
+            self._clog_hdr = None
+        return self._clog
+
+    def xml_dump_filelists_chunks(self):
+        """generator of the filelists xml of the package in chunks, the same
+           as xml_dump_filelists_metadata() makes in one go. With a few
+           hundred thousand files (texlive, kernel-devel) that's tens of MB,
+           which this never holds all of at once"""
+        buf = ['\n<package pkgid="%s" name="%s" arch="%s">\n'
+               '    <version epoch="%s" ver="%s" rel="%s"/>\n\n' % (
+               self.checksum, self.name, self.arch, self.epoch, self.ver,
+               self.rel)]
+        buflen = len(buf[0])
+        for (filetype, fmt) in (('file', '    <file>%s</file>\n'),
+                    ('dir', '    <file type="dir">%s</file>\n'),
+                    ('ghost', '    <file type="ghost">%s</file>\n')):
+            for fn in self.returnFileEntries(filetype):
+                line = fmt % misc.to_xml(fn)
+                buf.append(line)
+                buflen += len(line)
+                if buflen >= _FILELISTS_CHUNK_SIZE:
+                    yield ''.join(buf)
+                    buf = []
+                    buflen = 0
+        buf.append('</package>\n')
+        yield ''.join(buf)
+
+    def xml_dump_filelists_metadata(self):
+        return ''.join(self.xml_dump_filelists_chunks())
+
+    def _checksum_cache_key(self):
+        """return the key identifying this package's header and signatures
+           in the checksum cache"""
+        #  what rpm merged into the header used to give us as SIGGPG, SIGPGP
+        # and HDRID, then the RSA/DSA header signatures, which are all some
+        # packages have
+        t = []
+        for tag in (_RPMSIGTAG_GPG, _RPMSIGTAG_PGP, _RPMSIGTAG_SHA1,
+                    _RPMSIGTAG_DSA, _RPMSIGTAG_RSA):
+            if tag in self._sigtags:
+                t.append(self._sigtags[tag])
+
+        kcsum = misc.Checksums(checksums=[self.checksum_type])
+        kcsum.update("".join(t))
+        return kcsum.hexdigest()
+
+    def _read_cached_checksum(self):
+        if not self._cachedir:
+            return None
+        csum_cache = cache.get_checksum_cache(self._cachedir, self.checksum_type)
+        return csum_cache.get(self._stat, self._checksum_cache_key())
+
+    def _write_cached_checksum(self, checksum):
+        if not self._cachedir:
+            return
+        csum_cache = cache.get_checksum_cache(self._cachedir, self.checksum_type)
+        csum_cache.put(self._stat, self._checksum_cache_key(), checksum)
 
     def _do_checksum(self):
         """return a checksum for a package:
-           - check if the checksum cache is enabled
+           - normally it was computed while reading the package
+           - otherwise check if the checksum cache is enabled
               if not - return the checksum
-              if so - check to see if it has a cache file
-                if so, open it and return the first line's contents
-                if not, grab the checksum and write it to a file for this pkg
+              if so - check to see if it has an entry for this pkg
+                if so, return it
+                if not, grab the checksum and add it to the cache
          """
         # already got it
         if self._checksum:
             return self._checksum
 
-        # not using the cachedir
-        if not hasattr(self, '_cachedir') or not self._cachedir:
-            self._checksum = misc.checksum(self.checksum_type, self.localpath)
-            self._checksums = [(self.checksum_type, self._checksum, 1)]
-            return self._checksum
-
-
-        t = []
-        if type(self.hdr[rpm.RPMTAG_SIGGPG]) is not types.NoneType:
-            t.append("".join(self.hdr[rpm.RPMTAG_SIGGPG]))
-        if type(self.hdr[rpm.RPMTAG_SIGPGP]) is not types.NoneType:
-            t.append("".join(self.hdr[rpm.RPMTAG_SIGPGP]))
-        if type(self.hdr[rpm.RPMTAG_HDRID]) is not types.NoneType:
-            t.append("".join(self.hdr[rpm.RPMTAG_HDRID]))
-
-        kcsum = misc.Checksums(checksums=[self.checksum_type])
-        kcsum.update("".join(t))
-        key = kcsum.hexdigest()
-
-        csumtag = '%s-%s-%s-%s' % (os.path.basename(self.localpath),
-                                   key, self.size, self.filetime)
-        csumfile = '%s/%s' % (self._cachedir, csumtag)
-
-        if os.path.exists(csumfile) and float(self.filetime) <= float(os.stat(csumfile)[-2]):
-            csumo = open(csumfile, 'r')
-            checksum = csumo.readline()
-            csumo.close()
-
-        else:
+        checksum = self._read_cached_checksum()
+        if checksum is None:
             checksum = misc.checksum(self.checksum_type, self.localpath)
-
-            #  This is atomic cache creation via. rename, so we can have two
-            # tasks using the same cachedir ... mash does this.
-            try:
-                (csumo, tmpfilename) = tempfile.mkstemp(dir=self._cachedir)
-                csumo = os.fdopen(csumo, 'w', -1)
-                csumo.write(checksum)
-                csumo.close()
-                #  tempfile forces 002 ... we want to undo that, so that users
-                # can share the cache. BZ 833350.
-                os.chmod(tmpfilename, 0666 ^ _b4rpm_oumask)
-                os.rename(tmpfilename, csumfile)
-            except:
-                pass
+            self._write_cached_checksum(checksum)
 
         self._checksum = checksum
         self._checksums = [(self.checksum_type, checksum, 1)]
@@ -105,133 +359,26 @@ class CreateRepoPackage(YumLocalPackage):
 
     # sqlite-direct dump code below here :-/
 
-    def _sqlite_null(self, item):
-        if not item:
-            return None
-        return item
-
     def do_primary_sqlite_dump(self, cur):
         """insert primary data in place, this assumes the tables exist"""
-        if self.crp_reldir and self.localpath.startswith(self.crp_reldir):
-            relpath = self.localpath.replace(self.crp_reldir, '')
-            if relpath[0] == '/': relpath = relpath[1:]
-        else:
-            relpath = self.localpath
-
-        p = (self.crp_packagenumber, self.checksum, self.name, self.arch,
-            self.version, self.epoch, self.release, self.summary.strip(),
-            self.description.strip(), self._sqlite_null(self.url), self.filetime,
-            self.buildtime, self._sqlite_null(self.license),
-            self._sqlite_null(self.vendor), self._sqlite_null(self.group),
-            self._sqlite_null(self.buildhost), self._sqlite_null(self.sourcerpm),
-            self.hdrstart, self.hdrend, self._sqlite_null(self.packager),
-            self.packagesize, self.size, self.archivesize, relpath,
-            self.crp_baseurl, self.checksum_type)
-
-        q = """insert into packages values (?, ?, ?, ?, ?, ?,
-               ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?, ?,
-               ?, ?, ?)"""
-
-        # write out all of do_primary_sqlite as an executescript - work on the
-        # quoting for pretty much any contingency - take from sqlutils.py
-        #
-        # e
-        #p = None
-        #q = """insert into packages values (%s, %s, %s, %s, """
-
-        cur.execute(q, p)
-
-        # provides, obsoletes, conflicts
-        for pco in ('obsoletes', 'provides', 'conflicts'):
-            thispco = []
-            for (name, flag, (epoch, ver, rel)) in getattr(self, pco):
-                thispco.append((name, flag, epoch, ver, rel, self.crp_packagenumber))
-
-            q = "insert into %s values (?, ?, ?, ?, ?, ?)" % pco
-            cur.executemany(q, thispco)
-
-        # requires
-        reqs = []
-        for (name, flag, (epoch, ver, rel), pre) in self._requires_with_pre():
-            if name.startswith('rpmlib('):
-                continue
-            pre_bool = 'FALSE'
-            if pre == 1:
-                pre_bool = 'TRUE'
-            reqs.append((name, flag, epoch, ver,rel, self.crp_packagenumber, pre_bool))
-        q = "insert into requires values (?, ?, ?, ?, ?, ?, ?)"
-        cur.executemany(q, reqs)
-
-        # files
-        p = []
-        for f in self._return_primary_files():
-            p.append((f,))
-
-        if p:
-            q = "insert into files values (?, 'file', %s)" % self.crp_packagenumber
-            cur.executemany(q, p)
-
-        # dirs
-        p = []
-        for f in self._return_primary_dirs():
-            p.append((f,))
-        if p:
-            q = "insert into files values (?, 'dir', %s)" % self.crp_packagenumber
-            cur.executemany(q, p)
-
-
-        # ghosts
-        p = []
-        for f in self._return_primary_files(list_of_files = self.returnFileEntries('ghost')):
-            p.append((f,))
-        if p:
-            q = "insert into files values (?, 'ghost', %s)" % self.crp_packagenumber
-            cur.executemany(q, p)
-
-
+        batch = {}
+        add_sqlite_rows(batch, self._packagenumber, self.checksum,
+                        primary_sqlite_rows(self))
+        insert_sqlite_rows({'primary': cur}, batch)
 
     def do_filelists_sqlite_dump(self, cur):
         """inserts filelists data in place, this assumes the tables exist"""
-        # insert packagenumber + checksum into 'packages' table
-        q = 'insert into packages values (?, ?)'
-        p = (self.crp_packagenumber, self.checksum)
-
-        cur.execute(q, p)
-
-        # break up filelists and encode them
-        dirs = {}
-        for (filetype, files) in [('file', self.filelist), ('dir', self.dirlist),
-                                  ('ghost', self.ghostlist)]:
-            for filename in files:
-                (dirname,filename) = (os.path.split(filename))
-                if not dirs.has_key(dirname):
-                    dirs[dirname] = {'files':[], 'types':[]}
-                dirs[dirname]['files'].append(filename)
-                dirs[dirname]['types'].append(filetype)
-
-        # insert packagenumber|dir|files|types into files table
-        p = []
-        for (dirname,direc) in dirs.items():
-            p.append((self.crp_packagenumber, dirname,
-                 utils.encodefilenamelist(direc['files']),
-                 utils.encodefiletypelist(direc['types'])))
-        if p:
-            q = 'insert into filelist values (?, ?, ?, ?)'
-            cur.executemany(q, p)
-
-
-    def do_other_sqlite_dump(self, cur):
-        """inserts changelog data in place, this assumes the tables exist"""
-        # insert packagenumber + checksum into 'packages' table
-        q = 'insert into packages values (?, ?)'
-        p = (self.crp_packagenumber, self.checksum)
-
-        cur.execute(q, p)
-
-        if self.changelog:
-            q = 'insert into changelog ("pkgKey", "date", "author", "changelog") values (%s, ?, ?, ?)' % self.crp_packagenumber
-            cur.executemany(q, self.changelog)
+        batch = {}
+        add_sqlite_rows(batch, self._packagenumber, self.checksum,
+                        filelists_sqlite_rows(self))
+        insert_sqlite_rows({'filelists': cur}, batch)
 
+    def do_other_sqlite_dump(self, cur, clog_limit=None):
+        """inserts changelog data in place, this assumes the tables exist"""
+        batch = {}
+        add_sqlite_rows(batch, self._packagenumber, self.checksum,
+                        other_sqlite_rows(self, clog_limit))
+        insert_sqlite_rows({'other': cur}, batch)
 
     def do_sqlite_dump(self, md_sqlite):
         """write the metadata out to the sqlite dbs"""
@@ -241,3 +388,196 @@ class CreateRepoPackage(YumLocalPackage):
         md_sqlite.file_cx.commit()
         self.do_other_sqlite_dump(md_sqlite.other_cursor)
         md_sqlite.other_cx.commit()
+
+
+#  The rows below are what yum-metadata-parser stores when it reads the xml we
+# write for a package, so they work for any package object we can dump as xml
+# (including the old metadata's ones on --update). They're plain tuples, to be
+# marshalled from the workers, without the pkgKey which only the parent knows.
+# All but the packages row of primary are optional.
+
+_xml_unsafe = re.compile('[^\t\n\r\x20-\x7e]')
+
+def _sqlite_text(item):
+    """item as it comes back out of our xml"""
+    if not item:
+        return item
+    if type(item) is str and not _xml_unsafe.search(item):
+        # misc.to_xml() strips the end too
+        return item.rstrip()
+    return saxutils.unescape(misc.to_xml(item)).decode('utf-8')
+
+def _sqlite_null(item):
+    if not item:
+        return None
+    return _sqlite_text(item)
+
+def _sqlite_location(po):
+    """(href, base) of the <location> tag of po"""
+    if hasattr(po, '_reldir'):
+        # YumLocalPackage._return_remote_location()
+        if po._reldir and po.localpath.startswith(po._reldir):
+            relpath = po.localpath.replace(po._reldir, '')
+            if relpath[0] == '/': relpath = relpath[1:]
+        else:
+            relpath = po.localpath
+        return (relpath, po._baseurl or None)
+    return (po.relativepath, po.basepath or None)
+
+def _sqlite_requires(po):
+    """the requires yum's _dump_requires() puts into the xml, as
+       (name, flags, epoch, ver, rel, pre)"""
+    mylist = po._requires_with_pre()
+
+    if getattr(po, '_collapse_libc_requires', False):
+        libc_requires = [req for req in mylist
+                         if req[0].startswith('libc.so.6')]
+        if libc_requires:
+            rest = sorted(libc_requires, cmp=compareVerOnly,
+                          key=itemgetter(0))
+            best = rest.pop()
+            if len(rest) > 0 and best[0].startswith('libc.so.6()'):
+                # rpmvercmp sorts this one as 'highest'
+                best = rest.pop()
+            mylist = [req for req in mylist
+                      if not req[0].startswith('libc.so.6') or req == best]
+
+    reqs = []
+    for (name, flags, (epoch, ver, rel), pre) in mylist:
+        if name.startswith('rpmlib('):
+            continue
+        # this drops out requires that the pkg provides for itself.
+        if name in po.provides_names or \
+                (name.startswith('/') and \
+                     (name in po.filelist or name in po.dirlist or
+                      name in po.ghostlist)):
+            if not flags:
+                continue
+            elif po.checkPrco('provides', (name, flags, (epoch, ver, rel))):
+                continue
+        pre_bool = 'FALSE'
+        if pre:
+            pre_bool = 'TRUE'
+        reqs.append((_sqlite_text(name), flags, epoch, ver, rel, pre_bool))
+    return reqs
+
+def primary_sqlite_rows(po):
+    """return {table: [row, ...]} of po for primary.sqlite"""
+    (relpath, baseurl) = _sqlite_location(po)
+    rows = {}
+    rows['packages'] = [(po.checksum, _sqlite_text(po.name), po.arch,
+            po.ver, po.epoch, po.rel, _sqlite_text(po.summary),
+            _sqlite_text(po.description), _sqlite_null(po.url),
+            po.filetime, po.buildtime, _sqlite_null(po.license),
+            _sqlite_null(po.vendor), _sqlite_null(po.group),
+            _sqlite_null(po.buildhost), _sqlite_null(po.sourcerpm),
+            po.hdrstart, po.hdrend, _sqlite_null(po.packager),
+            po.packagesize, po.size, po.archivesize, _sqlite_text(relpath),
+            _sqlite_text(baseurl), po.checksum_type)]
+
+    # provides, obsoletes, conflicts
+    for pco in ('obsoletes', 'provides', 'conflicts'):
+        rows[pco] = [(_sqlite_text(name), flag, epoch, ver, rel)
+                     for (name, flag, (epoch, ver, rel)) in getattr(po, pco)]
+
+    rows['requires'] = _sqlite_requires(po)
+
+    files = []
+    for f in po._return_primary_files():
+        files.append((_sqlite_text(f), 'file'))
+    for f in po._return_primary_dirs():
+        files.append((_sqlite_text(f), 'dir'))
+    for f in po._return_primary_files(
+                            list_of_files=po.returnFileEntries('ghost')):
+        files.append((_sqlite_text(f), 'ghost'))
+    rows['files'] = files
+    return rows
+
+def filelists_sqlite_rows(po):
+    """return {table: [row, ...]} of po for filelists.sqlite"""
+    # break up filelists and encode them
+    dirs = {}
+    for (filetype, files) in [('file', po.filelist), ('dir', po.dirlist),
+                              ('ghost', po.ghostlist)]:
+        for filename in files:
+            (dirname,filename) = (os.path.split(filename))
+            if not dirs.has_key(dirname):
+                dirs[dirname] = {'files':[], 'types':[]}
+            dirs[dirname]['files'].append(filename)
+            dirs[dirname]['types'].append(filetype)
+
+    filelist = []
+    for (dirname,direc) in dirs.items():
+        filelist.append((_sqlite_text(dirname),
+             _sqlite_text(utils.encodefilenamelist(direc['files'])),
+             utils.encodefiletypelist(direc['types'])))
+    return {'filelist': filelist}
+
+def other_sqlite_rows(po, clog_limit=None):
+    """return {table: [row, ...]} of po for other.sqlite"""
+    changelog = []
+    if po.changelog:
+        # the same order and dates as _dump_changelog(): oldest first, and
+        # entries with the same date one second apart
+        clogs = po.changelog
+        if clog_limit:
+            clogs = clogs[:clog_limit]
+        last_ts = 0
+        hack_ts = 0
+        for (ts, author, content) in reversed(clogs):
+            if ts != last_ts:
+                hack_ts = 0
+            else:
+                hack_ts += 1
+            last_ts = ts
+            changelog.append((_sqlite_text(author), ts + hack_ts,
+                              _sqlite_text(content)))
+    return {'changelog': changelog}
+
+def sqlite_rows(po, clog_limit=None):
+    """return the rows of po for all three dbs, {table: [row, ...]} with the
+       tables and columns of sqlite_inserts, less the pkgKey"""
+    rows = primary_sqlite_rows(po)
+    rows.update(filelists_sqlite_rows(po))
+    rows.update(other_sqlite_rows(po, clog_limit))
+    return rows
+
+def manifest_info(po):
+    """return (size, mtime, pkgId, checksum type, pkgtup) of po, as kept in
+       the repodata manifest, see readMetadata"""
+    return (int(po.packagesize), int(po.filetime), po.checksum,
+            po.checksum_type, tuple(po.pkgtup))
+
+
+#  for each table: the db it's in and its insert, the pkgKey coming first.
+# The packages tables of filelists and other are fl_packages and ot_packages.
+sqlite_inserts = [
+    ('packages', 'primary', 'INSERT INTO packages VALUES (?%s)' % (', ?' * 25)),
+    ('provides', 'primary', 'INSERT INTO provides (pkgKey, name, flags, epoch, version, release) VALUES (?, ?, ?, ?, ?, ?)'),
+    ('obsoletes', 'primary', 'INSERT INTO obsoletes (pkgKey, name, flags, epoch, version, release) VALUES (?, ?, ?, ?, ?, ?)'),
+    ('conflicts', 'primary', 'INSERT INTO conflicts (pkgKey, name, flags, epoch, version, release) VALUES (?, ?, ?, ?, ?, ?)'),
+    ('requires', 'primary', 'INSERT INTO requires (pkgKey, name, flags, epoch, version, release, pre) VALUES (?, ?, ?, ?, ?, ?, ?)'),
+    ('files', 'primary', 'INSERT INTO files (pkgKey, name, type) VALUES (?, ?, ?)'),
+    ('fl_packages', 'filelists', 'INSERT INTO packages VALUES (?, ?)'),
+    ('filelist', 'filelists', 'INSERT INTO filelist VALUES (?, ?, ?, ?)'),
+    ('ot_packages', 'other', 'INSERT INTO packages VALUES (?, ?)'),
+    ('changelog', 'other', 'INSERT INTO changelog (pkgKey, author, date, changelog) VALUES (?, ?, ?, ?)'),
+    ]
+
+def add_sqlite_rows(batch, pkgKey, pkgId, rows):
+    """add rows, as from sqlite_rows(), to batch ({table: [row, ...]}) under
+       pkgKey"""
+    key = (pkgKey,)
+    for (table, pkgrows) in rows.items():
+        batch.setdefault(table, []).extend([key + row for row in pkgrows])
+    if 'packages' in rows or 'filelist' in rows:
+        batch.setdefault('fl_packages', []).append((pkgKey, pkgId))
+    if 'packages' in rows or 'changelog' in rows:
+        batch.setdefault('ot_packages', []).append((pkgKey, pkgId))
+
+def insert_sqlite_rows(cursors, batch):
+    """insert batch, from add_sqlite_rows(), using cursors ({db: cursor}).
+       Tables of dbs without a cursor are skipped"""
+    for (table, db, q) in sqlite_inserts:
+        if batch.get(table) and db in cursors:
+            cursors[db].executemany(q, batch[table])
@@ -27,6 +27,8 @@ import time
 import errno
 
 import createrepo
+import createrepo.journal
+import createrepo.daemon
 from createrepo import MDError
 from createrepo.utils import errorprint, _
 import yum.misc
@@ -54,6 +56,8 @@ def parse_args(args, conf):
         help="output more debugging info.")
     parser.add_option("--profile", default=False, action="store_true",
         help="output timing/profile info.")
+    parser.add_option("--profile-json", default=None, metavar="FILE",
+        help="write the timings of each stage and package to FILE as json")
     parser.add_option("-x", "--excludes", default=[], action="append",
         help="files to exclude")
     parser.add_option("--basedir", default=os.getcwd(),
@@ -68,6 +72,13 @@ def parse_args(args, conf):
         help="make sure all xml generated is formatted")
     parser.add_option("-c", "--cachedir", default=None,
         help="set path to cache dir")
+    parser.add_option("--cache-stats", default=False, action="store_true",
+        dest='cache_stats',
+        help="report checksum cache hits and misses for this run")
+    parser.add_option("--cache-max-entries", default=0, type='int',
+        dest='cache_max_entries',
+        help="evict the least recently used checksums from the cache dir " \
+             "beyond this many (default: no limit)")
     parser.add_option("-C", "--checkts", default=False, action="store_true",
         help="check timestamps on files vs the metadata to see " \
            "if we need to update")
@@ -75,6 +86,10 @@ def parse_args(args, conf):
         help="create sqlite database files: now default, see --no-database to disable")
     parser.add_option("--no-database", default=False, dest="nodatabase", action="store_true",
         help="do not create sqlite dbs of metadata")
+    parser.add_option("--sqlite-direct", default=False, action="store_true",
+        dest='sqlite_direct',
+        help="fill the sqlite dbs while reading the packages, instead of " \
+             "by parsing the xml metadata afterwards")
     # temporarily disabled
     #parser.add_option("--database-only", default=False, action="store_true",
     #  dest='database_only',
@@ -88,6 +103,14 @@ def parse_args(args, conf):
              "name is the same then the file is still the same " \
              "(only use this if you're fairly trusting or gullible)",
         action="store_true")
+    parser.add_option("--change-journal", default=None, dest='change_journal',
+        help="on a --update, only stat() the packages which this journal " \
+             "(kept by --watch) says changed")
+    parser.add_option("--watch", default=False, action="store_true",
+        help="keep the --change-journal of the directory, until interrupted")
+    parser.add_option("--daemon", default=None, metavar='SOCKET',
+        help="make metadata as requested on this unix socket, until " \
+             "interrupted, see createrepo/daemon.py")
     parser.add_option("--split", default=False, action="store_true",
         help="generate split media")
     parser.add_option("-i", "--pkglist", default=None,
@@ -130,13 +153,20 @@ def parse_args(args, conf):
         help="max size of an rpm that to run deltarpm against (in bytes)")
     parser.add_option("--max-concurrent-delta-rpm-size", default=100000000,
         dest='max_concurrent_delta_rpm_size', type='int',
-        help="max total payload size of concurrent deltarpm runs (in bytes)")
+        help="max total memory of concurrent deltarpm runs (in bytes)")
     parser.add_option("--workers", default=def_workers,
         dest='workers', type='int',
         help="number of workers to spawn to read rpms")
+    parser.add_option("--worker-pool", default='exec', dest='worker_pool',
+        type='choice', choices=['exec', 'fork'],
+        help="start the workers as new processes (exec, the default) or " \
+             "fork them from createrepo itself (fork)")
     parser.add_option("--delta-workers", default=1,
         dest='delta_workers', type='int',
         help="number of workers to spawn to create delta rpms")
+    parser.add_option("--delta-timeout", default=None,
+        dest='delta_timeout', type='int',
+        help="seconds after which a deltarpm run is given up on")
     parser.add_option("--xz", default=False,
         action="store_true",
         help=SUPPRESS_HELP)
@@ -145,6 +175,10 @@ def parse_args(args, conf):
         
     
     (opts, argsleft) = parser.parse_args(args)
+    if opts.daemon and not argsleft:
+        # the requests say which directory
+        argsleft = [None]
+
     if len(argsleft) > 1 and not opts.split:
         errorprint(_('Error: Only one directory allowed per run.'))
         parser.print_usage()
@@ -164,9 +198,6 @@ def parse_args(args, conf):
     if opts.delta_workers > opts.workers:
         errorprint(_('Warning: Requested more delta workers than workers. This is insane. Limiting.'))
         opts.delta_workers = opts.workers
-    if opts.max_concurrent_delta_rpm_size < opts.max_delta_rpm_size:
-        errorprint(_('Warning: max_concurrent_delta_rpm_size < max_delta_rpm_size - this will deadlock. Setting them to the same value.'))
-        opts.max_concurrent_delta_rpm_size = opts.max_delta_rpm_size
     if opts.sumtype == 'sha1':
         errorprint(_('Warning: It is more compatible to use sha instead of sha1'))
 
@@ -179,6 +210,14 @@ def parse_args(args, conf):
         errorprint(_('--split and --checkts options are mutually exclusive'))
         sys.exit(1)
 
+    if opts.watch and not opts.change_journal:
+        errorprint(_('--watch needs a --change-journal to write to'))
+        sys.exit(1)
+
+    if opts.watch and opts.split:
+        errorprint(_('--split and --watch options are mutually exclusive'))
+        sys.exit(1)
+
     if opts.nodatabase:
         opts.database = False
     
@@ -264,6 +303,25 @@ def main(args):
     start_st = time.time()
     conf = createrepo.MetaDataConfig()
     conf = parse_args(args, conf)
+    if conf.daemon:
+        parse = lambda args: parse_args(args, createrepo.MetaDataConfig())
+        try:
+            createrepo.daemon.Daemon(conf.daemon, parse).serve()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if conf.watch:
+        directory = os.path.join(conf.basedir, conf.directory)
+        try:
+            createrepo.journal.watch(directory, conf.change_journal)
+        except MDError, errormsg:
+            errorprint(_('%s') % errormsg)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
     if conf.profile:
         print ('start time: %0.3f' % (time.time() - start_st))
 
@@ -285,22 +343,33 @@ def main(args):
         if conf.profile:
             print ('mid time: %0.3f' % (time.time() - mid_st))
 
+        mdgen.timings.add('setup', time.time() - mid_st)
         pm_st = time.time()
         mdgen.doPkgMetadata()
+        mdgen.timings.add('package_metadata', time.time() - pm_st)
         if conf.profile:
             print ('pm time: %0.3f' % (time.time() - pm_st))
         rm_st = time.time()
         mdgen.doRepoMetadata()
+        mdgen.timings.add('repo_metadata', time.time() - rm_st)
         if conf.profile:
             print ('rm time: %0.3f' % (time.time() - rm_st))
         fm_st = time.time()
         mdgen.doFinalMove()
+        mdgen.timings.add('final_move', time.time() - fm_st)
         if conf.profile:
             print ('fm time: %0.3f' % (time.time() - fm_st))
         cl_st = time.time()
         mdgen.cleanup()
+        mdgen.timings.add('cleanup', time.time() - cl_st)
         if conf.profile:
             print ('cl time: %0.3f' % (time.time() - cl_st))
+        if conf.profile_json:
+            try:
+                mdgen.timings.write(conf.profile_json)
+            except (IOError, OSError), e:
+                raise MDError, _('Could not write %s: %s') % (
+                                                    conf.profile_json, e)
 
 
     except MDError, errormsg:
@@ -320,10 +389,9 @@ def main(args):
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if sys.argv[1] == 'profile':
-            import hotshot
-            p = hotshot.Profile(os.path.expanduser("~/createrepo.prof"))
-            p.run('main(sys.argv[2:])')
-            p.close()
+            import cProfile
+            cProfile.run('main(sys.argv[2:])',
+                         os.path.expanduser("~/createrepo.prof"))
         else:
             main(sys.argv[1:])
     else:
@@ -0,0 +1,84 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# how the daemon makes requests for a repo into runs
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from createrepo import daemon
+from createrepo import journal
+
+
+class FakeDaemon(object):
+    """notes the args of each run, and what the journal had for it"""
+    batch_delay = 0.5
+
+    def __init__(self):
+        self.runs = []
+        self.state = None
+
+    def run(self, args, journal_fn):
+        (self.state, changed) = journal.read_journal(journal_fn, self.state)
+        self.runs.append((args, changed))
+        return None
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.daemon = FakeDaemon()
+        self.repo = daemon._Repo(self.daemon,
+                                 os.path.join(self.tempdir, 'journal'))
+        # where the first run starts reading the journal
+        self.daemon.state = journal.read_journal(self.repo.journal.filename)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def request(self, args, packages):
+        req = daemon._Request('add', args, packages)
+        self.repo.queue.put(req)
+        return req
+
+    def wait(self, reqs):
+        for req in reqs:
+            req.done.wait(10)
+            self.assert_(req.done.isSet())
+            self.assertEqual(req.error, None)
+
+    def test_same_args(self):
+        reqs = [self.request(['--database'], ['a.rpm']),
+                self.request(['--database'], ['b.rpm'])]
+        self.wait(reqs)
+        self.assertEqual(self.daemon.runs,
+                         [(['--database'], set(['a.rpm', 'b.rpm']))])
+
+    def test_different_args(self):
+        reqs = [self.request(['--database'], ['a.rpm']),
+                self.request(['--checksum', 'sha1'], ['b.rpm']),
+                self.request(['--database'], ['c.rpm'])]
+        self.wait(reqs)
+        self.assertEqual(self.daemon.runs,
+                         [(['--database'], set(['a.rpm', 'c.rpm'])),
+                          (['--checksum', 'sha1'], set(['b.rpm']))])
+
+
+if __name__ == '__main__':
+    unittest.main()
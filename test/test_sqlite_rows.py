@@ -0,0 +1,94 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# the rows --sqlite-direct puts into the dbs, against what the xml says
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from createrepo import yumbased
+
+
+class FakePackage(object):
+    """just what primary_sqlite_rows() looks at, as a package read from a
+       repo's old metadata (no _reldir) without a --baseurl"""
+    checksum = 'f' * 64
+    checksum_type = 'sha256'
+    name = 'foo'
+    arch = 'noarch'
+    epoch = '0'
+    ver = '1.0'
+    rel = '1'
+    summary = 'A foo '
+    description = 'Foo, for testing.\n'
+    url = None
+    filetime = 1
+    buildtime = 1
+    license = 'GPLv2+'
+    vendor = None
+    group = 'Development/Tools'
+    buildhost = 'localhost'
+    sourcerpm = 'foo-1.0-1.src.rpm'
+    hdrstart = 280
+    hdrend = 2000
+    packager = None
+    packagesize = 3000
+    size = 10000
+    archivesize = 10400
+    relativepath = 'foo-1.0-1.noarch.rpm'
+    basepath = None
+    obsoletes = []
+    provides = [('foo', 'EQ', ('0', '1.0', '1'))]
+    conflicts = []
+
+    def _requires_with_pre(self):
+        return []
+
+    def _return_primary_files(self, list_of_files=None):
+        return []
+
+    def _return_primary_dirs(self):
+        return []
+
+    def returnFileEntries(self, ftype='file'):
+        return []
+
+
+class SqliteTextTests(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(yumbased._sqlite_text(None), None)
+        self.assertEqual(yumbased._sqlite_text(''), '')
+
+    def test_stripped_like_the_xml(self):
+        self.assertEqual(yumbased._sqlite_text('foo \n'), 'foo')
+        self.assertEqual(yumbased._sqlite_text('f&o\xc3\xa9 \n'),
+                         u'f&o\xe9')
+
+
+class PrimaryRowsTests(unittest.TestCase):
+    def test_no_baseurl(self):
+        rows = yumbased.primary_sqlite_rows(FakePackage())
+        package = rows['packages'][0]
+        # location_href, location_base
+        self.assertEqual(package[22], 'foo-1.0-1.noarch.rpm')
+        self.assertEqual(package[23], None)
+        self.assertEqual(package[6], 'A foo')
+        self.assertEqual(package[7], 'Foo, for testing.')
+
+
+if __name__ == '__main__':
+    unittest.main()
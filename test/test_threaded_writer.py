@@ -0,0 +1,62 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# ThreadedWriter passing on what the file it writes to does
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from createrepo import utils
+
+
+class FakeFile(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        if self.fail:
+            raise IOError, 'No space left on device'
+        self.data.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class ThreadedWriterTests(unittest.TestCase):
+    def test_write(self):
+        fo = FakeFile()
+        writer = utils.ThreadedWriter(fo, bufsize=4)
+        writer.write('foo')
+        writer.write('bar')
+        writer.write('baz')
+        self.assertEqual(writer.tell(), 9)
+        writer.close()
+        self.assertEqual(''.join(fo.data), 'foobarbaz')
+        self.assert_(fo.closed)
+
+    def test_error_closes(self):
+        fo = FakeFile(fail=True)
+        writer = utils.ThreadedWriter(fo)
+        writer.write('foo')
+        self.assertRaises(IOError, writer.close)
+        self.assert_(fo.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
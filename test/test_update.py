@@ -0,0 +1,139 @@
+#!/usr/bin/python -tt
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# createrepo --update runs, with the sqlite dbs patched rather than remade,
+# on a repo of packages built with rpmbuild
+
+import os
+import sys
+import bz2
+import glob
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SPEC = """\
+Name: %(name)s
+Version: 1.0
+Release: 1
+Summary: Test package %(name)s
+License: GPLv2+
+Group: Development/Tools
+BuildArch: noarch
+
+%%description
+Test package %(name)s.
+
+%%install
+mkdir -p %%{buildroot}/usr/share/%(name)s
+echo %(name)s > %%{buildroot}/usr/share/%(name)s/README
+
+%%files
+/usr/share/%(name)s
+"""
+
+
+def have_rpmbuild():
+    for path in os.environ.get('PATH', '').split(':'):
+        if os.access(os.path.join(path, 'rpmbuild'), os.X_OK):
+            return True
+    return False
+
+
+def build_package(name, destdir):
+    topdir = tempfile.mkdtemp()
+    try:
+        spec = os.path.join(topdir, '%s.spec' % name)
+        fo = open(spec, 'w')
+        fo.write(SPEC % {'name': name})
+        fo.close()
+        devnull = open(os.devnull, 'w')
+        subprocess.check_call(['rpmbuild', '-bb', '--quiet',
+                               '--define', '_topdir %s' % topdir, spec],
+                              stdout=devnull, stderr=devnull)
+        devnull.close()
+        for rpm in glob.glob(os.path.join(topdir, 'RPMS', '*', '*.rpm')):
+            shutil.move(rpm, destdir)
+    finally:
+        shutil.rmtree(topdir)
+
+
+class UpdateTests(unittest.TestCase):
+    def setUp(self):
+        if not have_rpmbuild():
+            self.skipTest('needs rpmbuild')
+        self.tmpdir = tempfile.mkdtemp()
+        self.packages = os.path.join(self.tmpdir, 'packages')
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        os.mkdir(self.packages)
+        os.mkdir(self.repo)
+        for name in ('alpha', 'beta', 'gamma'):
+            build_package(name, self.packages)
+
+    def tearDown(self):
+        if hasattr(self, 'tmpdir'):
+            shutil.rmtree(self.tmpdir)
+
+    def add(self, name):
+        fn = '%s-1.0-1.noarch.rpm' % name
+        os.link(os.path.join(self.packages, fn), os.path.join(self.repo, fn))
+
+    def createrepo(self, *args):
+        cmd = [sys.executable, os.path.join(TOP, 'genpkgmetadata.py'),
+               '--quiet', '--database'] + list(args) + [self.repo]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, cwd=TOP)
+        output = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, output)
+
+    def primary_rows(self):
+        (dbfn,) = glob.glob(os.path.join(self.repo, 'repodata',
+                                         '*primary.sqlite.bz2'))
+        fn = os.path.join(self.tmpdir, 'primary.sqlite')
+        fo = open(fn, 'wb')
+        fo.write(bz2.BZ2File(dbfn).read())
+        fo.close()
+        cx = sqlite3.connect(fn)
+        try:
+            return cx.execute("""SELECT name, location_base FROM packages
+                                 ORDER BY name""").fetchall()
+        finally:
+            cx.close()
+            os.unlink(fn)
+
+    def update_twice(self, *args):
+        self.add('alpha')
+        self.createrepo(*args)
+        # no --baseurl, so all the location_bases are NULL
+        self.add('beta')
+        self.createrepo('--update', *args)
+        self.add('gamma')
+        self.createrepo('--update', *args)
+        self.assertEqual(self.primary_rows(), [(u'alpha', None),
+                         (u'beta', None), (u'gamma', None)])
+
+    def test_update_twice_exec_workers(self):
+        self.update_twice('--worker-pool=exec', '--workers=2')
+
+    def test_update_twice_fork_workers(self):
+        self.update_twice('--worker-pool=fork', '--workers=2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,16 @@
 import sys
 import yum
 import createrepo
+import createrepo.cache
 import os
 import rpmUtils
 import re
+import itertools
+import time
+import traceback
+from createrepo.workerpool import read_package, pack_result, max_rss, \
+                                  write_frame, write_result, join_part, \
+                                  SHARD_FILE, STATUS_OK, STATUS_ERROR
 from optparse import OptionParser
 
 
@@ -23,9 +30,16 @@ from optparse import OptionParser
 def main(args):
     parser = OptionParser()
     parser.add_option('--tmpmdpath', default=None, 
-                help="path where the outputs should be dumped for this worker")
+                help="path where the outputs should be dumped for this worker"
+                     ", with --resultfd the shard of results the frames are for")
     parser.add_option('--pkglist', default=None, 
                 help="file to read the pkglist from in lieu of all of them on the cli")
+    parser.add_option('--stdin', default=False, action='store_true',
+                help="after the pkglist, read pkgs one per line from stdin until EOF")
+    parser.add_option('--resultfd', default=None, type='int',
+                help="write results as frames to this fd, rather than to stdout")
+    parser.add_option('--sqlite', default=False, action='store_true',
+                help="also output the sqlite db rows of each pkg")
     parser.add_option("--pkgoptions", default=[], action='append',
                 help="pkgoptions in the format of key=value")
     parser.add_option("--quiet", default=False, action='store_true',
@@ -65,14 +79,41 @@ def main(args):
     
     reldir = external_data['_reldir']
     ts = rpmUtils.transaction.initReadOnlyTransaction()
-    if opts.tmpmdpath:
+    if opts.resultfd is not None:
+        shard = None
+        if opts.tmpmdpath:
+            shard = os.open(os.path.join(opts.tmpmdpath, SHARD_FILE),
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        def output(index, status, start, start_rss, *parts):
+            rss = max_rss()
+            elapsed = time.time() - start
+            if status == STATUS_OK:
+                try:
+                    if shard is not None:
+                        # the parent reads it from the shard once it sees
+                        # the frame
+                        write_result(shard, index, status, elapsed, rss,
+                                     rss - start_rss, parts)
+                        parts = ()
+                    else:
+                        parts = [join_part(part) for part in parts]
+                except Exception:
+                    # making the filelists xml as it's written out failed,
+                    # that's this package's error
+                    print >> sys.stderr, "Error: %s" % ''.join(
+                        traceback.format_exception(*sys.exc_info())).strip()
+                    (status, parts) = (STATUS_ERROR, ())
+            write_result(opts.resultfd, index, status, elapsed, rss,
+                         rss - start_rss, parts)
+    elif opts.tmpmdpath:
         files = [open(opts.tmpmdpath + '/%s.xml' % i, 'w')
                  for i in ('primary', 'filelists', 'other')]
-        def output(*xml):
+        def output(index, status, start, start_rss, *xml):
             for fh, buf in zip(files, xml):
-                fh.write(buf)
+                fh.write(join_part(buf))
     else:
-        def output(*xml):
+        def output(index, status, start, start_rss, *parts):
+            xml = [join_part(part) for part in parts[:3]]
             buf = ' '.join(str(len(i)) for i in xml)
             sys.stdout.write('*** %s\n' % buf)
             for buf in xml:
@@ -85,32 +126,37 @@ def main(args):
                 continue
             pkgs.append(line)
 
+    if opts.stdin:
+        # the parent hands us a package whenever we're done with the last one,
+        # so read it line by line rather than letting the file object buffer
+        pkgs = itertools.chain(pkgs, (line.rstrip('\n') for line in
+                                      iter(sys.stdin.readline, '')))
+
+    if external_data.get('_cachedir'):
+        # share the parent's run id, so it can tell what we used and added
+        createrepo.cache.get_checksum_cache(external_data['_cachedir'],
+                                            globalopts.get('sumtype', None),
+                                            globalopts.get('cache_run', None))
+
     clog_limit=globalopts.get('clog_limit', None)
     if clog_limit is not None:
          clog_limit = int(clog_limit)
-    for pkgfile in pkgs:
-        pkgpath = reldir + '/' + pkgfile
-        if not os.path.exists(pkgpath):
-            print >> sys.stderr, "File not found: %s" % pkgpath
-            output()
-            continue
+    for index, pkgfile in enumerate(pkgs):
+        start = time.time()
+        start_rss = max_rss()
+        if not opts.quiet and opts.verbose:
+            print "reading %s" % (pkgfile)
 
-        try:
-            if not opts.quiet and opts.verbose:
-                print "reading %s" % (pkgfile)
-
-            pkg = createrepo.yumbased.CreateRepoPackage(ts, package=pkgpath, 
-                                sumtype=globalopts.get('sumtype', None), 
-                                external_data=external_data)
-            output(pkg.xml_dump_primary_metadata(),
-                   pkg.xml_dump_filelists_metadata(),
-                   pkg.xml_dump_other_metadata(clog_limit=clog_limit))
-        except yum.Errors.YumBaseError, e:
-            print >> sys.stderr, "Error: %s" % e
-            output()
-            continue
-        else:
+        (status, parts, msg) = read_package(ts, reldir, pkgfile, external_data,
+                                     sumtype=globalopts.get('sumtype', None),
+                                     clog_limit=clog_limit, sqlite=opts.sqlite)
+        if msg:
+            print >> sys.stderr, msg
+        output(index, status, start, start_rss, *parts)
+        if status == STATUS_OK:
             external_data['_packagenumber']+=1
+
+    createrepo.cache.flush_checksum_caches()
         
 if __name__ == "__main__":
     main(sys.argv[1:])